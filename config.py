@@ -2,6 +2,12 @@
 Configuration settings for FramePack AI Video Generator
 """
 
+import os
+
+
+# Root directory for on-disk caches
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
 # Flow shift configurations
 FLOW_SHIFT_CONFIGS = {
     "standard": {
@@ -24,7 +30,16 @@ FLOW_SHIFT_CONFIGS = {
     }
 }
 
+# Sigma schedules
+FLOW_SCHEDULE_CONFIG = {
+    # JSON file of precomputed sigma schedules that replace the computed ones for a flow preset
+    # and step count, e.g. to pin a schedule across versions. See load_custom_schedules.
+    "custom_schedules_file": None,
+}
+
 # Preset configurations for different video types
+# "calibrated_teacache" names a TEACACHE_CONFIG setting the preset uses instead of its "use_teacache"
+# once the TeaCache calibration file (see TEACACHE_CALIBRATION_CONFIG) covers that setting.
 PRESET_CONFIGS = {
     "Default": {
         "prompt": "",
@@ -37,6 +52,7 @@ PRESET_CONFIGS = {
     "Dance": {
         "prompt": "The person dances gracefully, with clear movements, full of charm.",
         "use_teacache": False,  # Disable TeaCache for better hand details
+        "calibrated_teacache": "hand_optimized",  # Block-level TeaCache once a calibration file validates its threshold
         "steps": 30,
         "gs": 12.0,
         "gpu_memory_preservation": 6,
@@ -53,6 +69,7 @@ PRESET_CONFIGS = {
     "Action": {
         "prompt": "The person performs an action with flowing movement. High quality, detailed.", 
         "use_teacache": False,  # Disable TeaCache for better hand details
+        "calibrated_teacache": "hand_optimized",  # Block-level TeaCache once a calibration file validates its threshold
         "steps": 30, 
         "gs": 12.0,
         "gpu_memory_preservation": 6,
@@ -69,6 +86,7 @@ PRESET_CONFIGS = {
     "Hand Movement": {
         "prompt": "The person makes detailed hand gestures and finger movements, demonstrating fine motor control.",
         "use_teacache": False,  # Disable TeaCache completely for best hand details
+        "calibrated_teacache": "hand_optimized",  # Block-level TeaCache once a calibration file validates its threshold
         "steps": 35,
         "gs": 14.0,
         "gpu_memory_preservation": 8,
@@ -89,21 +107,119 @@ EXAMPLE_PROMPTS = [
 ]
 
 # TeaCache configurations
+# A group is recomputed once its accumulated drift reaches "rel_l1_thresh", so a lower threshold
+# skips less: slower, closer to the result without TeaCache.
+# "mode": "model" skips all transformer blocks of a step at once; "blocks" decides per group of
+# "block_group_size" consecutive blocks, so groups whose input still changes keep being computed.
+# "residual_budget_gb" bounds the cached group residuals of all CFG branches together; groups that do not
+# fit are always computed. Low-VRAM mode reserves it on top of the GPU memory preservation setting.
 TEACACHE_CONFIG = {
     "standard": {
         "rel_l1_thresh": 0.15,  # Standard threshold - 2.1x speedup with good quality
+        "mode": "model",
     },
     "hand_optimized": {
-        "rel_l1_thresh": 0.25,  # Higher threshold for better hand details
+        # Skips less than standard. The built-in rescale polynomial was fitted for whole-model inputs,
+        # so record traces and run calibrate-teacache to fit one for block mode before relying on it.
+        "rel_l1_thresh": 0.1,
+        "mode": "blocks",
+        "block_group_size": 4,
+        "residual_budget_gb": 1.5,
     },
     "quality_first": {
-        "rel_l1_thresh": 0.35,  # Maximum quality preservation with minimal speedup
+        "rel_l1_thresh": 0.35,  # Most skipping: fastest, lowest quality
     }
 }
 
+# Offline TeaCache calibration (python framepack.py record-teacache / calibrate-teacache)
+TEACACHE_CALIBRATION_CONFIG = {
+    # When this file exists, its rescale polynomial and thresholds replace the ones above
+    "file": os.path.join(CACHE_DIR, "teacache_calibration.json"),
+    "trace_steps": [25, 35],  # Step counts each job is recorded with
+    "degree": 4,  # Degree of the rescale polynomial
+    # Largest mean drift (relative L1) that reusing residuals may accumulate, per TeaCache setting
+    "max_error": {
+        "standard": 0.08,
+        "hand_optimized": 0.04,
+        "quality_first": 0.02,
+    },
+}
+
+# Encoder output caches (memory tier is LRU, disk tier evicts least recently used files)
+EMBEDDING_CACHE_CONFIG = {
+    "prompt": {
+        "memory_mb": 512,
+        "disk_dir": os.path.join(CACHE_DIR, "prompt_embeds"),
+        "disk_mb": 2048,  # Set to 0 to disable the disk tier
+    },
+    "image": {
+        "memory_mb": 256,
+        "disk_dir": os.path.join(CACHE_DIR, "image_embeds"),
+        "disk_mb": 1024,  # Set to 0 to disable the disk tier
+    },
+}
+
+# Low-VRAM memory management
+MEMORY_CONFIG = {
+    # "dynamic": DynamicSwapInstaller, every weight access copies from pageable CPU memory
+    # "pinned": PinnedSwapInstaller, transformer blocks stream from pinned memory with async prefetch
+    "swap_engine": "dynamic",
+    "pinned_gpu_budget_gb": 0,  # Transformer blocks kept resident on GPU by the pinned engine
+    "pinned_prefetch_blocks": 1,  # Blocks uploaded ahead of the one being computed
+    # With the dynamic engine, plan which transformer blocks stay on GPU from their byte sizes
+    # and the observed activation peak instead of polling free memory per submodule
+    "residency_planner": True,
+    "vram_budget_gb": None,  # None: free memory measured once per section
+    "activation_margin": 1.1,  # Headroom on top of the observed activation peak
+    # VAE, image encoder and CLIP text encoder stay on GPU while they fit in this budget (LRU eviction)
+    "model_budget_gb": 2.0,
+}
+
+# Sampling performance settings
+SAMPLING_CONFIG = {
+    # Flow-matching sampler: "unipc", "unipc_bh2", "dpmpp_2m", "euler" or "heun" (two model calls per step)
+    "sampler": "unipc",
+    # Run the positive and negative CFG branches as one batch-of-2 forward pass when cfg != 1.
+    # None enables it only in High-VRAM mode; it falls back to two passes on OOM either way.
+    "cfg_batching": None,
+    # Decide TeaCache skips from the previous step's distance, copied to the host asynchronously,
+    # so the CPU never blocks on the GPU mid-forward. Reacts to changes one step later.
+    "sync_free": False,
+}
+
+# Adaptive step count per section
+ADAPTIVE_STEPS_CONFIG = {
+    # None: every section runs the configured steps
+    # "early_stop": stop a section once its denoised estimate stops changing and keep that estimate
+    # "coarse_grid": run each section on a full schedule with as many steps as the previous section needed
+    "mode": None,
+    "tolerance": 0.01,  # Mean relative change of the denoised estimate between steps that counts as converged
+    "patience": 2,  # Consecutive converged steps needed
+    "min_steps_ratio": 0.5,  # Never use fewer than this fraction of the configured steps
+}
+
+# Attention kernels
+ATTENTION_CONFIG = {
+    # None: first installed of sage, flash, xformers, sdpa
+    # "sage" / "flash" / "xformers" / "sdpa": use that backend (falls back to the default order if unavailable)
+    # "auto": benchmark the installed backends on the first call with each shape and keep the fastest
+    # The FRAMEPACK_ATTENTION_BACKEND environment variable overrides this setting
+    "backend": None,
+}
+
+# Section decoding
+DECODE_CONFIG = {
+    # Deferred decode keeps the transformer on GPU for all sections and decodes the whole video
+    # with the VAE once at the end, instead of swapping transformer and VAE after every section.
+    # None: deferred for headless runs only, where intermediate videos are not written anyway
+    "deferred_decode": None,
+    "preview_every_sections": 0,  # With deferred decode, VAE-decode the newest section as a preview every N sections (0: never)
+}
+
 # Default UI settings
 DEFAULT_UI_SETTINGS = {
     "seed": 31337,
+    "num_variations": 1,  # Seeds denoised together as one batch
     "total_second_length": 5.0,
     "latent_window_size": 9,
     "steps": 25,
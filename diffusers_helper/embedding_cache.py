@@ -0,0 +1,256 @@
+"""
+Content-addressed caches for encoder outputs.
+
+`TensorCache` is a two-tier store for small groups of named tensors: an
+in-memory LRU tier and an on-disk safetensors tier, both bounded in bytes.
+The typed caches on top of it build the keys, so a hit never needs the
+encoder that produced the value to be loaded.
+"""
+
+import os
+import json
+import hashlib
+import weakref
+
+from collections import OrderedDict
+from threading import Lock
+
+import torch
+import safetensors.torch as sf
+
+from diffusers.pipelines.hunyuan_video.pipeline_hunyuan_video import DEFAULT_PROMPT_TEMPLATE
+
+
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def model_fingerprint(model, chunk_bytes=256 * 1024 ** 2):
+    """
+    Hash of the model weights, keying on-disk entries to the exact encoder.
+
+    Hashes the class name, config, and every parameter's name, shape, dtype and
+    full bytes, so merged LoRAs or partial fine-tunes never hit stale entries.
+    Hashing takes seconds for a large encoder, so it is done once per model object;
+    weights copy to the host `chunk_bytes` at a time.
+    """
+    if model in _fingerprints:
+        return _fingerprints[model]
+
+    h = hashlib.sha256()
+    h.update(type(model).__name__.encode())
+
+    config = getattr(model, 'config', None)
+    if config is not None:
+        h.update(config.to_json_string().encode() if hasattr(config, 'to_json_string') else str(config).encode())
+
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            h.update(f'{name}:{tuple(p.shape)}:{p.dtype}'.encode())
+            data = p.detach().contiguous().flatten().view(torch.uint8)
+            for chunk in data.split(chunk_bytes):
+                h.update(chunk.cpu().numpy())
+
+    fingerprint = h.hexdigest()
+    _fingerprints[model] = fingerprint
+    return fingerprint
+
+
+def _tensors_nbytes(tensors):
+    return sum(t.nelement() * t.element_size() for t in tensors.values())
+
+
+class TensorCache:
+    def __init__(self, memory_max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir is not None and self.disk_max_bytes > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        else:
+            self.disk_dir = None
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.safetensors')
+
+    def _memory_put(self, key, tensors):
+        nbytes = _tensors_nbytes(tensors)
+
+        if nbytes > self.memory_max_bytes:
+            return
+
+        if key in self.memory:
+            self.memory_bytes -= _tensors_nbytes(self.memory.pop(key))
+
+        self.memory[key] = tensors
+        self.memory_bytes += nbytes
+
+        while self.memory_bytes > self.memory_max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= _tensors_nbytes(evicted)
+
+    def _disk_evict(self):
+        entries = []
+        total_bytes = 0
+
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.safetensors'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+        entries.sort()
+
+        for _, size, path in entries:
+            if total_bytes <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def get(self, key):
+        """Return the dict of CPU tensors stored under `key`, or None."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if self.disk_dir is not None:
+                path = self._disk_path(key)
+                if os.path.exists(path):
+                    try:
+                        tensors = sf.load_file(path)
+                        os.utime(path)  # Disk tier is LRU by mtime
+                    except Exception as e:
+                        print(f'Could not read cache entry {path}: {e}')
+                    else:
+                        self._memory_put(key, tensors)
+                        self.hits += 1
+                        return tensors
+
+            self.misses += 1
+            return None
+
+    def put(self, key, tensors):
+        tensors = {k: v.detach().to(device='cpu').contiguous() for k, v in tensors.items()}
+
+        with self.lock:
+            self._memory_put(key, tensors)
+
+            if self.disk_dir is not None and _tensors_nbytes(tensors) <= self.disk_max_bytes:
+                path = self._disk_path(key)
+                sf.save_file(tensors, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self._disk_evict()
+
+        return
+
+
+class PromptEmbeddingCache:
+    """
+    Cache for the `(llama_vec, clip_l_pooler)` pair returned by `encode_prompt_conds`.
+
+    Keys cover the prompt text, the prompt template, max_length and both text
+    encoders' weights, so a hit is always the exact value the encoders would produce.
+    """
+
+    def __init__(self, tensor_cache, text_encoder, text_encoder_2, prompt_template=DEFAULT_PROMPT_TEMPLATE):
+        self.tensor_cache = tensor_cache
+        self.text_encoder = text_encoder
+        self.text_encoder_2 = text_encoder_2
+        self.prompt_template = prompt_template
+
+    def key(self, prompt, max_length=256):
+        content = json.dumps([
+            prompt,
+            self.prompt_template['template'],
+            self.prompt_template['crop_start'],
+            max_length,
+            model_fingerprint(self.text_encoder),
+            model_fingerprint(self.text_encoder_2),
+        ])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, prompt, max_length=256):
+        tensors = self.tensor_cache.get(self.key(prompt, max_length))
+        if tensors is None:
+            return None
+        return tensors['llama_vec'], tensors['clip_l_pooler']
+
+    def put(self, prompt, llama_vec, clip_l_pooler, max_length=256):
+        self.tensor_cache.put(self.key(prompt, max_length), {'llama_vec': llama_vec, 'clip_l_pooler': clip_l_pooler})
+
+    def get_or_encode(self, prompts, encode_fn, max_length=256):
+        """
+        Look up every prompt and encode only the misses.
+
+        Args:
+            prompts: List of prompt strings
+            encode_fn: Called once with the list of missing prompts (never with an
+                empty list) and must return a list of (llama_vec, clip_l_pooler).
+                This is where the caller loads the text encoders, so they are not
+                touched at all when every prompt hits.
+
+        Returns:
+            List of (llama_vec, clip_l_pooler) in the order of `prompts`
+        """
+        results = {}
+        missing = []
+
+        for prompt in prompts:
+            if prompt in results or prompt in missing:
+                continue
+            cached = self.get(prompt, max_length)
+            if cached is None:
+                missing.append(prompt)
+            else:
+                results[prompt] = cached
+
+        if len(missing) > 0:
+            for prompt, (llama_vec, clip_l_pooler) in zip(missing, encode_fn(missing)):
+                self.put(prompt, llama_vec, clip_l_pooler, max_length)
+                results[prompt] = (llama_vec, clip_l_pooler)
+
+        return [results[prompt] for prompt in prompts]
+
+
+class ImageEmbeddingCache:
+    """
+    Cache for the start-image encodings: the VAE `start_latent` and the SigLIP
+    `image_encoder_last_hidden_state`.
+
+    Keys cover the bucketed, center-cropped pixels, the bucket resolution and the
+    VAE and image encoder weights, so regenerating from the same image with another
+    prompt or seed needs neither encoder.
+    """
+
+    def __init__(self, tensor_cache, vae, image_encoder):
+        self.tensor_cache = tensor_cache
+        self.vae = vae
+        self.image_encoder = image_encoder
+
+    def key(self, image_np):
+        height, width = image_np.shape[:2]
+        h = hashlib.sha256()
+        h.update(json.dumps([height, width, str(image_np.dtype), model_fingerprint(self.vae), model_fingerprint(self.image_encoder)]).encode())
+        h.update(image_np.tobytes())
+        return h.hexdigest()
+
+    def get(self, image_np):
+        tensors = self.tensor_cache.get(self.key(image_np))
+        if tensors is None:
+            return None
+        return tensors['start_latent'], tensors['image_encoder_last_hidden_state']
+
+    def put(self, image_np, start_latent, image_encoder_last_hidden_state):
+        self.tensor_cache.put(self.key(image_np), {'start_latent': start_latent, 'image_encoder_last_hidden_state': image_encoder_last_hidden_state})
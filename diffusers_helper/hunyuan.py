@@ -4,21 +4,14 @@ from diffusers.pipelines.hunyuan_video.pipeline_hunyuan_video import DEFAULT_PRO
 from diffusers_helper.utils import crop_or_pad_yield_mask
 
 
-@torch.no_grad()
-def encode_prompt_conds(prompt, text_encoder, text_encoder_2, tokenizer, tokenizer_2, max_length=256):
-    assert isinstance(prompt, str)
-
-    prompt = [prompt]
-
-    # LLAMA
-
-    prompt_llama = [DEFAULT_PROMPT_TEMPLATE["template"].format(p) for p in prompt]
+def encode_llama_batch(prompts, text_encoder, tokenizer, pad_length):
+    prompt_llama = [DEFAULT_PROMPT_TEMPLATE["template"].format(p) for p in prompts]
     crop_start = DEFAULT_PROMPT_TEMPLATE["crop_start"]
 
     llama_inputs = tokenizer(
         prompt_llama,
         padding="max_length",
-        max_length=max_length + crop_start,
+        max_length=pad_length,
         truncation=True,
         return_tensors="pt",
         return_length=False,
@@ -28,7 +21,7 @@ def encode_prompt_conds(prompt, text_encoder, text_encoder_2, tokenizer, tokeniz
 
     llama_input_ids = llama_inputs.input_ids.to(text_encoder.device)
     llama_attention_mask = llama_inputs.attention_mask.to(text_encoder.device)
-    llama_attention_length = int(llama_attention_mask.sum())
+    llama_attention_lengths = llama_attention_mask.sum(dim=1).tolist()
 
     llama_outputs = text_encoder(
         input_ids=llama_input_ids,
@@ -36,16 +29,20 @@ def encode_prompt_conds(prompt, text_encoder, text_encoder_2, tokenizer, tokeniz
         output_hidden_states=True,
     )
 
-    llama_vec = llama_outputs.hidden_states[-3][:, crop_start:llama_attention_length]
-    # llama_vec_remaining = llama_outputs.hidden_states[-3][:, llama_attention_length:]
-    llama_attention_mask = llama_attention_mask[:, crop_start:llama_attention_length]
+    results = []
 
-    assert torch.all(llama_attention_mask.bool())
+    for i, llama_attention_length in enumerate(llama_attention_lengths):
+        llama_vec = llama_outputs.hidden_states[-3][i:i + 1, crop_start:llama_attention_length]
+        # llama_vec_remaining = llama_outputs.hidden_states[-3][i:i + 1, llama_attention_length:]
+        assert torch.all(llama_attention_mask[i, crop_start:llama_attention_length].bool())
+        results.append(llama_vec)
 
-    # CLIP
+    return results
 
+
+def encode_clip_l_batch(prompts, text_encoder_2, tokenizer_2):
     clip_l_input_ids = tokenizer_2(
-        prompt,
+        prompts,
         padding="max_length",
         max_length=77,
         truncation=True,
@@ -54,8 +51,66 @@ def encode_prompt_conds(prompt, text_encoder, text_encoder_2, tokenizer, tokeniz
         return_tensors="pt",
     ).input_ids
     clip_l_pooler = text_encoder_2(clip_l_input_ids.to(text_encoder_2.device), output_hidden_states=False).pooler_output
+    return list(clip_l_pooler.split(1, dim=0))
+
+
+def bucket_prompts_by_length(prompts, tokenizer, max_length=256, batch_size=8, bucket_size=32):
+    """
+    Group prompts into batches of similar Llama token length.
+
+    Returns:
+        List of (prompt_indices, pad_length) where pad_length is the batch's
+        longest prompt rounded up to a multiple of bucket_size
+    """
+    crop_start = DEFAULT_PROMPT_TEMPLATE["crop_start"]
+    full_length = max_length + crop_start
+
+    prompt_llama = [DEFAULT_PROMPT_TEMPLATE["template"].format(p) for p in prompts]
+    lengths = [min(len(ids), full_length) for ids in tokenizer(prompt_llama, truncation=True, max_length=full_length).input_ids]
+
+    order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        longest = max(lengths[i] for i in indices)
+        pad_length = min(full_length, ((longest + bucket_size - 1) // bucket_size) * bucket_size)
+        batches.append((indices, pad_length))
+
+    return batches
 
-    return llama_vec, clip_l_pooler
+
+@torch.no_grad()
+def encode_prompt_conds(prompt, text_encoder, text_encoder_2, tokenizer, tokenizer_2, max_length=256, batch_size=8, bucket_size=32):
+    """
+    Encode one prompt, or a list of prompts in a few batched forward passes.
+
+    A single string returns `(llama_vec, clip_l_pooler)`. A list returns one such
+    pair per prompt, in order; each llama_vec keeps its own length. Lists are
+    bucketed by token length so each Llama pass pads only to the longest prompt
+    of its batch instead of max_length.
+    """
+    if isinstance(prompt, str):
+        llama_vec, = encode_llama_batch([prompt], text_encoder, tokenizer, pad_length=max_length + DEFAULT_PROMPT_TEMPLATE["crop_start"])
+        clip_l_pooler, = encode_clip_l_batch([prompt], text_encoder_2, tokenizer_2)
+        return llama_vec, clip_l_pooler
+
+    prompts = list(prompt)
+
+    if len(prompts) == 0:
+        return []
+
+    llama_vecs = [None] * len(prompts)
+    for indices, pad_length in bucket_prompts_by_length(prompts, tokenizer, max_length=max_length, batch_size=batch_size, bucket_size=bucket_size):
+        batch_vecs = encode_llama_batch([prompts[i] for i in indices], text_encoder, tokenizer, pad_length=pad_length)
+        for i, llama_vec in zip(indices, batch_vecs):
+            llama_vecs[i] = llama_vec
+
+    clip_l_poolers = []
+    for start in range(0, len(prompts), batch_size):
+        clip_l_poolers += encode_clip_l_batch(prompts[start:start + batch_size], text_encoder_2, tokenizer_2)
+
+    return list(zip(llama_vecs, clip_l_poolers))
 
 
 @torch.no_grad()
@@ -104,6 +159,62 @@ def vae_decode(latents, vae, image_mode=False):
     return image
 
 
+def _pixels_to_uint8(x):
+    return (torch.clamp(x.float(), -1., 1.) * 127.5 + 127.5).to(torch.uint8)
+
+
+@torch.no_grad()
+def vae_decode_chunked(latents, vae, chunk_latent_frames=8, context_latent_frames=3, blend_frames=4):
+    """
+    Decode latents in temporal chunks, yielding uint8 bcthw pixel chunks on CPU in order.
+
+    The VAE's causal convolutions treat the first latent of every decode call as
+    the start of a clip, so every chunk after the first is decoded with
+    `context_latent_frames` latents of the previous chunk in front and the frames
+    they produce are dropped. Their last `blend_frames` frames are kept instead to
+    crossfade with the held-back tail of the previous chunk. Concatenated, the
+    chunks have the 4 * (T - 1) + 1 frames of a single `vae_decode` call, while host
+    memory only ever holds about one chunk.
+    """
+    total_latent_frames = latents.shape[2]
+    held = None  # Tail of the previous chunk, waiting to be blended with the next one
+    start = 0
+
+    while start < total_latent_frames:
+        end = min(start + chunk_latent_frames, total_latent_frames)
+        context_start = max(0, start - context_latent_frames)
+
+        # Local frame k of this decode is global frame 4 * context_start + k
+        pixels = vae_decode(latents[:, :, context_start:end], vae).float().cpu()
+
+        if held is None:
+            first_new = 0
+        else:
+            # First frame after the previous chunk's last frame, 4 * (start - 1)
+            first_new = 4 * (start - 1) + 1 - 4 * context_start
+            overlap = held.shape[2]
+            weights = torch.linspace(1, 0, overlap, dtype=pixels.dtype).view(1, 1, -1, 1, 1)
+            pixels[:, :, first_new - overlap:first_new] = weights * held + (1 - weights) * pixels[:, :, first_new - overlap:first_new]
+            first_new -= overlap
+
+        if end < total_latent_frames:
+            # The next chunk's first_new is 4 * context_latent_frames - 3 frames into its decode
+            overlap = min(blend_frames, 4 * min(context_latent_frames, end) - 3, pixels.shape[2] - first_new)
+            overlap = max(overlap, 0)
+            chunk = pixels[:, :, first_new:pixels.shape[2] - overlap]
+            held = pixels[:, :, pixels.shape[2] - overlap:].clone()
+        else:
+            chunk = pixels[:, :, first_new:]
+            held = None
+
+        if chunk.shape[2] > 0:
+            yield _pixels_to_uint8(chunk)
+
+        start = end
+
+    return
+
+
 @torch.no_grad()
 def vae_encode(image, vae):
     latents = vae.encode(image.to(device=vae.device, dtype=vae.dtype)).latent_dist.sample()
@@ -0,0 +1,72 @@
+"""
+Convergence monitoring for adaptive step counts.
+
+Later sections of a long video are conditioned on much more clean context than
+the first one, and their denoised estimate often settles well before the last
+step. `ConvergenceMonitor` watches the mean relative change of the denoised
+estimate between consecutive steps and tells the sampler to stop once it has
+stayed below a tolerance for a few steps; the sampler then returns the current
+denoised estimate. Without early stopping it only records when the criterion was
+met, so the next section can be run on a coarser grid instead.
+
+The change is copied to the host asynchronously and judged one step later, so
+monitoring never blocks the CPU on the GPU mid-sampling.
+"""
+
+from diffusers_helper.models.hunyuan_video_packed import lagged_rel_l1
+
+
+def relative_change(current, previous):
+    # Per sample
+    current, previous = current.flatten(1).float(), previous.flatten(1).float()
+    return (current - previous).abs().mean(dim=1) / previous.abs().mean(dim=1).clamp_min(1e-8)
+
+
+class ConvergenceMonitor:
+    """
+    Args:
+        num_steps: Steps of the full schedule
+        tolerance: Largest mean relative change of the denoised estimate, over all
+            samples of the batch, that counts as converged
+        patience: Consecutive converged steps needed to stop
+        min_steps_ratio: Never stop before this fraction of num_steps
+        early_stop: Stop sampling once converged; otherwise only record the step
+    """
+
+    def __init__(self, num_steps, tolerance=0.01, patience=2, min_steps_ratio=0.5, early_stop=True):
+        self.num_steps = num_steps
+        self.early_stop = early_stop
+        self.tolerance = tolerance
+        self.patience = patience
+        self.min_steps = max(int(round(num_steps * min_steps_ratio)), 1)
+
+        self.steps = 0
+        self.converged_at = None  # Steps taken when the criterion was first met
+        self.changes = []
+        self.previous = None
+        self.pending = None
+        self.calm_steps = 0
+
+    def update(self, i, denoised):
+        """Record the denoised estimate of step i. Returns True if sampling should stop after it."""
+        self.steps = i + 1
+
+        if self.previous is not None:
+            change, self.pending = lagged_rel_l1(relative_change(denoised, self.previous), self.pending)
+
+            if change is not None:
+                change = float(change.max())
+                self.changes.append(change)
+                self.calm_steps = self.calm_steps + 1 if change < self.tolerance else 0
+
+        self.previous = denoised
+
+        if self.converged_at is None and self.calm_steps >= self.patience and self.steps >= self.min_steps:
+            self.converged_at = self.steps
+
+        return self.early_stop and self.converged_at is not None and self.steps < self.num_steps
+
+    def summary(self):
+        if self.converged_at is None:
+            return f'{self.steps}/{self.num_steps} steps, not converged'
+        return f'{self.steps}/{self.num_steps} steps, converged after {self.converged_at}'
@@ -0,0 +1,142 @@
+"""
+Flow-matching samplers, registered by name.
+
+Every sampler has the signature of `sample_unipc`:
+
+    sampler(model, noise, sigmas, extra_args=None, callback=None, disable=False, convergence=None)
+
+where `model(x, sigma, **extra_args)` returns the denoised estimate (see
+`fm_wrapper`), `sigmas` runs from 1 down to 0, and `callback` gets
+{'x', 'i', 'denoised'} after every step. They return the final denoised latents,
+or the current denoised estimate once `convergence` (a ConvergenceMonitor) says
+the run has converged.
+
+Model evaluations per run with n = len(sigmas) - 1 steps:
+
+- euler, dpmpp_2m, unipc, unipc_bh2: n
+- heun: 2n - 1 (the step to sigma 0 is a plain Euler step)
+"""
+
+import math
+
+from functools import partial
+from tqdm.auto import trange
+
+from diffusers_helper.k_diffusion.uni_pc_fm import sample_unipc
+
+
+def sample_euler(model, noise, sigmas, extra_args=None, callback=None, disable=False, convergence=None):
+    extra_args = {} if extra_args is None else extra_args
+    x = noise
+
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i].expand(x.shape[0]), **extra_args)
+
+        # Flow matching velocity is (x - denoised) / sigma, so this is exact at sigma_next = 0
+        sigma, sigma_next = sigmas[i], sigmas[i + 1]
+        x = denoised + (x - denoised) * (sigma_next / sigma)
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 'denoised': denoised})
+
+        if convergence is not None and convergence.update(i, denoised):
+            return denoised
+
+    return x
+
+
+def sample_heun(model, noise, sigmas, extra_args=None, callback=None, disable=False, convergence=None):
+    extra_args = {} if extra_args is None else extra_args
+    x = noise
+
+    for i in trange(len(sigmas) - 1, disable=disable):
+        sigma, sigma_next = sigmas[i], sigmas[i + 1]
+        denoised = model(x, sigma.expand(x.shape[0]), **extra_args)
+        d = (x - denoised) / sigma
+
+        if i == len(sigmas) - 2:
+            # The final sigma is 0, where the velocity is undefined; Euler lands exactly on the denoised estimate
+            x = denoised
+        else:
+            x_euler = x + d * (sigma_next - sigma)
+            denoised_next = model(x_euler, sigma_next.expand(x.shape[0]), **extra_args)
+            d_next = (x_euler - denoised_next) / sigma_next
+            x = x + (d + d_next) * 0.5 * (sigma_next - sigma)
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 'denoised': denoised})
+
+        if convergence is not None and convergence.update(i, denoised):
+            return denoised
+
+    return x
+
+
+def sample_dpmpp_2m(model, noise, sigmas, extra_args=None, callback=None, disable=False, convergence=None):
+    """DPM-Solver++(2M) in the flow-matching time lambda = -log(sigma), as in UniPC above."""
+    extra_args = {} if extra_args is None else extra_args
+    x = noise
+
+    sigmas_host = sigmas.detach().double().cpu().tolist()  # One sync per run; step weights are host floats
+    old_denoised = None
+    h_last = None
+
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i].expand(x.shape[0]), **extra_args)
+        sigma, sigma_next = sigmas_host[i], sigmas_host[i + 1]
+
+        if sigma_next == 0:
+            x = denoised
+        else:
+            h = math.log(sigma) - math.log(sigma_next)
+
+            if old_denoised is None:
+                denoised_d = denoised
+            else:
+                r = h_last / h
+                denoised_d = denoised * (1 + 1 / (2 * r)) - old_denoised * (1 / (2 * r))
+
+            x = x * (sigma_next / sigma) - denoised_d * math.expm1(-h)
+            h_last = h
+
+        old_denoised = denoised
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 'denoised': denoised})
+
+        if convergence is not None and convergence.update(i, denoised):
+            return denoised
+
+    return x
+
+
+SAMPLERS = {
+    'unipc': sample_unipc,
+    'unipc_bh2': partial(sample_unipc, variant='bh2', lower_order_final=True),
+    'euler': sample_euler,
+    'heun': sample_heun,
+    'dpmpp_2m': sample_dpmpp_2m,
+}
+
+# Model evaluations of a run with n steps, where that is not n. Counters that advance per
+# model call, such as TeaCache's step counter, need this as their number of steps.
+SAMPLER_NFE = {
+    'heun': lambda steps: 2 * steps - 1,
+}
+
+
+def register_sampler(name, sampler, nfe=None):
+    SAMPLERS[name] = sampler
+    if nfe is not None:
+        SAMPLER_NFE[name] = nfe
+
+
+def sampler_nfe(name, steps):
+    """Number of model evaluations of sampler `name` in a run of `steps` steps."""
+    return SAMPLER_NFE[name](steps) if name in SAMPLER_NFE else steps
+
+
+def get_sampler(name):
+    if name not in SAMPLERS:
+        raise NotImplementedError(f'Sampler {name} is not supported, available: {list(SAMPLERS.keys())}')
+    return SAMPLERS[name]
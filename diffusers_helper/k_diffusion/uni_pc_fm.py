@@ -4,138 +4,186 @@
 # Attribution-ShareAlike 4.0 International Licence
 
 
+import math
 import torch
+import numpy as np
 
+from collections import OrderedDict
 from tqdm.auto import trange
 
 
-def expand_dims(v, dims):
-    return v[(...,) + (None,) * (dims - 1)]
+_coefficient_cache = OrderedDict()
+_coefficient_cache_size = 32
 
 
-class FlowMatchUniPC:
-    def __init__(self, model, extra_args, variant='bh1'):
-        self.model = model
-        self.variant = variant
-        self.extra_args = extra_args
+def step_coefficients(t_prev_list, t, order, variant):
+    """
+    Coefficients of one UniPC step from the previous times `t_prev_list` (oldest
+    first, `order` of them) to `t`, in float64.
 
-    def model_fn(self, x, t):
-        return self.model(x, t, **self.extra_args)
+    Both the predicted x_t and the corrected x_t are linear combinations of x and
+    the previous model outputs (oldest first); the corrected one also of the model
+    output at the predicted x_t. Returns (x weight, predictor weights, corrector
+    weights, weight of the new model output).
+    """
+    t_prev_0 = t_prev_list[-1]
+    lambda_prev_0 = - math.log(t_prev_0)
+    lambda_t = - math.log(t)
+
+    h = lambda_t - lambda_prev_0
 
-    def update_fn(self, x, model_prev_list, t_prev_list, t, order):
-        assert order <= len(model_prev_list)
-        dims = x.dim()
+    rks = []
+    for i in range(1, order):
+        lambda_prev_i = - math.log(t_prev_list[-(i + 1)])
+        rks.append((lambda_prev_i - lambda_prev_0) / h)
 
-        t_prev_0 = t_prev_list[-1]
-        lambda_prev_0 = - torch.log(t_prev_0)
-        lambda_t = - torch.log(t)
-        model_prev_0 = model_prev_list[-1]
+    rks.append(1.)
+    rks = np.array(rks, dtype=np.float64)
 
-        h = lambda_t - lambda_prev_0
+    R = []
+    b = []
 
-        rks = []
-        D1s = []
-        for i in range(1, order):
-            t_prev_i = t_prev_list[-(i + 1)]
-            model_prev_i = model_prev_list[-(i + 1)]
-            lambda_prev_i = - torch.log(t_prev_i)
-            rk = ((lambda_prev_i - lambda_prev_0) / h)[0]
-            rks.append(rk)
-            D1s.append((model_prev_i - model_prev_0) / rk)
+    hh = -h
+    h_phi_1 = math.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1
 
-        rks.append(1.)
-        rks = torch.tensor(rks, device=x.device)
+    factorial_i = 1
 
-        R = []
-        b = []
+    if variant == 'bh1':
+        B_h = hh
+    elif variant == 'bh2':
+        B_h = math.expm1(hh)
+    else:
+        raise NotImplementedError('Bad variant!')
 
-        hh = -h[0]
-        h_phi_1 = torch.expm1(hh)
-        h_phi_k = h_phi_1 / hh - 1
+    for i in range(1, order + 1):
+        R.append(np.power(rks, i - 1))
+        b.append(h_phi_k * factorial_i / B_h)
+        factorial_i *= (i + 1)
+        h_phi_k = h_phi_k / hh - 1 / factorial_i
 
-        factorial_i = 1
+    R = np.stack(R)
+    b = np.array(b, dtype=np.float64)
 
-        if self.variant == 'bh1':
-            B_h = hh
-        elif self.variant == 'bh2':
-            B_h = torch.expm1(hh)
+    use_predictor = order > 1
+
+    if use_predictor:
+        if order == 2:
+            rhos_p = np.array([0.5])
         else:
-            raise NotImplementedError('Bad variant!')
+            rhos_p = np.linalg.solve(R[:-1, :-1], b[:-1])
+    else:
+        rhos_p = np.zeros(0)
 
-        for i in range(1, order + 1):
-            R.append(torch.pow(rks, i - 1))
-            b.append(h_phi_k * factorial_i / B_h)
-            factorial_i *= (i + 1)
-            h_phi_k = h_phi_k / hh - 1 / factorial_i
+    if order == 1:
+        rhos_c = np.array([0.5])
+    else:
+        rhos_c = np.linalg.solve(R, b)
 
-        R = torch.stack(R)
-        b = torch.tensor(b, device=x.device)
+    # D1_k = (model_prev_k - model_prev_0) / rk_k, where model_prev_k is the k-th newest output
+    predictor = [0.0] * order
+    corrector = [0.0] * order
 
-        use_predictor = len(D1s) > 0
+    predictor[-1] = - h_phi_1
+    corrector[-1] = - h_phi_1 + B_h * rhos_c[-1]
 
-        if use_predictor:
-            D1s = torch.stack(D1s, dim=1)
-            if order == 2:
-                rhos_p = torch.tensor([0.5], device=b.device)
-            else:
-                rhos_p = torch.linalg.solve(R[:-1, :-1], b[:-1])
-        else:
-            D1s = None
-            rhos_p = None
+    for k in range(1, order):
+        rk = rks[k - 1]
+        predictor[-(k + 1)] -= B_h * rhos_p[k - 1] / rk
+        predictor[-1] += B_h * rhos_p[k - 1] / rk
+        corrector[-(k + 1)] -= B_h * rhos_c[k - 1] / rk
+        corrector[-1] += B_h * rhos_c[k - 1] / rk
 
-        if order == 1:
-            rhos_c = torch.tensor([0.5], device=b.device)
-        else:
-            rhos_c = torch.linalg.solve(R, b)
+    return t / t_prev_0, tuple(float(w) for w in predictor), tuple(float(w) for w in corrector), float(- B_h * rhos_c[-1])
 
-        x_t_ = expand_dims(t / t_prev_0, dims) * x - expand_dims(h_phi_1, dims) * model_prev_0
 
-        if use_predictor:
-            pred_res = torch.tensordot(D1s, rhos_p, dims=([1], [0]))
-        else:
-            pred_res = 0
+def unipc_coefficients(sigmas, order, variant, lower_order_final=False):
+    """
+    Coefficients of every step of a sampling run, as Python floats so steps need no
+    small device tensors or solves. Depends only on the schedule, order and variant,
+    so tables are cached across sections and jobs.
 
-        x_t = x_t_ - expand_dims(B_h, dims) * pred_res
-        model_t = self.model_fn(x_t, t)
+    With lower_order_final, the order is also capped by the number of remaining
+    steps, which keeps the last steps stable at low step counts.
+    """
+    if isinstance(sigmas, torch.Tensor):
+        sigmas = sigmas.detach().to(device='cpu', dtype=torch.float64).tolist()
 
-        if D1s is not None:
-            corr_res = torch.tensordot(D1s, rhos_c[:-1], dims=([1], [0]))
-        else:
-            corr_res = 0
+    key = (tuple(sigmas), order, variant, lower_order_final)
+
+    if key in _coefficient_cache:
+        _coefficient_cache.move_to_end(key)
+        return _coefficient_cache[key]
+
+    table = [None]  # The first step only evaluates the model
+
+    for i in range(1, len(sigmas) - 1):
+        step_order = min(i, order)
+        if lower_order_final:
+            step_order = min(step_order, len(sigmas) - 1 - i)
+        table.append(step_coefficients(sigmas[i - step_order:i], sigmas[i], step_order, variant))
+
+    table = tuple(table)
+    _coefficient_cache[key] = table
 
-        D1_t = (model_t - model_prev_0)
-        x_t = x_t_ - expand_dims(B_h, dims) * (corr_res + rhos_c[-1] * D1_t)
+    while len(_coefficient_cache) > _coefficient_cache_size:
+        _coefficient_cache.popitem(last=False)
+
+    return table
+
+
+def linear_combination(weights, tensors):
+    result = tensors[0] * weights[0]
+    for w, x in zip(weights[1:], tensors[1:]):
+        result.add_(x, alpha=w)
+    return result
+
+
+class FlowMatchUniPC:
+    def __init__(self, model, extra_args, variant='bh1', lower_order_final=False):
+        self.model = model
+        self.variant = variant
+        self.lower_order_final = lower_order_final
+        self.extra_args = extra_args
+
+    def model_fn(self, x, t):
+        return self.model(x, t, **self.extra_args)
+
+    def update_fn(self, x, model_prev_list, t, coefficients):
+        x_weight, predictor, corrector, model_t_weight = coefficients
+        model_prev_list = model_prev_list[-len(predictor):]
+
+        x_t = linear_combination((x_weight,) + predictor, [x] + model_prev_list)
+        model_t = self.model_fn(x_t, t)
+
+        x_t = linear_combination((x_weight,) + corrector + (model_t_weight,), [x] + model_prev_list + [model_t])
 
         return x_t, model_t
 
-    def sample(self, x, sigmas, callback=None, disable_pbar=False):
+    def sample(self, x, sigmas, callback=None, disable_pbar=False, convergence=None):
         order = min(3, len(sigmas) - 2)
-        model_prev_list, t_prev_list = [], []
+        coefficients = unipc_coefficients(sigmas, order, self.variant, self.lower_order_final)
+        model_prev_list = []
         for i in trange(len(sigmas) - 1, disable=disable_pbar):
             vec_t = sigmas[i].expand(x.shape[0])
 
             if i == 0:
                 model_prev_list = [self.model_fn(x, vec_t)]
-                t_prev_list = [vec_t]
-            elif i < order:
-                init_order = i
-                x, model_x = self.update_fn(x, model_prev_list, t_prev_list, vec_t, init_order)
-                model_prev_list.append(model_x)
-                t_prev_list.append(vec_t)
             else:
-                x, model_x = self.update_fn(x, model_prev_list, t_prev_list, vec_t, order)
+                x, model_x = self.update_fn(x, model_prev_list, vec_t, coefficients[i])
                 model_prev_list.append(model_x)
-                t_prev_list.append(vec_t)
 
             model_prev_list = model_prev_list[-order:]
-            t_prev_list = t_prev_list[-order:]
 
             if callback is not None:
                 callback({'x': x, 'i': i, 'denoised': model_prev_list[-1]})
 
+            if convergence is not None and convergence.update(i, model_prev_list[-1]):
+                break
+
         return model_prev_list[-1]
 
 
-def sample_unipc(model, noise, sigmas, extra_args=None, callback=None, disable=False, variant='bh1'):
+def sample_unipc(model, noise, sigmas, extra_args=None, callback=None, disable=False, variant='bh1', lower_order_final=False, convergence=None):
     assert variant in ['bh1', 'bh2']
-    return FlowMatchUniPC(model, extra_args=extra_args, variant=variant).sample(noise, sigmas=sigmas, callback=callback, disable_pbar=disable)
+    return FlowMatchUniPC(model, extra_args=extra_args, variant=variant, lower_order_final=lower_order_final).sample(noise, sigmas=sigmas, callback=callback, disable_pbar=disable, convergence=convergence)
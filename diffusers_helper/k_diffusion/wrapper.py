@@ -16,7 +16,60 @@ def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=1.0):
     return noise_cfg
 
 
+def concat_cfg_kwargs(positive, negative, batch_size):
+    """
+    Merge positive and negative transformer kwargs into one batch of 2 * batch_size.
+
+    Per-sample tensors are concatenated along the batch dim; values shared by both
+    branches are kept as they are. Returns None if the two cannot be merged.
+    """
+    if positive.keys() != negative.keys():
+        return None
+
+    fused = {}
+
+    for k, p in positive.items():
+        n = negative[k]
+
+        if isinstance(p, torch.Tensor) and isinstance(n, torch.Tensor):
+            if p.ndim > 0 and p.shape == n.shape and p.shape[0] == batch_size:
+                fused[k] = torch.cat([p, n], dim=0)
+            elif p is n or (p.shape == n.shape and torch.equal(p, n)):
+                fused[k] = p
+            else:
+                return None
+        elif p is n or p == n:
+            fused[k] = p
+        else:
+            return None
+
+    return fused
+
+
 def fm_wrapper(transformer, t_scale=1000.0):
+    # Batched CFG state, shared by all steps of one sampling run
+    cfg_batch = dict(source=None, kwargs=None, disabled=False)
+
+    def get_cfg_batch_kwargs(extra_args, batch_size):
+        if cfg_batch['disabled'] or not extra_args.get('cfg_batching', False):
+            return None
+
+        positive, negative = extra_args['positive'], extra_args['negative']
+
+        # Kwargs are the same objects at every step, so they are only merged once
+        if cfg_batch['source'] is None or cfg_batch['source'][0] is not positive or cfg_batch['source'][1] is not negative:
+            cfg_batch['source'] = (positive, negative)
+            cfg_batch['kwargs'] = concat_cfg_kwargs(positive, negative, batch_size)
+
+        return cfg_batch['kwargs']
+
+    def teacache_kwargs(extra_args, branch, start_step=0):
+        # Every transformer call of a step gets its own TeaCache state, so CFG branches never see each other's residuals
+        teacache = extra_args.get('teacache', None)
+        if teacache is None:
+            return {}
+        return dict(teacache=teacache.branch(branch, start_step=start_step))
+
     def k_model(x, sigma, **extra_args):
         dtype = extra_args['dtype']
         cfg_scale = extra_args['cfg_scale']
@@ -34,12 +87,35 @@ def fm_wrapper(transformer, t_scale=1000.0):
         else:
             hidden_states = torch.cat([x, concat_latent.to(x)], dim=1)
 
-        pred_positive = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['positive'])[0].float()
-
-        if cfg_scale == 1.0:
-            pred_negative = torch.zeros_like(pred_positive)
-        else:
-            pred_negative = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['negative'])[0].float()
+        pred_positive = None
+        start_step = 0
+
+        if cfg_scale != 1.0:
+            fused_kwargs = get_cfg_batch_kwargs(extra_args, batch_size=hidden_states.shape[0])
+
+            if fused_kwargs is not None:
+                # Positive and negative in one forward pass; their text masks differ, so the transformer takes its varlen path
+                fused_teacache_kwargs = teacache_kwargs(extra_args, 'cfg_batch')
+                try:
+                    pred = transformer(hidden_states=torch.cat([hidden_states, hidden_states], dim=0), timestep=torch.cat([timestep, timestep], dim=0), return_dict=False, **fused_kwargs, **fused_teacache_kwargs)[0].float()
+                    pred_positive, pred_negative = pred.chunk(2, dim=0)
+                except (torch.cuda.OutOfMemoryError, NotImplementedError) as e:
+                    print(f'Batched CFG failed ({e.__class__.__name__}), falling back to separate positive and negative passes.')
+                    cfg_batch['disabled'] = True
+                    pred_positive = None
+                    # The batched branch is dead: free its 2B-batch residuals and budget share.
+                    # The separate branches continue its step count
+                    if fused_teacache_kwargs:
+                        start_step = extra_args['teacache'].discard_branch('cfg_batch').cnt
+                    torch.cuda.empty_cache()
+
+        if pred_positive is None:
+            pred_positive = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['positive'], **teacache_kwargs(extra_args, 'positive', start_step))[0].float()
+
+            if cfg_scale == 1.0:
+                pred_negative = torch.zeros_like(pred_positive)
+            else:
+                pred_negative = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['negative'], **teacache_kwargs(extra_args, 'negative', start_step))[0].float()
 
         pred_cfg = pred_negative + cfg_scale * (pred_positive - pred_negative)
         pred = rescale_noise_cfg(pred_cfg, pred_positive, guidance_rescale=cfg_rescale)
@@ -1,8 +1,10 @@
 import torch
 
+from collections import OrderedDict
+
 
 cpu = torch.device('cpu')
-gpu = torch.device(f'cuda:{torch.cuda.current_device()}')
+gpu = torch.device(f'cuda:{torch.cuda.current_device()}') if torch.cuda.is_available() else cpu
 gpu_complete_modules = []
 
 
@@ -54,6 +56,516 @@ class DynamicSwapInstaller:
         return
 
 
+def find_repeated_blocks(model: torch.nn.Module):
+    """
+    Return the repeated blocks of a model in execution order.
+
+    These are the children of every top-level ModuleList whose entries all share
+    one class, e.g. transformer_blocks / single_transformer_blocks of the
+    transformer or layers of the Llama text encoder.
+    """
+    blocks = []
+    block_ids = set()
+
+    for m in model.modules():
+        if id(m) in block_ids:
+            continue
+
+        if isinstance(m, torch.nn.ModuleList) and len(m) > 1 and len(set(type(c) for c in m)) == 1:
+            for child in m:
+                blocks.append(child)
+                block_ids.update(id(c) for c in child.modules())
+
+    return blocks
+
+
+def _module_tensors(module: torch.nn.Module):
+    tensors = [p for p in module.parameters() if p is not None]
+    tensors += [b for b in module.buffers() if b is not None]
+    return tensors
+
+
+def _tensors_nbytes(tensors):
+    return sum(t.data.nelement() * t.data.element_size() for t in tensors)
+
+
+class PinnedSwapEngine:
+    """
+    Streams the repeated blocks of a model from pinned host memory.
+
+    Blocks that fit in `gpu_budget_bytes` stay on the device for good; the others
+    live in pinned host memory and are copied in right before they run. Copies
+    are issued on a separate CUDA stream `prefetch_blocks` blocks ahead, so block
+    N+1 is uploaded while block N computes. Everything outside the repeated
+    blocks (embedders, norms, output projection) is small and stays resident.
+
+    On a non-CUDA device there is no pinning and no side stream and copies are
+    synchronous. This CPU path uses the same hooks and counters, so it can be
+    unit-tested without a GPU.
+    """
+
+    def __init__(self, model, device, gpu_budget_bytes=0, prefetch_blocks=1):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.copy_stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        self.prefetch_blocks = prefetch_blocks
+
+        self.blocks = find_repeated_blocks(model)
+        self.resident = []
+        self.streamed = []
+        self.uploads = {}  # Prefetched copies: index -> (tensors, copies, event)
+        self.swapped_in = {}  # Blocks computing on the copies: index -> (tensors, homes)
+        self.hooks = []
+
+        self.bytes_uploaded = 0
+        self.upload_count = 0
+
+        block_tensor_ids = set()
+        for block in self.blocks:
+            block_tensor_ids.update(id(t) for t in _module_tensors(block))
+
+        for t in _module_tensors(model):
+            if id(t) not in block_tensor_ids:
+                t.data = t.data.to(self.device)
+
+        remaining_budget = gpu_budget_bytes
+
+        for index, block in enumerate(self.blocks):
+            tensors = _module_tensors(block)
+            nbytes = _tensors_nbytes(tensors)
+
+            if nbytes <= remaining_budget:
+                remaining_budget -= nbytes
+                for t in tensors:
+                    t.data = t.data.to(self.device)
+                self.resident.append(index)
+                continue
+
+            for t in tensors:
+                t.data = t.data.to(cpu)
+                if self.use_cuda:
+                    t.data = t.data.pin_memory()
+
+            self.streamed.append(index)
+            self.hooks.append(block.register_forward_pre_hook(self._make_pre_hook(index)))
+            self.hooks.append(block.register_forward_hook(self._make_post_hook(index)))
+
+        self.next_streamed = {a: b for a, b in zip(self.streamed, self.streamed[1:] + self.streamed[:1])}
+
+        print(f'PinnedSwapEngine: {len(self.resident)} blocks resident, {len(self.streamed)} blocks streamed to {self.device}')
+
+    def _upload(self, index):
+        if index in self.uploads:
+            return
+
+        tensors = _module_tensors(self.blocks[index])
+
+        if self.use_cuda:
+            with torch.cuda.stream(self.copy_stream):
+                copies = [t.data.to(self.device, non_blocking=True) for t in tensors]
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+        else:
+            copies = [t.data.to(self.device) for t in tensors]
+            event = None
+
+        self.uploads[index] = (tensors, copies, event)
+        self.bytes_uploaded += _tensors_nbytes(tensors)
+        self.upload_count += 1
+
+    def _make_pre_hook(self, index):
+        def pre_hook(module, args):
+            self._upload(index)
+            tensors, copies, event = self.uploads[index]
+
+            if self.use_cuda:
+                compute_stream = torch.cuda.current_stream(self.device)
+                compute_stream.wait_event(event)
+
+            homes = []
+            for t, c in zip(tensors, copies):
+                homes.append(t.data)
+                t.data = c
+                if self.use_cuda:
+                    # Allocated on the copy stream but used on the compute stream
+                    c.record_stream(compute_stream)
+
+            del self.uploads[index]
+            self.swapped_in[index] = (tensors, homes)
+
+            # Queue the following blocks (wrapping around for the next forward pass) while this one computes
+            following = []
+            for _ in range(min(self.prefetch_blocks, len(self.streamed) - 1)):
+                following.append(self.next_streamed[following[-1] if following else index])
+
+            # Blocks that were skipped (e.g. by TeaCache) never consumed their prefetched copies; free them
+            for stale in [i for i in self.uploads if i not in following]:
+                del self.uploads[stale]
+
+            for i in following:
+                self._upload(i)
+
+            return None
+
+        return pre_hook
+
+    def _make_post_hook(self, index):
+        def post_hook(module, args, output):
+            tensors, homes = self.swapped_in.pop(index)
+            for t, home in zip(tensors, homes):
+                t.data = home
+            return None
+
+        return post_hook
+
+    def uninstall(self):
+        for hook in self.hooks:
+            hook.remove()
+
+        self.hooks = []
+
+        self.uploads = {}
+
+        for index in list(self.swapped_in.keys()):
+            # Block was swapped in by its pre-hook (an interrupted forward); restore its pinned copies
+            tensors, homes = self.swapped_in.pop(index)
+            for t, home in zip(tensors, homes):
+                t.data = home
+
+        for block in self.blocks:
+            for t in _module_tensors(block):
+                t.data = t.data.to(cpu)
+
+        return
+
+
+class PinnedSwapInstaller:
+    """
+    Alternative to DynamicSwapInstaller with the same install_model / uninstall_model API.
+
+    Weights of the repeated blocks are streamed from pinned host memory with
+    asynchronous prefetching, see PinnedSwapEngine.
+    """
+
+    @staticmethod
+    def install_model(model: torch.nn.Module, device, gpu_budget_gb=0, prefetch_blocks=1, **kwargs):
+        PinnedSwapInstaller.uninstall_model(model)
+        engine = PinnedSwapEngine(model, device=device, gpu_budget_bytes=int(gpu_budget_gb * 1024 ** 3), prefetch_blocks=prefetch_blocks)
+        model.__dict__['pinned_swap_engine'] = engine
+        return
+
+    @staticmethod
+    def uninstall_model(model: torch.nn.Module):
+        engine = model.__dict__.pop('pinned_swap_engine', None)
+        if engine is not None:
+            engine.uninstall()
+        return
+
+    @staticmethod
+    def is_installed(model: torch.nn.Module):
+        return 'pinned_swap_engine' in model.__dict__
+
+
+class ResidencyPlan:
+    """
+    Decision of a ResidencyPlanner: which repeated blocks stay on the device and
+    which stay on CPU and stream in through DynamicSwapInstaller.
+    """
+
+    def __init__(self, key, budget_bytes, activation_bytes, base_bytes, block_bytes, resident, streamed):
+        self.key = key
+        self.budget_bytes = budget_bytes
+        self.activation_bytes = activation_bytes
+        self.base_bytes = base_bytes
+        self.block_bytes = block_bytes
+        self.resident = resident
+        self.streamed = streamed
+
+    @property
+    def resident_bytes(self):
+        return self.base_bytes + sum(self.block_bytes[i] for i in self.resident)
+
+    @property
+    def streamed_bytes(self):
+        return sum(self.block_bytes[i] for i in self.streamed)
+
+    def __repr__(self):
+        gb = 1024 ** 3
+        return (f'ResidencyPlan(key={self.key}, budget={self.budget_bytes / gb:.2f} GB, activations={self.activation_bytes / gb:.2f} GB, '
+                f'resident={len(self.resident)} blocks / {self.resident_bytes / gb:.2f} GB, '
+                f'streamed={len(self.streamed)} blocks / {self.streamed_bytes / gb:.2f} GB)')
+
+
+class ResidencyPlanner:
+    """
+    Decides how much of a model fits on the device from byte sizes instead of
+    querying free memory before every submodule move.
+
+    Sizes of the model's repeated blocks and of everything else ("base") are
+    computed once. Each plan takes a VRAM budget (fixed, or the free memory
+    measured once), subtracts the activation peak observed for the same key
+    (resolution, window size, batch) and makes as many blocks resident as fit.
+    Until a key has been observed, `default_activation_gb` is reserved instead.
+    """
+
+    def __init__(self, model, device, vram_budget_gb=None, activation_margin=1.1):
+        self.model = model
+        self.device = torch.device(device)
+        self.vram_budget_bytes = None if vram_budget_gb is None else int(vram_budget_gb * 1024 ** 3)
+        self.activation_margin = activation_margin
+
+        self.blocks = find_repeated_blocks(model)
+        self.block_tensors = [_module_tensors(block) for block in self.blocks]
+        self.block_bytes = [_tensors_nbytes(tensors) for tensors in self.block_tensors]
+
+        block_tensor_ids = set(id(t) for tensors in self.block_tensors for t in tensors)
+        self.base_tensors = [t for t in _module_tensors(model) if id(t) not in block_tensor_ids]
+        self.base_bytes = _tensors_nbytes(self.base_tensors)
+
+        self.activation_peaks = {}
+        self.last_plan = None
+
+    def _on_device(self, tensors):
+        return len(tensors) > 0 and tensors[0].device == self.device
+
+    def placed_bytes(self):
+        """Bytes of this model currently on the device, from tensor placement alone (no CUDA queries)."""
+        placed = self.base_bytes if self._on_device(self.base_tensors) else 0
+        placed += sum(nbytes for tensors, nbytes in zip(self.block_tensors, self.block_bytes) if self._on_device(tensors))
+        return placed
+
+    def plan(self, key, default_activation_gb=6):
+        if self.vram_budget_bytes is not None:
+            budget_bytes = self.vram_budget_bytes
+        else:
+            budget_bytes = int(get_cuda_free_memory_gb(self.device) * 1024 ** 3) + self.placed_bytes()
+
+        if key in self.activation_peaks:
+            activation_bytes = int(self.activation_peaks[key] * self.activation_margin)
+        else:
+            activation_bytes = int(default_activation_gb * 1024 ** 3)
+
+        remaining = budget_bytes - activation_bytes - self.base_bytes
+        resident = []
+        streamed = []
+
+        for index, nbytes in enumerate(self.block_bytes):
+            if nbytes <= remaining:
+                remaining -= nbytes
+                resident.append(index)
+            else:
+                streamed.append(index)
+
+        self.last_plan = ResidencyPlan(key, budget_bytes, activation_bytes, self.base_bytes, self.block_bytes, resident, streamed)
+        return self.last_plan
+
+    def _move(self, tensors, device):
+        for t in tensors:
+            t.data = t.data.to(device)
+
+    def apply(self, plan):
+        """Move only the blocks whose placement differs from the plan."""
+        print(f'Applying {plan}')
+
+        resident = set(plan.resident)
+        released = False
+
+        if not self._on_device(self.base_tensors):
+            self._move(self.base_tensors, self.device)
+
+        for index, tensors in enumerate(self.block_tensors):
+            on_device = self._on_device(tensors)
+            if index in resident and not on_device:
+                self._move(tensors, self.device)
+            elif index not in resident and on_device:
+                self._move(tensors, cpu)
+                released = True
+
+        if released and self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return
+
+    def offload(self, preserved_memory_gb):
+        """
+        Move resident blocks back to CPU, last block first, until `preserved_memory_gb`
+        is free. Free memory is measured once and the rest is byte accounting.
+        """
+        if self.device.type != 'cuda':
+            # Without CUDA the planned device is the CPU (see `gpu`); there is nothing to free
+            return
+
+        needed = int((preserved_memory_gb - get_cuda_free_memory_gb(self.device)) * 1024 ** 3)
+
+        for index in reversed(range(len(self.blocks))):
+            if needed <= 0:
+                break
+            if self._on_device(self.block_tensors[index]):
+                self._move(self.block_tensors[index], cpu)
+                needed -= self.block_bytes[index]
+
+        torch.cuda.empty_cache()
+        return
+
+    def observe_activations(self, key):
+        """Context manager recording the peak memory allocated on top of the weights while it is open."""
+        return _ActivationObserver(self, key)
+
+
+class _ActivationObserver:
+    def __init__(self, planner, key):
+        self.planner = planner
+        self.key = key
+        self.start_bytes = 0
+
+    def __enter__(self):
+        if self.planner.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.planner.device)
+            self.start_bytes = torch.cuda.memory_allocated(self.planner.device)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.planner.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.planner.device) - self.start_bytes
+            self.planner.activation_peaks[self.key] = max(peak, self.planner.activation_peaks.get(self.key, 0))
+        return False
+
+
+class CudaMemoryAccountant:
+    """Device side of ModelResidencyManager: moves whole models and reports free device memory."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+
+    def free_bytes(self):
+        return int(get_cuda_free_memory_gb(self.device) * 1024 ** 3)
+
+    def to_device(self, model, nbytes):
+        model.to(device=self.device)
+
+    def to_host(self, model, nbytes):
+        model.to(device=cpu)
+
+    def release_cache(self):
+        torch.cuda.empty_cache()
+
+
+class FakeDeviceMemoryAccountant:
+    """
+    Pretends to be a device with `total_bytes` of memory. Models never leave the
+    CPU; only the byte accounting changes, so ModelResidencyManager can be tested
+    without a GPU. `reserved_bytes` simulates memory held by something else.
+    """
+
+    def __init__(self, total_bytes, reserved_bytes=0):
+        self.total_bytes = total_bytes
+        self.reserved_bytes = reserved_bytes
+        self.used_bytes = 0
+
+    def free_bytes(self):
+        return self.total_bytes - self.reserved_bytes - self.used_bytes
+
+    def to_device(self, model, nbytes):
+        if nbytes > self.free_bytes():
+            raise torch.cuda.OutOfMemoryError(f'Fake device out of memory: {nbytes} bytes requested, {self.free_bytes()} free')
+        self.used_bytes += nbytes
+
+    def to_host(self, model, nbytes):
+        self.used_bytes -= nbytes
+
+    def release_cache(self):
+        return
+
+
+class ModelResidencyManager:
+    """
+    Keeps whole models on the device while they fit in `budget_bytes` and evicts
+    the least recently used ones only when a load needs the room.
+
+    This replaces the load_model_as_complete / unload_complete_models pattern, where
+    every load unloads everything else and the VAE and encoders are moved on and
+    off the device for every section.
+    """
+
+    def __init__(self, budget_bytes, accountant):
+        self.budget_bytes = budget_bytes
+        self.accountant = accountant
+
+        self.resident = OrderedDict()  # id(model) -> (model, nbytes), least recently used first
+        self.model_bytes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_loaded = 0
+        self.bytes_evicted = 0
+
+    def size_of(self, model):
+        if id(model) not in self.model_bytes:
+            self.model_bytes[id(model)] = _tensors_nbytes(_module_tensors(model))
+        return self.model_bytes[id(model)]
+
+    @property
+    def resident_bytes(self):
+        return sum(nbytes for _, nbytes in self.resident.values())
+
+    def is_resident(self, model):
+        return id(model) in self.resident
+
+    def _evict_lru(self):
+        _, (model, nbytes) = self.resident.popitem(last=False)
+        self.accountant.to_host(model, nbytes)
+        self.evictions += 1
+        self.bytes_evicted += nbytes
+        print(f'Evicted {model.__class__.__name__} ({nbytes / 1024 ** 3:.2f} GB)')
+
+    def load(self, model):
+        """Make `model` resident, evicting least recently used models if it does not fit."""
+        if id(model) in self.resident:
+            self.resident.move_to_end(id(model))
+            self.hits += 1
+            return
+
+        self.misses += 1
+        nbytes = self.size_of(model)
+
+        while len(self.resident) > 0 and (self.resident_bytes + nbytes > self.budget_bytes or self.accountant.free_bytes() < nbytes):
+            self._evict_lru()
+
+        self.accountant.release_cache()
+        self.accountant.to_device(model, nbytes)
+        self.bytes_loaded += nbytes
+
+        # A model larger than the whole budget is still loaded, but only until the next load
+        self.resident[id(model)] = (model, nbytes)
+        print(f'Loaded {model.__class__.__name__} ({nbytes / 1024 ** 3:.2f} GB), {self.resident_bytes / 1024 ** 3:.2f} GB resident')
+        return
+
+    def evict(self, model):
+        entry = self.resident.pop(id(model), None)
+        if entry is not None:
+            self.accountant.to_host(model, entry[1])
+            self.evictions += 1
+            self.bytes_evicted += entry[1]
+        return
+
+    def unload_all(self):
+        while len(self.resident) > 0:
+            self._evict_lru()
+        self.accountant.release_cache()
+        return
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            bytes_loaded=self.bytes_loaded,
+            bytes_evicted=self.bytes_evicted,
+            resident_bytes=self.resident_bytes,
+            resident=[model.__class__.__name__ for model, _ in self.resident.values()],
+        )
+
+
 def fake_diffusers_current_device(model: torch.nn.Module, target_device: torch.device):
     if hasattr(model, 'scale_shift_table'):
         model.scale_shift_table.data = model.scale_shift_table.data.to(target_device)
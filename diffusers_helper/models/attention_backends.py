@@ -0,0 +1,248 @@
+"""
+Registry of attention implementations used by the packed HunyuanVideo transformer.
+
+Every backend takes q, k, v of shape (batch, seq_len, heads, head_dim). The
+varlen form also takes the cumulative sequence boundaries of flash-attn's varlen
+API over the flattened (batch * seq_len) tokens, and only attends within each
+segment.
+
+The backend is chosen by name with `set_attention_backend`, or with the
+FRAMEPACK_ATTENTION_BACKEND environment variable, which takes precedence:
+
+- None / "default": first available of sage, flash, xformers, sdpa (the old fixed priority)
+- "auto": micro-benchmark the available backends on the first call with each
+  shape, check them against SDPA and keep the fastest correct one for that shape
+- a backend name: always use it, falling back to the default order if it is not
+  installed or lacks the required form
+"""
+
+import os
+import time
+
+import torch
+
+from collections import OrderedDict
+
+
+enabled_backends = []
+
+if torch.backends.cuda.flash_sdp_enabled():
+    enabled_backends.append("flash")
+if torch.backends.cuda.math_sdp_enabled():
+    enabled_backends.append("math")
+if torch.backends.cuda.mem_efficient_sdp_enabled():
+    enabled_backends.append("mem_efficient")
+if torch.backends.cuda.cudnn_sdp_enabled():
+    enabled_backends.append("cudnn")
+
+print("Currently enabled native sdp backends:", enabled_backends)
+
+try:
+    # raise NotImplementedError
+    from xformers.ops import memory_efficient_attention as xformers_attn_func
+    print('Xformers is installed!')
+except:
+    print('Xformers is not installed!')
+    xformers_attn_func = None
+
+try:
+    # raise NotImplementedError
+    from flash_attn import flash_attn_varlen_func, flash_attn_func
+    print('Flash Attn is installed!')
+except:
+    print('Flash Attn is not installed!')
+    flash_attn_varlen_func = None
+    flash_attn_func = None
+
+try:
+    # raise NotImplementedError
+    from sageattention import sageattn_varlen, sageattn
+    print('Sage Attn is installed!')
+except:
+    print('Sage Attn is not installed!')
+    sageattn_varlen = None
+    sageattn = None
+
+
+class AttentionBackend:
+    def __init__(self, name, dense=None, varlen=None):
+        self.name = name
+        self.dense = dense
+        self.varlen = varlen
+
+    def supports(self, varlen):
+        return (self.varlen if varlen else self.dense) is not None
+
+
+ATTENTION_BACKENDS = OrderedDict()
+DEFAULT_BACKEND_ORDER = ['sage', 'flash', 'xformers', 'sdpa']
+
+selected_backend = os.environ.get('FRAMEPACK_ATTENTION_BACKEND', None)
+benchmarked_backends = {}  # Shape signature -> backend name, for "auto"
+
+
+def register_attention_backend(name, dense=None, varlen=None):
+    ATTENTION_BACKENDS[name] = AttentionBackend(name, dense=dense, varlen=varlen)
+
+
+def set_attention_backend(name):
+    """Select a backend by name; the FRAMEPACK_ATTENTION_BACKEND environment variable overrides it."""
+    global selected_backend
+    selected_backend = os.environ.get('FRAMEPACK_ATTENTION_BACKEND', name)
+
+    if selected_backend not in (None, 'default', 'auto') and selected_backend not in ATTENTION_BACKENDS:
+        raise ValueError(f'Unknown attention backend "{selected_backend}", available: {list(ATTENTION_BACKENDS.keys())}')
+
+    print(f'Attention backend: {selected_backend or "default"}')
+    return
+
+
+def _flatten(x):
+    return x.reshape(x.shape[0] * x.shape[1], *x.shape[2:])
+
+
+def _sage_varlen(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv):
+    x = sageattn_varlen(_flatten(q), _flatten(k), _flatten(v), cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
+    return x.view(q.shape[0], max_seqlen_q, *x.shape[1:])
+
+
+def _flash_varlen(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv):
+    x = flash_attn_varlen_func(_flatten(q), _flatten(k), _flatten(v), cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
+    return x.view(q.shape[0], max_seqlen_q, *x.shape[1:])
+
+
+def _sdpa_dense(q, k, v):
+    return torch.nn.functional.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)).transpose(1, 2)
+
+
+_segment_bounds_cache = {}
+
+
+def segment_bounds(cu_seqlens):
+    """
+    cu_seqlens as a host list. Copied once and reused while the same cu_seqlens
+    tensor is passed, i.e. for every block and step of a section.
+    """
+    cached = _segment_bounds_cache.get(id(cu_seqlens), None)
+    if cached is not None and cached[0] is cu_seqlens:
+        return cached[1]
+
+    bounds = cu_seqlens.tolist()
+
+    _segment_bounds_cache.clear()
+    _segment_bounds_cache[id(cu_seqlens)] = (cu_seqlens, bounds)
+    return bounds
+
+
+def _sdpa_varlen(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv):
+    # Fallback for machines without sage/flash-attn; also runs on CPU. One unmasked SDPA call per
+    # segment, so memory stays that of dense attention over the longest segment.
+    assert cu_seqlens_q is cu_seqlens_kv or torch.equal(cu_seqlens_q, cu_seqlens_kv), 'SDPA varlen needs self-attention segments'
+    bounds = segment_bounds(cu_seqlens_q)
+
+    q_flat, k_flat, v_flat = _flatten(q), _flatten(k), _flatten(v)
+    out = torch.empty_like(q_flat)
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end > start:
+            out[start:end] = _sdpa_dense(q_flat[None, start:end], k_flat[None, start:end], v_flat[None, start:end])[0]
+
+    return out.view(q.shape)
+
+
+if sageattn is not None:
+    register_attention_backend('sage', dense=lambda q, k, v: sageattn(q, k, v, tensor_layout='NHD'), varlen=_sage_varlen if sageattn_varlen is not None else None)
+
+if flash_attn_func is not None:
+    register_attention_backend('flash', dense=flash_attn_func, varlen=_flash_varlen if flash_attn_varlen_func is not None else None)
+
+if xformers_attn_func is not None:
+    register_attention_backend('xformers', dense=xformers_attn_func)
+
+register_attention_backend('sdpa', dense=_sdpa_dense, varlen=_sdpa_varlen)
+
+
+def _default_backend(varlen):
+    for name in DEFAULT_BACKEND_ORDER:
+        backend = ATTENTION_BACKENDS.get(name, None)
+        if backend is not None and backend.supports(varlen):
+            return backend
+    raise NotImplementedError('No Attn Installed!')
+
+
+def _call(backend, varlen, q, k, v, varlen_args):
+    if varlen:
+        return backend.varlen(q, k, v, *varlen_args)
+    return backend.dense(q, k, v)
+
+
+def benchmark_attention_backends(q, k, v, varlen_args=None, repeats=3, rtol=0.05):
+    """
+    Time every backend that supports these inputs and return the name of the
+    fastest one whose output is within `rtol` (relative mean error) of SDPA.
+    """
+    varlen = varlen_args is not None
+    # The reference call is SDPA's warm-up too; it costs one attention call, no mask is built
+    reference = _call(ATTENTION_BACKENDS['sdpa'], varlen, q, k, v, varlen_args).float()
+    reference_scale = reference.abs().mean().clamp_min(1e-6)
+
+    timings = {}
+
+    for name, backend in ATTENTION_BACKENDS.items():
+        if not backend.supports(varlen):
+            continue
+
+        try:
+            if name != 'sdpa':
+                out = _call(backend, varlen, q, k, v, varlen_args)  # Warm-up and correctness check
+                error = ((out.float() - reference).abs().mean() / reference_scale).item()
+                if error > rtol:
+                    print(f'Attention backend {name} rejected: relative error {error:.4f}')
+                    continue
+
+            if q.is_cuda:
+                torch.cuda.synchronize(q.device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                _call(backend, varlen, q, k, v, varlen_args)
+            if q.is_cuda:
+                torch.cuda.synchronize(q.device)
+            timings[name] = (time.perf_counter() - start) / repeats
+        except Exception as e:
+            print(f'Attention backend {name} failed: {e}')
+
+    if len(timings) == 0:
+        best = _default_backend(varlen).name
+        print(f'Attention benchmark {tuple(q.shape)} varlen={varlen}: every backend failed, using {best}')
+        return best
+
+    best = min(timings, key=timings.get)
+    print(f'Attention benchmark {tuple(q.shape)} varlen={varlen}: ' + ', '.join(f'{n}={t * 1000:.2f}ms' for n, t in timings.items()) + f' -> {best}')
+    return best
+
+
+def get_attention_backend(q, varlen, benchmark_inputs=None):
+    if selected_backend in (None, 'default'):
+        return _default_backend(varlen)
+
+    if selected_backend == 'auto':
+        key = (tuple(q.shape), q.dtype, str(q.device), varlen)
+        if key not in benchmarked_backends:
+            benchmarked_backends[key] = benchmark_attention_backends(*benchmark_inputs)
+        return ATTENTION_BACKENDS[benchmarked_backends[key]]
+
+    backend = ATTENTION_BACKENDS.get(selected_backend, None)
+    if backend is None or not backend.supports(varlen):
+        return _default_backend(varlen)
+    return backend
+
+
+def attention(q, k, v, cu_seqlens_q=None, cu_seqlens_kv=None, max_seqlen_q=None, max_seqlen_kv=None):
+    """Attention over (batch, seq_len, heads, head_dim) inputs with the selected backend."""
+    if cu_seqlens_q is None and cu_seqlens_kv is None and max_seqlen_q is None and max_seqlen_kv is None:
+        backend = get_attention_backend(q, varlen=False, benchmark_inputs=(q, k, v))
+        return backend.dense(q, k, v)
+
+    varlen_args = (cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
+    backend = get_attention_backend(q, varlen=True, benchmark_inputs=(q, k, v, varlen_args))
+    return backend.varlen(q, k, v, *varlen_args)
@@ -1,6 +1,8 @@
 from typing import Any, Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
 
 import torch
+import weakref
 import einops
 import torch.nn as nn
 import numpy as np
@@ -16,46 +18,7 @@ from diffusers.models.modeling_outputs import Transformer2DModelOutput
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers_helper.dit_common import LayerNorm
 from diffusers_helper.utils import zero_module
-
-
-enabled_backends = []
-
-if torch.backends.cuda.flash_sdp_enabled():
-    enabled_backends.append("flash")
-if torch.backends.cuda.math_sdp_enabled():
-    enabled_backends.append("math")
-if torch.backends.cuda.mem_efficient_sdp_enabled():
-    enabled_backends.append("mem_efficient")
-if torch.backends.cuda.cudnn_sdp_enabled():
-    enabled_backends.append("cudnn")
-
-print("Currently enabled native sdp backends:", enabled_backends)
-
-try:
-    # raise NotImplementedError
-    from xformers.ops import memory_efficient_attention as xformers_attn_func
-    print('Xformers is installed!')
-except:
-    print('Xformers is not installed!')
-    xformers_attn_func = None
-
-try:
-    # raise NotImplementedError
-    from flash_attn import flash_attn_varlen_func, flash_attn_func
-    print('Flash Attn is installed!')
-except:
-    print('Flash Attn is not installed!')
-    flash_attn_varlen_func = None
-    flash_attn_func = None
-
-try:
-    # raise NotImplementedError
-    from sageattention import sageattn_varlen, sageattn
-    print('Sage Attn is installed!')
-except:
-    print('Sage Attn is not installed!')
-    sageattn_varlen = None
-    sageattn = None
+from diffusers_helper.models.attention_backends import attention
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -80,22 +43,72 @@ def center_down_sample_3d(x, kernel_size):
 
 
 def get_cu_seqlens(text_mask, img_len):
+    # Per sample i: [i * max_len + img_len + text_len_i, (i + 1) * max_len], built on the mask's device without host syncs
     batch_size = text_mask.shape[0]
-    text_len = text_mask.sum(dim=1)
+    text_len = text_mask.sum(dim=1).to(torch.int32)
     max_len = text_mask.shape[1] + img_len
 
-    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device="cuda")
+    sample_starts = torch.arange(batch_size, dtype=torch.int32, device=text_mask.device) * max_len
 
-    for i in range(batch_size):
-        s = text_len[i] + img_len
-        s1 = i * max_len + s
-        s2 = (i + 1) * max_len
-        cu_seqlens[2 * i + 1] = s1
-        cu_seqlens[2 * i + 2] = s2
+    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device=text_mask.device)
+    cu_seqlens[1::2] = sample_starts + img_len + text_len
+    cu_seqlens[2::2] = sample_starts + max_len
 
     return cu_seqlens
 
 
+def tensor_version(x):
+    # Inference tensors (created under torch.inference_mode) have no version counter
+    return -1 if x.is_inference() else x._version
+
+
+def indices_cache_key(indices):
+    if indices is None:
+        return None
+
+    if indices.device.type == 'cpu':
+        return tuple(indices.shape), tuple(indices.flatten().tolist())
+
+    # Reading device tensors would sync with the GPU, so they are keyed by identity;
+    # cache entries keep them alive so an id cannot be reused while it is cached
+    return tuple(indices.shape), str(indices.device), id(indices), tensor_version(indices)
+
+
+class SectionInputCache:
+    """
+    Memoizes results computed from conditioning tensors that are passed unchanged
+    to every step of a section (clean latents, image and text embeddings).
+
+    Entries are keyed by the identity and version of the input tensors and hold
+    weak references to them, so a new section's tensors never hit a previous
+    section's entries. Bypassed while grad is enabled.
+    """
+
+    def __init__(self, max_entries=16):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def get_or_compute(self, name, inputs, compute):
+        if torch.is_grad_enabled():
+            return compute()
+
+        inputs = [x for x in inputs if x is not None]
+        key = (name,) + tuple((id(x), tensor_version(x)) for x in inputs)
+        entry = self.entries.get(key, None)
+
+        if entry is not None and all(ref() is x for ref, x in zip(entry[0], inputs)):
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        result = compute()
+        self.entries[key] = ([weakref.ref(x) for x in inputs], result)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return result
+
+
 def apply_rotary_emb_transposed(x, freqs_cis):
     cos, sin = freqs_cis.unsqueeze(-2).chunk(2, dim=-1)
     x_real, x_imag = x.unflatten(-1, (-1, 2)).unbind(-1)
@@ -106,34 +119,7 @@ def apply_rotary_emb_transposed(x, freqs_cis):
 
 
 def attn_varlen_func(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv):
-    if cu_seqlens_q is None and cu_seqlens_kv is None and max_seqlen_q is None and max_seqlen_kv is None:
-        if sageattn is not None:
-            x = sageattn(q, k, v, tensor_layout='NHD')
-            return x
-
-        if flash_attn_func is not None:
-            x = flash_attn_func(q, k, v)
-            return x
-
-        if xformers_attn_func is not None:
-            x = xformers_attn_func(q, k, v)
-            return x
-
-        x = torch.nn.functional.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)).transpose(1, 2)
-        return x
-
-    batch_size = q.shape[0]
-    q = q.view(q.shape[0] * q.shape[1], *q.shape[2:])
-    k = k.view(k.shape[0] * k.shape[1], *k.shape[2:])
-    v = v.view(v.shape[0] * v.shape[1], *v.shape[2:])
-    if sageattn_varlen is not None:
-        x = sageattn_varlen(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
-    elif flash_attn_varlen_func is not None:
-        x = flash_attn_varlen_func(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
-    else:
-        raise NotImplementedError('No Attn Installed!')
-    x = x.view(batch_size, max_seqlen_q, *x.shape[2:])
-    return x
+    return attention(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
 
 
 class HunyuanAttnProcessorFlashAttnDouble:
@@ -244,13 +230,14 @@ class CombinedTimestepTextProjEmbeddings(nn.Module):
         self.timestep_embedder = TimestepEmbedding(in_channels=256, time_embed_dim=embedding_dim)
         self.text_embedder = PixArtAlphaTextProjection(pooled_projection_dim, embedding_dim, act_fn="silu")
 
-    def forward(self, timestep, pooled_projection):
+    def forward(self, timestep, pooled_projection, projected_pooled_projection=None):
         timesteps_proj = self.time_proj(timestep)
         timesteps_emb = self.timestep_embedder(timesteps_proj.to(dtype=pooled_projection.dtype))
 
-        pooled_projections = self.text_embedder(pooled_projection)
+        if projected_pooled_projection is None:
+            projected_pooled_projection = self.text_embedder(pooled_projection)
 
-        conditioning = timesteps_emb + pooled_projections
+        conditioning = timesteps_emb + projected_pooled_projection
 
         return conditioning
 
@@ -397,12 +384,12 @@ class HunyuanVideoTokenRefiner(nn.Module):
             attention_bias=attention_bias,
         )
 
-    def forward(
+    def embed_text(
         self,
         hidden_states: torch.Tensor,
-        timestep: torch.LongTensor,
         attention_mask: Optional[torch.LongTensor] = None,
-    ) -> torch.Tensor:
+    ):
+        """The timestep-independent part of forward: pooled text, its projection and proj_in."""
         if attention_mask is None:
             pooled_projections = hidden_states.mean(dim=1)
         else:
@@ -411,8 +398,24 @@ class HunyuanVideoTokenRefiner(nn.Module):
             pooled_projections = (hidden_states * mask_float).sum(dim=1) / mask_float.sum(dim=1)
             pooled_projections = pooled_projections.to(original_dtype)
 
-        temb = self.time_text_embed(timestep, pooled_projections)
+        projected_pooled_projections = self.time_text_embed.text_embedder(pooled_projections)
         hidden_states = self.proj_in(hidden_states)
+
+        return pooled_projections, projected_pooled_projections, hidden_states
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        timestep: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        text_embeddings=None,
+    ) -> torch.Tensor:
+        if text_embeddings is None:
+            text_embeddings = self.embed_text(hidden_states, attention_mask)
+
+        pooled_projections, projected_pooled_projections, hidden_states = text_embeddings
+
+        temb = self.time_text_embed(timestep, pooled_projections, projected_pooled_projections)
         hidden_states = self.token_refiner(hidden_states, temb, attention_mask)
 
         return hidden_states
@@ -720,6 +723,209 @@ class HunyuanVideoPatchEmbedForCleanLatents(nn.Module):
         return
 
 
+# Polynomial rescaling function to adjust sensitivity
+# Can be tuned for different detail preservation needs
+TEACACHE_RESCALE_COEFFICIENTS = [7.33226126e+02, -4.01131952e+02, 6.75869174e+01, -3.14987800e+00, 9.61237896e-02]
+
+
+def lagged_rel_l1(rel_l1, pending):
+    """
+    Start copying TeaCache distances to the host without blocking.
+
+    Returns the distances started with the previous call as a numpy array (None
+    if there is none) and the new pending (host buffer, event) pair to pass to
+    the next call.
+    """
+    if rel_l1.device.type == 'cuda':
+        host = torch.empty(rel_l1.shape, dtype=torch.float32, pin_memory=True)
+        host.copy_(rel_l1.float(), non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+    else:
+        host, event = rel_l1.float(), None
+
+    if pending is None:
+        return None, (host, event)
+
+    previous_host, previous_event = pending
+    if previous_event is not None:
+        # Recorded a whole step ago, so normally complete already
+        previous_event.synchronize()
+    return previous_host.numpy(), (host, event)
+
+
+def relative_l1(current, previous):
+    # Per sample
+    return (current - previous).abs().mean(dim=(1, 2)) / previous.abs().mean(dim=(1, 2))
+
+
+def teacache_modulated_input(block, hidden_states, temb):
+    if isinstance(block, HunyuanVideoSingleTransformerBlock):
+        return block.norm(hidden_states, emb=temb)[0]
+    return block.norm1(hidden_states, emb=temb)[0]
+
+
+def batch_subset(x, indices, batch_size):
+    # Per-sample tensors are indexed, tensors shared by the whole batch are kept
+    if isinstance(x, torch.Tensor) and batch_size > 1 and x.ndim > 0 and x.shape[0] == batch_size:
+        return x[indices]
+    return x
+
+
+def subset_attention_mask(attention_mask, encoder_attention_mask, indices):
+    cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv = attention_mask
+
+    if cu_seqlens_q is None:
+        return attention_mask
+
+    cu_seqlens = get_cu_seqlens(encoder_attention_mask[indices], max_seqlen_q - encoder_attention_mask.shape[1])
+    return cu_seqlens, cu_seqlens, max_seqlen_q, max_seqlen_kv
+
+
+class TeaCacheBlockGroup:
+    """Cached state of one group of consecutive transformer blocks."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.cacheable = True
+        self.computed = 0  # Counted per sample
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        self.accumulated_rel_l1_distance = None  # Per sample
+        self.previous_modulated_input = None
+        self.previous_residual = None
+        self.previous_encoder_residual = None
+        self.pending_rel_l1 = None
+
+
+class TeaCacheState:
+    """Step counter and block group caches of one branch of a TeaCacheContext."""
+
+    def __init__(self, context, cnt=0):
+        self.context = context
+        self.cnt = cnt
+        self.groups = None
+        self.traces = {}  # Group index -> per-step lists of per-sample input and output distances
+
+    def record(self, group_index, input_rel_l1, output_rel_l1):
+        trace = self.traces.setdefault(group_index, dict(input_rel_l1=[], output_rel_l1=[]))
+        trace['input_rel_l1'].append(input_rel_l1.float().cpu().tolist())
+        trace['output_rel_l1'].append(output_rel_l1.float().cpu().tolist())
+
+    def stats(self):
+        computed = sum(group.computed for group in self.groups or [])
+        skipped = sum(group.skipped for group in self.groups or [])
+        return dict(computed=computed, skipped=skipped)
+
+
+class TeaCacheContext:
+    """
+    TeaCache settings of one sampling run, with a separate TeaCacheState per branch.
+
+    A branch is one of the transformer calls made at every step, e.g. 'positive'
+    and 'negative' for CFG, so every branch compares against its own previous step.
+    Within a branch, skip decisions are made per sample of the batch. Nothing is
+    stored on the transformer, so any number of requests can share one model.
+
+    Args:
+        num_steps (int): Model calls per branch in one run, which is the number of
+            diffusion steps for most samplers (see `sampler_nfe`); the first and last
+            always compute
+        rel_l1_thresh (float): Relative L1 threshold for TeaCache; a group is
+            recomputed once its accumulated drift reaches it
+            - Lower values (0.1) skip fewer steps: less speedup, closer to full quality
+            - Medium values (0.15) balance speed (≈2.1x) and quality
+            - Higher values (0.25+) skip more steps and lose fine detail such as hands first
+        sync_free (bool): Decide whether to skip a step from the previous step's
+            distance, copied to the host asynchronously, instead of reading the
+            current one with a blocking .item(). The CPU can then queue work
+            ahead of the GPU, at the cost of reacting one step later.
+        mode (str): 'model' skips the whole block stack at once; 'blocks' decides per
+            group of `block_group_size` consecutive blocks from that group's own drift
+        block_group_size (int): Blocks per group in 'blocks' mode
+        residual_budget_gb (float): Memory for cached group residuals of all branches
+            together in 'blocks' mode; groups that do not fit are always computed.
+            None: unbounded
+        rescale_coefficients (list): Coefficients of the rescale polynomial, highest
+            power first. None: TEACACHE_RESCALE_COEFFICIENTS
+        record_traces (bool): Compute every step and record, per group and sample, the
+            modulated input distance and the distance of the group's residual to the
+            previous step, for `diffusers_helper.teacache_calibration`
+    """
+
+    def __init__(self, num_steps=25, rel_l1_thresh=0.15, sync_free=False, mode='model', block_group_size=4, residual_budget_gb=None, rescale_coefficients=None, record_traces=False):
+        assert mode in ('model', 'blocks'), f'Unknown TeaCache mode {mode}'
+
+        self.num_steps = num_steps
+        self.rel_l1_thresh = rel_l1_thresh
+        self.sync_free = sync_free
+        self.mode = mode
+        self.block_group_size = block_group_size
+        self.residual_budget_gb = residual_budget_gb
+        self.rescale_func = np.poly1d(TEACACHE_RESCALE_COEFFICIENTS if rescale_coefficients is None else rescale_coefficients)
+        self.record_traces = record_traces
+
+        self.branches = {}
+        self.reserved_bytes = {}  # Branch state -> bytes of residuals it may cache
+
+    def branch(self, name, start_step=0):
+        """Return the state of branch `name`, created at step `start_step` on first use."""
+        if name not in self.branches:
+            self.branches[name] = TeaCacheState(self, cnt=start_step)
+        return self.branches[name]
+
+    def discard_branch(self, name):
+        """
+        Drop branch `name`, freeing its cached residuals and giving its share of the
+        residual budget back to the other branches. Returns its state, or None.
+        """
+        state = self.branches.pop(name, None)
+        if state is None:
+            return None
+
+        self.reserved_bytes.pop(state, None)
+        for group in state.groups or []:
+            group.reset()
+        return state
+
+    def reserve_residuals(self, state, group_bytes, num_groups):
+        """
+        Number of groups of `state` whose residuals fit in what the other branches
+        leave of the budget; the first branch to start takes what it needs.
+        """
+        if self.mode != 'blocks' or self.residual_budget_gb is None:
+            return num_groups
+
+        others = sum(nbytes for other, nbytes in self.reserved_bytes.items() if other is not state)
+        available = max(int(self.residual_budget_gb * 1024 ** 3) - others, 0)
+        num_cacheable = min(num_groups, available // group_bytes)
+
+        self.reserved_bytes[state] = num_cacheable * group_bytes
+        return num_cacheable
+
+    def stats(self):
+        return {name: state.stats() for name, state in self.branches.items()}
+
+    def traces(self):
+        """Recorded traces as one dict per branch, group and sample."""
+        records = []
+        for name, state in self.branches.items():
+            for group_index, trace in state.traces.items():
+                for sample in range(len(trace['input_rel_l1'][0])):
+                    records.append(dict(
+                        mode=self.mode,
+                        num_steps=self.num_steps,
+                        branch=name,
+                        group=group_index,
+                        input_rel_l1=[step[sample] for step in trace['input_rel_l1']],
+                        output_rel_l1=[step[sample] for step in trace['output_rel_l1']],
+                    ))
+        return records
+
+
 class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterMixin, FromOriginalModelMixin):
     @register_to_config
     def __init__(
@@ -789,6 +995,7 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
         self.inner_dim = inner_dim
         self.use_gradient_checkpointing = False
         self.enable_teacache = False
+        self.teacache_context = None
 
         if has_image_proj:
             self.install_image_projection(image_proj_dim)
@@ -798,6 +1005,10 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
 
         self.high_quality_fp32_output_for_inference = False
 
+        self.rope_cache = OrderedDict()
+        self.rope_cache_size = 8
+        self.section_cache = SectionInputCache()
+
     def install_image_projection(self, in_channels):
         self.image_projection = ClipVisionProjection(in_channels=in_channels, out_channels=self.inner_dim)
         self.config['has_image_proj'] = True
@@ -815,29 +1026,152 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
         self.use_gradient_checkpointing = False
         print('self.use_gradient_checkpointing = False')
 
-    def initialize_teacache(self, enable_teacache=True, num_steps=25, rel_l1_thresh=0.15):
+    def initialize_teacache(self, enable_teacache=True, num_steps=25, rel_l1_thresh=0.15, sync_free=False, mode='model', block_group_size=4, residual_budget_gb=None):
         """
         Initialize TeaCache for optimized inference.
-        
-        Args:
-            enable_teacache (bool): Whether to enable TeaCache optimization
-            num_steps (int): Number of diffusion steps
-            rel_l1_thresh (float): Relative L1 threshold for TeaCache
-                - Lower values (0.1) provide more speedup (≈1.6x) but may reduce quality
-                - Medium values (0.15) balance speed (≈2.1x) and quality
-                - Higher values (0.25+) prioritize quality especially for detailed regions like hands
+
+        Sets the TeaCacheContext used by calls that do not pass their own `teacache`
+        state; see TeaCacheContext for the arguments. Samplers take the context's
+        'positive' and 'negative' branches, other callers share its 'default' branch.
+
+        Returns:
+            The TeaCacheContext, or None if TeaCache is disabled
         """
         self.enable_teacache = enable_teacache
-        self.cnt = 0
-        self.num_steps = num_steps
-        self.rel_l1_thresh = rel_l1_thresh
-        self.accumulated_rel_l1_distance = 0
-        self.previous_modulated_input = None
-        self.previous_residual = None
-        
-        # Polynomial rescaling function to adjust sensitivity
-        # Can be tuned for different detail preservation needs
-        self.teacache_rescale_func = np.poly1d([7.33226126e+02, -4.01131952e+02, 6.75869174e+01, -3.14987800e+00, 9.61237896e-02])
+        self.teacache_context = TeaCacheContext(
+            num_steps=num_steps, rel_l1_thresh=rel_l1_thresh, sync_free=sync_free,
+            mode=mode, block_group_size=block_group_size, residual_budget_gb=residual_budget_gb,
+        ) if enable_teacache else None
+        return self.teacache_context
+
+    def teacache_forward(self, state, hidden_states, encoder_hidden_states, temb, attention_mask, encoder_attention_mask, rope_freqs):
+        """
+        Run the double and single blocks with TeaCache.
+
+        Every group of consecutive blocks (one group of all blocks in 'model' mode)
+        accumulates the rescaled drift of its own modulated input per sample. Samples
+        past `rel_l1_thresh` are recomputed, as a sub-batch if the others can reuse
+        their last residual. Skipped groups add their residual, so later groups still
+        see the changes of the groups before them. Only as many groups as fit in the
+        residual budget are cached (the first ones); the rest always run.
+        """
+        context = state.context
+        blocks = list(self.transformer_blocks) + list(self.single_transformer_blocks)
+        batch_size = hidden_states.shape[0]
+
+        if state.groups is None:
+            group_size = len(blocks) if context.mode == 'model' else context.block_group_size
+            state.groups = [
+                TeaCacheBlockGroup(start, min(start + group_size, len(blocks)))
+                for start in range(0, len(blocks), group_size)
+            ]
+
+        force_calc = state.cnt == 0 or state.cnt == context.num_steps - 1
+
+        if state.cnt == 0:
+            # Residuals of both streams plus the previous modulated input
+            group_bytes = 2 * hidden_states.nelement() * hidden_states.element_size() + encoder_hidden_states.nelement() * encoder_hidden_states.element_size()
+            num_cacheable = context.reserve_residuals(state, group_bytes, len(state.groups))
+
+            for i, group in enumerate(state.groups):
+                if i >= num_cacheable:
+                    group.reset()
+                group.cacheable = i < num_cacheable
+
+        def run_blocks(group, hidden_states, encoder_hidden_states, temb, attention_mask, rope_freqs):
+            for block in blocks[group.start:group.end]:
+                hidden_states, encoder_hidden_states = self.gradient_checkpointing_method(
+                    block,
+                    hidden_states,
+                    encoder_hidden_states,
+                    temb,
+                    attention_mask,
+                    rope_freqs
+                )
+            return hidden_states, encoder_hidden_states
+
+        for group_index, group in enumerate(state.groups):
+            should_calc = None  # Per-sample bool array; None computes every sample
+            trace_rel_l1 = None
+
+            if group.cacheable:
+                modulated_inp = teacache_modulated_input(blocks[group.start], hidden_states, temb)
+                previous = group.previous_modulated_input
+
+                if context.record_traces and previous is not None and previous.shape == modulated_inp.shape:
+                    trace_rel_l1 = relative_l1(modulated_inp, previous)
+
+                if force_calc or context.record_traces or previous is None or previous.shape != modulated_inp.shape:
+                    group.accumulated_rel_l1_distance = np.zeros(batch_size)
+                    group.pending_rel_l1 = None
+                else:
+                    curr_rel_l1 = relative_l1(modulated_inp, previous)
+
+                    if context.sync_free:
+                        curr_rel_l1, group.pending_rel_l1 = lagged_rel_l1(curr_rel_l1, group.pending_rel_l1)
+                    else:
+                        curr_rel_l1 = curr_rel_l1.float().cpu().numpy()
+
+                    if curr_rel_l1 is None:
+                        group.accumulated_rel_l1_distance[:] = 0
+                    else:
+                        group.accumulated_rel_l1_distance += context.rescale_func(curr_rel_l1)
+                        should_calc = group.accumulated_rel_l1_distance >= context.rel_l1_thresh
+                        group.accumulated_rel_l1_distance[should_calc] = 0
+
+                group.previous_modulated_input = modulated_inp
+
+            if should_calc is None or should_calc.all():
+                ori_hidden_states, ori_encoder_hidden_states = hidden_states, encoder_hidden_states
+
+                hidden_states, encoder_hidden_states = run_blocks(group, hidden_states, encoder_hidden_states, temb, attention_mask, rope_freqs)
+
+                if group.cacheable:
+                    residual = hidden_states - ori_hidden_states
+
+                    if trace_rel_l1 is not None and group.previous_residual is not None and group.previous_residual.shape == residual.shape:
+                        state.record(group_index, trace_rel_l1, relative_l1(residual, group.previous_residual))
+
+                    group.previous_residual = residual
+                    group.previous_encoder_residual = encoder_hidden_states - ori_encoder_hidden_states
+
+                group.computed += batch_size
+                continue
+
+            reused_hidden_states = hidden_states + group.previous_residual
+            reused_encoder_hidden_states = encoder_hidden_states + group.previous_encoder_residual
+
+            if not should_calc.any():
+                hidden_states, encoder_hidden_states = reused_hidden_states, reused_encoder_hidden_states
+                group.skipped += batch_size
+                continue
+
+            # Only the samples that drifted are recomputed, the others reuse their residuals
+            indices = torch.from_numpy(np.flatnonzero(should_calc)).to(hidden_states.device)
+
+            sub_hidden_states, sub_encoder_hidden_states = hidden_states[indices], encoder_hidden_states[indices]
+            new_hidden_states, new_encoder_hidden_states = run_blocks(
+                group, sub_hidden_states, sub_encoder_hidden_states,
+                batch_subset(temb, indices, batch_size),
+                subset_attention_mask(attention_mask, encoder_attention_mask, indices),
+                batch_subset(rope_freqs, indices, batch_size),
+            )
+
+            group.previous_residual = group.previous_residual.index_copy(0, indices, new_hidden_states - sub_hidden_states)
+            group.previous_encoder_residual = group.previous_encoder_residual.index_copy(0, indices, new_encoder_hidden_states - sub_encoder_hidden_states)
+
+            hidden_states = reused_hidden_states.index_copy(0, indices, new_hidden_states)
+            encoder_hidden_states = reused_encoder_hidden_states.index_copy(0, indices, new_encoder_hidden_states)
+
+            group.computed += len(indices)
+            group.skipped += batch_size - len(indices)
+
+        state.cnt += 1
+
+        if state.cnt == context.num_steps:
+            state.cnt = 0
+
+        return hidden_states, encoder_hidden_states
 
     def gradient_checkpointing_method(self, block, *args):
         if self.use_gradient_checkpointing:
@@ -846,6 +1180,50 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
             result = block(*args)
         return result
 
+    @torch.no_grad()
+    def get_rope_freqs(self, height, width, device, latent_indices, clean_latent_indices=None, clean_latent_2x_indices=None, clean_latent_4x_indices=None):
+        """
+        RoPE frequencies of the packed sequence [4x clean, 2x clean, clean, noisy].
+
+        They only depend on the indices and the latent size, which are the same for
+        every step and CFG branch of a section, so the result is cached.
+        """
+        all_indices = [latent_indices, clean_latent_indices, clean_latent_2x_indices, clean_latent_4x_indices]
+        key = (height, width, str(device)) + tuple(indices_cache_key(indices) for indices in all_indices)
+
+        if key in self.rope_cache:
+            self.rope_cache.move_to_end(key)
+            return self.rope_cache[key][0]
+
+        rope_freqs = self.rope(frame_indices=latent_indices, height=height, width=width, device=device)
+        rope_freqs = rope_freqs.flatten(2).transpose(1, 2)
+
+        if clean_latent_indices is not None:
+            clean_latent_rope_freqs = self.rope(frame_indices=clean_latent_indices, height=height, width=width, device=device)
+            clean_latent_rope_freqs = clean_latent_rope_freqs.flatten(2).transpose(1, 2)
+            rope_freqs = torch.cat([clean_latent_rope_freqs, rope_freqs], dim=1)
+
+        if clean_latent_2x_indices is not None:
+            clean_latent_2x_rope_freqs = self.rope(frame_indices=clean_latent_2x_indices, height=height, width=width, device=device)
+            clean_latent_2x_rope_freqs = pad_for_3d_conv(clean_latent_2x_rope_freqs, (2, 2, 2))
+            clean_latent_2x_rope_freqs = center_down_sample_3d(clean_latent_2x_rope_freqs, (2, 2, 2))
+            clean_latent_2x_rope_freqs = clean_latent_2x_rope_freqs.flatten(2).transpose(1, 2)
+            rope_freqs = torch.cat([clean_latent_2x_rope_freqs, rope_freqs], dim=1)
+
+        if clean_latent_4x_indices is not None:
+            clean_latent_4x_rope_freqs = self.rope(frame_indices=clean_latent_4x_indices, height=height, width=width, device=device)
+            clean_latent_4x_rope_freqs = pad_for_3d_conv(clean_latent_4x_rope_freqs, (4, 4, 4))
+            clean_latent_4x_rope_freqs = center_down_sample_3d(clean_latent_4x_rope_freqs, (4, 4, 4))
+            clean_latent_4x_rope_freqs = clean_latent_4x_rope_freqs.flatten(2).transpose(1, 2)
+            rope_freqs = torch.cat([clean_latent_4x_rope_freqs, rope_freqs], dim=1)
+
+        self.rope_cache[key] = (rope_freqs, all_indices)
+
+        while len(self.rope_cache) > self.rope_cache_size:
+            self.rope_cache.popitem(last=False)
+
+        return rope_freqs
+
     def process_input_hidden_states(
             self,
             latents, latent_indices=None,
@@ -861,47 +1239,47 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
 
         hidden_states = hidden_states.flatten(2).transpose(1, 2)
 
-        rope_freqs = self.rope(frame_indices=latent_indices, height=H, width=W, device=hidden_states.device)
-        rope_freqs = rope_freqs.flatten(2).transpose(1, 2)
+        # Clean latents are the same at every step of a section, so their tokens are embedded once
+        def embed_clean_latents(x, proj, padding):
+            x = x.to(hidden_states)
+            if padding is not None:
+                x = pad_for_3d_conv(x, padding)
+            x = self.gradient_checkpointing_method(proj, x)
+            return x.flatten(2).transpose(1, 2)
 
-        if clean_latents is not None and clean_latent_indices is not None:
-            clean_latents = clean_latents.to(hidden_states)
-            clean_latents = self.gradient_checkpointing_method(self.clean_x_embedder.proj, clean_latents)
-            clean_latents = clean_latents.flatten(2).transpose(1, 2)
+        dtype_key = f'{hidden_states.dtype}:{hidden_states.device}'
 
-            clean_latent_rope_freqs = self.rope(frame_indices=clean_latent_indices, height=H, width=W, device=clean_latents.device)
-            clean_latent_rope_freqs = clean_latent_rope_freqs.flatten(2).transpose(1, 2)
+        if clean_latents is not None and clean_latent_indices is not None:
+            clean_latents = self.section_cache.get_or_compute(
+                f'clean_latents:{dtype_key}', [clean_latents],
+                lambda: embed_clean_latents(clean_latents, self.clean_x_embedder.proj, None)
+            )
 
             hidden_states = torch.cat([clean_latents, hidden_states], dim=1)
-            rope_freqs = torch.cat([clean_latent_rope_freqs, rope_freqs], dim=1)
+        else:
+            clean_latent_indices = None
 
         if clean_latents_2x is not None and clean_latent_2x_indices is not None:
-            clean_latents_2x = clean_latents_2x.to(hidden_states)
-            clean_latents_2x = pad_for_3d_conv(clean_latents_2x, (2, 4, 4))
-            clean_latents_2x = self.gradient_checkpointing_method(self.clean_x_embedder.proj_2x, clean_latents_2x)
-            clean_latents_2x = clean_latents_2x.flatten(2).transpose(1, 2)
-
-            clean_latent_2x_rope_freqs = self.rope(frame_indices=clean_latent_2x_indices, height=H, width=W, device=clean_latents_2x.device)
-            clean_latent_2x_rope_freqs = pad_for_3d_conv(clean_latent_2x_rope_freqs, (2, 2, 2))
-            clean_latent_2x_rope_freqs = center_down_sample_3d(clean_latent_2x_rope_freqs, (2, 2, 2))
-            clean_latent_2x_rope_freqs = clean_latent_2x_rope_freqs.flatten(2).transpose(1, 2)
+            clean_latents_2x = self.section_cache.get_or_compute(
+                f'clean_latents_2x:{dtype_key}', [clean_latents_2x],
+                lambda: embed_clean_latents(clean_latents_2x, self.clean_x_embedder.proj_2x, (2, 4, 4))
+            )
 
             hidden_states = torch.cat([clean_latents_2x, hidden_states], dim=1)
-            rope_freqs = torch.cat([clean_latent_2x_rope_freqs, rope_freqs], dim=1)
+        else:
+            clean_latent_2x_indices = None
 
         if clean_latents_4x is not None and clean_latent_4x_indices is not None:
-            clean_latents_4x = clean_latents_4x.to(hidden_states)
-            clean_latents_4x = pad_for_3d_conv(clean_latents_4x, (4, 8, 8))
-            clean_latents_4x = self.gradient_checkpointing_method(self.clean_x_embedder.proj_4x, clean_latents_4x)
-            clean_latents_4x = clean_latents_4x.flatten(2).transpose(1, 2)
-
-            clean_latent_4x_rope_freqs = self.rope(frame_indices=clean_latent_4x_indices, height=H, width=W, device=clean_latents_4x.device)
-            clean_latent_4x_rope_freqs = pad_for_3d_conv(clean_latent_4x_rope_freqs, (4, 4, 4))
-            clean_latent_4x_rope_freqs = center_down_sample_3d(clean_latent_4x_rope_freqs, (4, 4, 4))
-            clean_latent_4x_rope_freqs = clean_latent_4x_rope_freqs.flatten(2).transpose(1, 2)
+            clean_latents_4x = self.section_cache.get_or_compute(
+                f'clean_latents_4x:{dtype_key}', [clean_latents_4x],
+                lambda: embed_clean_latents(clean_latents_4x, self.clean_x_embedder.proj_4x, (4, 8, 8))
+            )
 
             hidden_states = torch.cat([clean_latents_4x, hidden_states], dim=1)
-            rope_freqs = torch.cat([clean_latent_4x_rope_freqs, rope_freqs], dim=1)
+        else:
+            clean_latent_4x_indices = None
+
+        rope_freqs = self.get_rope_freqs(H, W, hidden_states.device, latent_indices, clean_latent_indices, clean_latent_2x_indices, clean_latent_4x_indices)
 
         return hidden_states, rope_freqs
 
@@ -913,7 +1291,7 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
             clean_latents_2x=None, clean_latent_2x_indices=None,
             clean_latents_4x=None, clean_latent_4x_indices=None,
             image_embeddings=None,
-            attention_kwargs=None, return_dict=True
+            attention_kwargs=None, return_dict=True, teacache=None
     ):
 
         if attention_kwargs is None:
@@ -929,81 +1307,65 @@ class HunyuanVideoTransformer3DModelPacked(ModelMixin, ConfigMixin, PeftAdapterM
         hidden_states, rope_freqs = self.process_input_hidden_states(hidden_states, latent_indices, clean_latents, clean_latent_indices, clean_latents_2x, clean_latent_2x_indices, clean_latents_4x, clean_latent_4x_indices)
 
         temb = self.gradient_checkpointing_method(self.time_text_embed, timestep, guidance, pooled_projections)
-        encoder_hidden_states = self.gradient_checkpointing_method(self.context_embedder, encoder_hidden_states, timestep, encoder_attention_mask)
+
+        # Only the timestep embedding of the context embedder changes between steps
+        text_embeddings = self.section_cache.get_or_compute(
+            'context_embedder', [encoder_hidden_states, encoder_attention_mask],
+            lambda: self.context_embedder.embed_text(encoder_hidden_states, encoder_attention_mask)
+        ) if not torch.is_grad_enabled() else None
+        encoder_hidden_states = self.gradient_checkpointing_method(self.context_embedder, encoder_hidden_states, timestep, encoder_attention_mask, text_embeddings)
+
+        original_attention_mask = encoder_attention_mask
+        extra_len = 0
 
         if self.image_projection is not None:
             assert image_embeddings is not None, 'You must use image embeddings!'
-            extra_encoder_hidden_states = self.gradient_checkpointing_method(self.image_projection, image_embeddings)
-            extra_attention_mask = torch.ones((batch_size, extra_encoder_hidden_states.shape[1]), dtype=encoder_attention_mask.dtype, device=encoder_attention_mask.device)
+            extra_encoder_hidden_states = self.section_cache.get_or_compute(
+                'image_projection', [image_embeddings],
+                lambda: self.gradient_checkpointing_method(self.image_projection, image_embeddings)
+            )
+            extra_len = extra_encoder_hidden_states.shape[1]
+            extra_attention_mask = torch.ones((batch_size, extra_len), dtype=encoder_attention_mask.dtype, device=encoder_attention_mask.device)
 
             # must cat before (not after) encoder_hidden_states, due to attn masking
             encoder_hidden_states = torch.cat([extra_encoder_hidden_states, encoder_hidden_states], dim=1)
             encoder_attention_mask = torch.cat([extra_attention_mask, encoder_attention_mask], dim=1)
 
         with torch.no_grad():
-            if batch_size == 1:
+            # Reading the mask on the host syncs with the GPU, so it is only done once per section's mask
+            shared_text_mask, text_len = self.section_cache.get_or_compute(
+                f'text_mask:{extra_len}', [original_attention_mask],
+                lambda: (
+                    batch_size == 1 or bool((original_attention_mask == original_attention_mask[:1]).all()),
+                    extra_len + int(original_attention_mask[0].sum().item()),
+                )
+            )
+
+            if shared_text_mask:
                 # When batch size is 1, we do not need any masks or var-len funcs since cropping is mathematically same to what we want
                 # If they are not same, then their impls are wrong. Ours are always the correct one.
-                text_len = encoder_attention_mask.sum().item()
+                # The same holds when every sample shares one text mask, e.g. several seeds of the same prompt.
                 encoder_hidden_states = encoder_hidden_states[:, :text_len]
                 attention_mask = None, None, None, None
             else:
                 img_seq_len = hidden_states.shape[1]
                 txt_seq_len = encoder_hidden_states.shape[1]
 
-                cu_seqlens_q = get_cu_seqlens(encoder_attention_mask, img_seq_len)
+                cu_seqlens_q = self.section_cache.get_or_compute(
+                    f'cu_seqlens:{extra_len}:{img_seq_len}', [original_attention_mask],
+                    lambda: get_cu_seqlens(encoder_attention_mask, img_seq_len)
+                )
                 cu_seqlens_kv = cu_seqlens_q
                 max_seqlen_q = img_seq_len + txt_seq_len
                 max_seqlen_kv = max_seqlen_q
 
                 attention_mask = cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv
 
-        if self.enable_teacache:
-            modulated_inp = self.transformer_blocks[0].norm1(hidden_states, emb=temb)[0]
+        if teacache is None and self.enable_teacache:
+            teacache = self.teacache_context.branch('default')
 
-            if self.cnt == 0 or self.cnt == self.num_steps-1:
-                should_calc = True
-                self.accumulated_rel_l1_distance = 0
-            else:
-                curr_rel_l1 = ((modulated_inp - self.previous_modulated_input).abs().mean() / self.previous_modulated_input.abs().mean()).cpu().item()
-                self.accumulated_rel_l1_distance += self.teacache_rescale_func(curr_rel_l1)
-                should_calc = self.accumulated_rel_l1_distance >= self.rel_l1_thresh
-
-                if should_calc:
-                    self.accumulated_rel_l1_distance = 0
-
-            self.previous_modulated_input = modulated_inp
-            self.cnt += 1
-
-            if self.cnt == self.num_steps:
-                self.cnt = 0
-
-            if not should_calc:
-                hidden_states = hidden_states + self.previous_residual
-            else:
-                ori_hidden_states = hidden_states.clone()
-
-                for block_id, block in enumerate(self.transformer_blocks):
-                    hidden_states, encoder_hidden_states = self.gradient_checkpointing_method(
-                        block,
-                        hidden_states,
-                        encoder_hidden_states,
-                        temb,
-                        attention_mask,
-                        rope_freqs
-                    )
-
-                for block_id, block in enumerate(self.single_transformer_blocks):
-                    hidden_states, encoder_hidden_states = self.gradient_checkpointing_method(
-                        block,
-                        hidden_states,
-                        encoder_hidden_states,
-                        temb,
-                        attention_mask,
-                        rope_freqs
-                    )
-
-                self.previous_residual = hidden_states - ori_hidden_states
+        if teacache is not None:
+            hidden_states, encoder_hidden_states = self.teacache_forward(teacache, hidden_states, encoder_hidden_states, temb, attention_mask, encoder_attention_mask, rope_freqs)
         else:
             for block_id, block in enumerate(self.transformer_blocks):
                 hidden_states, encoder_hidden_states = self.gradient_checkpointing_method(
@@ -10,7 +10,13 @@ with less extreme flow shift timesteps. We observe that the resulting less aggre
 may lead to improved visual quality."
 """
 
+import os
+import json
 import math
+import torch
+
+from collections import OrderedDict
+from functools import lru_cache
 
 
 # Base flux time shift function
@@ -29,6 +35,15 @@ def flux_time_shift(t, mu=1.15, sigma=1.0):
     return math.exp(mu) / (math.exp(mu) + (1 / t - 1) ** sigma)
 
 
+def calculate_flux_mu(context_length, x1=256, y1=0.5, x2=4096, y2=1.15, exp_max=7.0):
+    """Linear interpolation of mu over the sequence length, clamped at log(exp_max)."""
+    k = (y2 - y1) / (x2 - x1)
+    b = y1 - k * x1
+    mu = k * context_length + b
+    mu = min(mu, math.log(exp_max))
+    return mu
+
+
 # Optimized calculation of mu based on content type
 def calculate_optimized_mu(context_length, content_type="balanced", detail_level="standard"):
     """
@@ -42,15 +57,10 @@ def calculate_optimized_mu(context_length, content_type="balanced", detail_level
     Returns:
         Optimized mu value
     """
-    # Base calculation from original implementation
-    x1, y1 = 256, 0.5
-    x2, y2 = 4096, 1.15
     exp_max = 7.0
-    
-    # Calculate base mu
-    k = (y2 - y1) / (x2 - x1)
-    b = y1 - k * x1
-    base_mu = k * context_length + b
+
+    # Base calculation from original implementation
+    base_mu = calculate_flux_mu(context_length, exp_max=exp_max)
     
     # Content type adjustments (based on paper findings)
     # More balanced schedulers = lower mu values
@@ -73,7 +83,7 @@ def calculate_optimized_mu(context_length, content_type="balanced", detail_level
     # Calculate final mu with adjustments
     final_mu = base_mu + content_type_adjustments.get(content_type, 0.0) + detail_level_adjustments.get(detail_level, 0.0)
     
-    # Ensure we don't exceed maximum
+    # Ensure the adjustments don't exceed the maximum either
     final_mu = min(final_mu, math.log(exp_max))
     
     # Ensure we don't go too low
@@ -159,3 +169,148 @@ FLOW_SHIFT_PRESETS = {
         "description": "Specialized for detailed hand gestures and finger movements"
     }
 }
+
+
+# Sigma schedules
+#
+# A schedule depends only on the sequence length, the flow preset and the step
+# count, so it is computed once per key and kept on the sampling device. Custom
+# schedules loaded with `load_custom_schedules` take precedence over computed ones.
+
+_schedule_cache = OrderedDict()
+_schedule_cache_size = 64
+_custom_schedules = {}
+
+
+def get_flux_sigmas_from_mu_sigma(n, mu, sigma):
+    """
+    Get sigma schedule with custom mu and sigma parameters for more balanced diffusion.
+
+    Args:
+        n: Number of inference steps
+        mu: Flow shift magnitude parameter
+        sigma: Flow shift curve parameter
+
+    Returns:
+        Tensor of sigma values
+    """
+    sigmas = torch.linspace(1, 0, steps=n + 1)
+    sigmas = flux_time_shift(sigmas, mu=mu, sigma=sigma)
+    return sigmas
+
+
+def resolve_flow_preset(flow_preset=None, content_type=None, detail_level=None, shift=None):
+    """
+    Hashable key of the flow shift settings passed to `sample_hunyuan`, in its order
+    of precedence: a direct shift, a preset from FLOW_SHIFT_PRESETS, a content type
+    and detail level, or the Default preset.
+    """
+    if shift is not None:
+        return ('shift', float(shift))
+    if flow_preset is not None and flow_preset in FLOW_SHIFT_PRESETS:
+        return ('preset', flow_preset)
+    if content_type is not None:
+        return ('content', content_type, detail_level if detail_level is not None else "standard")
+    return ('preset', "Default")
+
+
+@lru_cache(maxsize=None)
+def flow_shift_parameters(seq_length, preset):
+    """
+    Returns (mu, sigma) for a sequence length and a key from `resolve_flow_preset`.
+    """
+    kind = preset[0]
+
+    if kind == 'shift':
+        # Direct shift value (legacy mode)
+        return math.log(preset[1]), 1.0
+
+    if kind == 'preset':
+        settings = FLOW_SHIFT_PRESETS[preset[1]]
+        content_type, detail_level = settings["content_type"], settings["detail_level"]
+    else:
+        content_type, detail_level = preset[1], preset[2]
+
+    return calculate_optimized_mu(seq_length, content_type, detail_level), calculate_optimized_sigma(content_type, detail_level)
+
+
+def get_sigma_schedule(seq_length, steps, preset=('preset', "Default"), device=None):
+    """
+    Sigma schedule from 1 to 0 with `steps` steps, memoized per
+    (seq_length, preset, steps, device).
+
+    The returned tensor is shared between calls and must not be modified in place.
+
+    Args:
+        seq_length: Number of latent tokens, which sets mu
+        steps: Number of inference steps
+        preset: Key from `resolve_flow_preset`
+        device: Device the schedule is kept on
+
+    Returns:
+        Float32 tensor of steps + 1 sigmas on `device`
+    """
+    device = torch.device('cpu' if device is None else device)
+    key = (seq_length, preset, steps, device)
+
+    if key in _schedule_cache:
+        _schedule_cache.move_to_end(key)
+        return _schedule_cache[key]
+
+    custom = None
+    if preset[0] == 'preset':
+        custom = _custom_schedules.get((preset[1], steps, seq_length), _custom_schedules.get((preset[1], steps, None), None))
+
+    if custom is not None:
+        sigmas = torch.tensor(custom, dtype=torch.float32)
+        print(f"Using custom sigma schedule for {preset[1]}, {steps} steps, sequence length {seq_length}")
+    else:
+        mu, sigma = flow_shift_parameters(seq_length, preset)
+        sigmas = get_flux_sigmas_from_mu_sigma(steps, mu, sigma)
+        print(f"Sigma schedule for {preset}, {steps} steps, sequence length {seq_length}: mu={mu:.4f}, sigma={sigma:.4f}")
+
+    sigmas = sigmas.to(device)
+    _schedule_cache[key] = sigmas
+
+    while len(_schedule_cache) > _schedule_cache_size:
+        _schedule_cache.popitem(last=False)
+
+    return sigmas
+
+
+def register_sigma_schedule(flow_preset, steps, sigmas, seq_length=None):
+    """
+    Use `sigmas` for `flow_preset` at `steps` steps, for one sequence length or for
+    all of them when seq_length is None.
+    """
+    sigmas = [float(s) for s in sigmas]
+
+    assert len(sigmas) == steps + 1, f'A {steps}-step schedule needs {steps + 1} sigmas, got {len(sigmas)}'
+    assert all(a > b for a, b in zip(sigmas[:-1], sigmas[1:])), 'Sigmas must be strictly decreasing'
+    assert sigmas[0] <= 1.0 and sigmas[-1] == 0.0, 'Sigmas must start at most at 1 and end at 0'
+
+    _custom_schedules[(flow_preset, steps, seq_length)] = sigmas
+
+    for key in [k for k in _schedule_cache if k[1] == ('preset', flow_preset) and k[2] == steps]:
+        del _schedule_cache[key]
+
+
+def load_custom_schedules(path):
+    """
+    Register the precomputed schedules in a JSON file of the form
+
+        {"schedules": [{"flow_preset": "Hand Detail", "steps": 25, "seq_length": null, "sigmas": [1.0, ..., 0.0]}]}
+
+    where seq_length is optional. Returns the number of schedules loaded.
+    """
+    if path is None or not os.path.exists(path):
+        return 0
+
+    with open(path, 'rt', encoding='utf-8') as f:
+        entries = json.load(f)["schedules"]
+
+    for entry in entries:
+        register_sigma_schedule(entry["flow_preset"], int(entry["steps"]), entry["sigmas"], entry.get("seq_length", None))
+
+    print(f'Loaded {len(entries)} custom sigma schedules from {path}')
+    return len(entries)
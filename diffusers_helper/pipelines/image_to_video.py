@@ -0,0 +1,656 @@
+"""
+Image-to-video generation shared by the Gradio UI and the headless job runner.
+
+Models are loaded once with `load_models` and every job is run through
+`generate_video` with the same `FramePackModels` instance, so a long queue of
+jobs never pays for model loading more than once.
+"""
+
+import os
+import shutil
+import contextlib
+import traceback
+
+import einops
+import numpy as np
+import torch
+
+from PIL import Image
+from diffusers import AutoencoderKLHunyuanVideo
+from transformers import LlamaModel, CLIPTextModel, LlamaTokenizerFast, CLIPTokenizer
+from transformers import SiglipImageProcessor, SiglipVisionModel
+from config import TEACACHE_CONFIG, TEACACHE_CALIBRATION_CONFIG, FLOW_SHIFT_CONFIGS, EMBEDDING_CACHE_CONFIG, SAMPLING_CONFIG, MEMORY_CONFIG, DECODE_CONFIG, ATTENTION_CONFIG, FLOW_SCHEDULE_CONFIG, ADAPTIVE_STEPS_CONFIG
+from diffusers_helper.hunyuan import encode_prompt_conds, vae_decode, vae_decode_chunked, vae_encode, vae_decode_fake
+from diffusers_helper.utils import save_bcthw_as_mp4, bcthw_to_uint8_frames, crop_or_pad_yield_mask, FrameHistoryBuffer, resize_and_center_crop, generate_timestamp, repeat_to_batch_size
+from diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModelPacked, TeaCacheContext
+from diffusers_helper.models.attention_backends import set_attention_backend
+from diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
+from diffusers_helper.pipelines.flow_shift_configs import load_custom_schedules
+from diffusers_helper.k_diffusion.convergence import ConvergenceMonitor
+from diffusers_helper.k_diffusion.samplers import sampler_nfe
+from diffusers_helper.memory import gpu, get_cuda_free_memory_gb, move_model_to_device_with_memory_preservation, offload_model_from_device_for_memory_preservation, fake_diffusers_current_device, DynamicSwapInstaller, PinnedSwapInstaller, ResidencyPlanner, ModelResidencyManager, CudaMemoryAccountant, unload_complete_models
+from diffusers_helper.gradio.enhanced_progress_bar import make_enhanced_progress_bar_html
+from diffusers_helper.clip_vision import hf_clip_vision_encode
+from diffusers_helper.bucket_tools import find_nearest_bucket
+from diffusers_helper.embedding_cache import TensorCache, PromptEmbeddingCache, ImageEmbeddingCache
+from diffusers_helper.video_writer import SegmentedMP4Writer
+from diffusers_helper.teacache_calibration import load_calibration, calibrated_settings
+
+
+class FramePackModels:
+    """
+    Container for every model used by the image-to-video pipeline.
+
+    Instances are created by `load_models` and shared across jobs.
+    """
+
+    def __init__(self, text_encoder, text_encoder_2, tokenizer, tokenizer_2, vae, feature_extractor, image_encoder, transformer, high_vram):
+        self.text_encoder = text_encoder
+        self.text_encoder_2 = text_encoder_2
+        self.tokenizer = tokenizer
+        self.tokenizer_2 = tokenizer_2
+        self.vae = vae
+        self.feature_extractor = feature_extractor
+        self.image_encoder = image_encoder
+        self.transformer = transformer
+        self.high_vram = high_vram
+
+        self.residency = None
+        if not high_vram:
+            self.residency = ModelResidencyManager(
+                budget_bytes=int(MEMORY_CONFIG["model_budget_gb"] * 1024 ** 3),
+                accountant=CudaMemoryAccountant(gpu),
+            )
+
+        self.residency_planner = None
+        if not high_vram and MEMORY_CONFIG["residency_planner"] and not PinnedSwapInstaller.is_installed(transformer):
+            self.residency_planner = ResidencyPlanner(
+                transformer, device=gpu,
+                vram_budget_gb=MEMORY_CONFIG["vram_budget_gb"],
+                activation_margin=MEMORY_CONFIG["activation_margin"],
+            )
+
+        prompt_cache_config = EMBEDDING_CACHE_CONFIG["prompt"]
+        self.prompt_cache = PromptEmbeddingCache(
+            TensorCache(
+                memory_max_bytes=int(prompt_cache_config["memory_mb"] * 1024 ** 2),
+                disk_dir=prompt_cache_config["disk_dir"],
+                disk_max_bytes=int(prompt_cache_config["disk_mb"] * 1024 ** 2),
+            ),
+            text_encoder, text_encoder_2,
+        )
+
+        image_cache_config = EMBEDDING_CACHE_CONFIG["image"]
+        self.image_cache = ImageEmbeddingCache(
+            TensorCache(
+                memory_max_bytes=int(image_cache_config["memory_mb"] * 1024 ** 2),
+                disk_dir=image_cache_config["disk_dir"],
+                disk_max_bytes=int(image_cache_config["disk_mb"] * 1024 ** 2),
+            ),
+            vae, image_encoder,
+        )
+
+    def encode_prompts(self, prompts):
+        """
+        Return `(llama_vec, clip_l_pooler)` for every prompt, in order.
+
+        Cached prompts are served without touching the text encoders. All misses are
+        encoded together in length-bucketed batches, so prefilling the cache with a
+        whole job queue costs one encoder load and a few forward passes.
+        """
+        def encode_missing_prompts(missing_prompts):
+            # Text encoders are only moved to GPU when some prompt is not cached
+            if not self.high_vram:
+                fake_diffusers_current_device(self.text_encoder, gpu)  # the Llama encoder stays under DynamicSwap; only its first weight is moved so diffusers reports the GPU as its device
+                self.residency.load(self.text_encoder_2)
+
+            return encode_prompt_conds(missing_prompts, self.text_encoder, self.text_encoder_2, self.tokenizer, self.tokenizer_2)
+
+        return self.prompt_cache.get_or_encode(prompts, encode_missing_prompts)
+
+    def unload_all(self, keep_residents=False):
+        """
+        Move the swapped models (text encoder, transformer) off the GPU. The whole
+        models managed by `residency` are unloaded too unless `keep_residents` is set.
+        """
+        if not self.high_vram:
+            if not keep_residents:
+                self.residency.unload_all()
+
+            # Models under PinnedSwapInstaller keep their resident part on GPU for good
+            unload_complete_models(*[
+                m for m in [self.text_encoder, self.transformer]
+                if not PinnedSwapInstaller.is_installed(m)
+            ])
+
+
+def load_models(high_vram=None):
+    """
+    Load all pipeline models and place them according to the available VRAM.
+
+    Args:
+        high_vram: Force high- or low-VRAM mode. If None, it is detected from
+            the free GPU memory (more than 60 GB means high-VRAM mode).
+
+    Returns:
+        FramePackModels instance ready to be passed to `generate_video`
+    """
+    if high_vram is None:
+        free_mem_gb = get_cuda_free_memory_gb(gpu)
+        high_vram = free_mem_gb > 60
+        print(f'Free VRAM {free_mem_gb} GB')
+
+    print(f'High-VRAM Mode: {high_vram}')
+
+    text_encoder = LlamaModel.from_pretrained("hunyuanvideo-community/HunyuanVideo", subfolder='text_encoder', torch_dtype=torch.float16).cpu()
+    text_encoder_2 = CLIPTextModel.from_pretrained("hunyuanvideo-community/HunyuanVideo", subfolder='text_encoder_2', torch_dtype=torch.float16).cpu()
+    tokenizer = LlamaTokenizerFast.from_pretrained("hunyuanvideo-community/HunyuanVideo", subfolder='tokenizer')
+    tokenizer_2 = CLIPTokenizer.from_pretrained("hunyuanvideo-community/HunyuanVideo", subfolder='tokenizer_2')
+    vae = AutoencoderKLHunyuanVideo.from_pretrained("hunyuanvideo-community/HunyuanVideo", subfolder='vae', torch_dtype=torch.float16).cpu()
+
+    feature_extractor = SiglipImageProcessor.from_pretrained("Suparious/FLUX.1-Redux-dev-adaptor-bfl", subfolder='feature_extractor')
+    image_encoder = SiglipVisionModel.from_pretrained("Suparious/FLUX.1-Redux-dev-adaptor-bfl", subfolder='image_encoder', torch_dtype=torch.float16).cpu()
+
+    transformer = HunyuanVideoTransformer3DModelPacked.from_pretrained('Suparious/FP-image-to-video-FLUX.1-HV-bf16', torch_dtype=torch.bfloat16).cpu()
+
+    vae.eval()
+    text_encoder.eval()
+    text_encoder_2.eval()
+    image_encoder.eval()
+    transformer.eval()
+
+    if not high_vram:
+        vae.enable_slicing()
+        vae.enable_tiling()
+
+    transformer.high_quality_fp32_output_for_inference = True
+    print('transformer.high_quality_fp32_output_for_inference = True')
+
+    set_attention_backend(ATTENTION_CONFIG["backend"])
+    load_custom_schedules(FLOW_SCHEDULE_CONFIG["custom_schedules_file"])
+
+    transformer.to(dtype=torch.bfloat16)
+    vae.to(dtype=torch.float16)
+    image_encoder.to(dtype=torch.float16)
+    text_encoder.to(dtype=torch.float16)
+    text_encoder_2.to(dtype=torch.float16)
+
+    vae.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    text_encoder_2.requires_grad_(False)
+    image_encoder.requires_grad_(False)
+    transformer.requires_grad_(False)
+
+    if not high_vram:
+        if MEMORY_CONFIG["swap_engine"] == "pinned":
+            # Blocks stream from pinned memory on a side stream, overlapping the upload of block N+1 with block N
+            PinnedSwapInstaller.install_model(transformer, device=gpu, gpu_budget_gb=MEMORY_CONFIG["pinned_gpu_budget_gb"], prefetch_blocks=MEMORY_CONFIG["pinned_prefetch_blocks"])
+            PinnedSwapInstaller.install_model(text_encoder, device=gpu, prefetch_blocks=MEMORY_CONFIG["pinned_prefetch_blocks"])
+        else:
+            # DynamicSwapInstaller is same as huggingface's enable_sequential_offload but 3x faster
+            DynamicSwapInstaller.install_model(transformer, device=gpu)
+            DynamicSwapInstaller.install_model(text_encoder, device=gpu)
+    else:
+        text_encoder.to(gpu)
+        text_encoder_2.to(gpu)
+        image_encoder.to(gpu)
+        vae.to(gpu)
+        transformer.to(gpu)
+
+    return FramePackModels(
+        text_encoder=text_encoder,
+        text_encoder_2=text_encoder_2,
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer_2,
+        vae=vae,
+        feature_extractor=feature_extractor,
+        image_encoder=image_encoder,
+        transformer=transformer,
+        high_vram=high_vram,
+    )
+
+
+class _NullStream:
+    """Stands in for AsyncStream when nobody is listening (headless runs)."""
+
+    class _Queue:
+        def push(self, item):
+            return
+
+        def top(self):
+            return None
+
+    def __init__(self):
+        self.input_queue = self._Queue()
+        self.output_queue = self._Queue()
+
+
+@torch.no_grad()
+def generate_video(models, input_image, prompt, n_prompt, seed, total_second_length, latent_window_size, steps, cfg, gs, rs, gpu_memory_preservation, use_teacache, hand_optimization, flow_preset, mp4_crf, outputs_dir, stream=None, job_id=None, num_variations=1, deferred_decode=None, teacache_traces=None, sampler=None, adaptive_steps=None):
+    """
+    Generate a video from a start image and a prompt.
+
+    Progress, previews and intermediate files are reported through `stream`
+    (an AsyncStream) when it is given. Without a stream the job runs headless:
+    latent previews are skipped and only the final video is written.
+
+    With num_variations > 1, seeds seed, seed + 1, ... are denoised together as
+    one batch. The returned file then shows all variations side by side, and
+    every variation is also saved on its own as `<name>_seed<seed>.mp4`.
+
+    With deferred_decode (default from DECODE_CONFIG) the transformer stays on
+    the GPU for all sections and the VAE decodes the whole video once at the end;
+    only the optional low-rate section previews are written before that.
+
+    With teacache_traces (a list), TeaCache computes every step and the traces it
+    records for calibration are appended to the list.
+
+    `sampler` names one of `diffusers_helper.k_diffusion.samplers.SAMPLERS`
+    (default from SAMPLING_CONFIG).
+
+    `adaptive_steps` (default from ADAPTIVE_STEPS_CONFIG) adapts the step count per
+    section: "early_stop" stops a section once its denoised estimate has
+    converged, "coarse_grid" runs every section on a schedule with as many steps
+    as the previous section needed. None runs `steps` steps in every section.
+
+    Returns:
+        Path of the final MP4 file, or None if the job was cancelled or failed
+    """
+    headless = stream is None
+    if headless:
+        stream = _NullStream()
+
+    if deferred_decode is None:
+        deferred_decode = headless if DECODE_CONFIG["deferred_decode"] is None else DECODE_CONFIG["deferred_decode"]
+    preview_every_sections = DECODE_CONFIG["preview_every_sections"]
+
+    text_encoder = models.text_encoder
+    text_encoder_2 = models.text_encoder_2
+    tokenizer = models.tokenizer
+    tokenizer_2 = models.tokenizer_2
+    vae = models.vae
+    feature_extractor = models.feature_extractor
+    image_encoder = models.image_encoder
+    transformer = models.transformer
+    high_vram = models.high_vram
+    residency_planner = models.residency_planner
+    cfg_batching = high_vram if SAMPLING_CONFIG["cfg_batching"] is None else SAMPLING_CONFIG["cfg_batching"]
+    teacache_calibration = load_calibration(TEACACHE_CALIBRATION_CONFIG["file"])
+    sampler = SAMPLING_CONFIG["sampler"] if sampler is None else sampler
+    adaptive_steps = ADAPTIVE_STEPS_CONFIG["mode"] if adaptive_steps is None else adaptive_steps
+    assert adaptive_steps in [None, 'early_stop', 'coarse_grid'], f'Unknown adaptive steps mode {adaptive_steps}'
+
+    # If hand optimization is enabled and TeaCache is enabled, we use the hand-optimized (block-level) TeaCache settings
+    # Block-level residuals stay on the GPU during sampling, so they are reserved like activations
+    teacache_name = None
+    teacache_residual_gb = 0.0
+    if use_teacache:
+        teacache_name = "hand_optimized" if hand_optimization else "standard"
+        teacache_settings, rescale_coefficients = calibrated_settings(teacache_name, TEACACHE_CONFIG[teacache_name], teacache_calibration)
+        if teacache_settings.get("mode", "model") == "blocks":
+            teacache_residual_gb = teacache_settings.get("residual_budget_gb", None) or 0.0
+
+    total_latent_sections = (total_second_length * 30) / (latent_window_size * 4)
+    total_latent_sections = int(max(round(total_latent_sections), 1))
+
+    if job_id is None:
+        job_id = generate_timestamp()
+
+    output_filename = None
+    segment_root = os.path.join(outputs_dir, 'partial', f'{job_id}_segments')
+    writers = []
+
+    stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'Starting ...'))))
+
+    try:
+        # Clean GPU; the VAE and encoders stay resident for the next job while they fit in the budget
+        models.unload_all(keep_residents=True)
+
+        # Text encoding
+
+        stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'Text encoding ...'))))
+
+        if cfg == 1:
+            (llama_vec, clip_l_pooler), = models.encode_prompts([prompt])
+            llama_vec_n, clip_l_pooler_n = torch.zeros_like(llama_vec), torch.zeros_like(clip_l_pooler)
+        else:
+            (llama_vec, clip_l_pooler), (llama_vec_n, clip_l_pooler_n) = models.encode_prompts([prompt, n_prompt])
+
+        llama_vec, clip_l_pooler = llama_vec.to(gpu), clip_l_pooler.to(gpu)
+        llama_vec_n, clip_l_pooler_n = llama_vec_n.to(gpu), clip_l_pooler_n.to(gpu)
+
+        llama_vec, llama_attention_mask = crop_or_pad_yield_mask(llama_vec, length=512)
+        llama_vec_n, llama_attention_mask_n = crop_or_pad_yield_mask(llama_vec_n, length=512)
+
+        # Processing input image
+
+        stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'Image processing ...'))))
+
+        H, W, C = input_image.shape
+        height, width = find_nearest_bucket(H, W, resolution=640)
+        input_image_np = resize_and_center_crop(input_image, target_width=width, target_height=height)
+
+        Image.fromarray(input_image_np).save(os.path.join(outputs_dir, f'{job_id}.png'))
+
+        cached_image_embeddings = models.image_cache.get(input_image_np)
+
+        if cached_image_embeddings is not None:
+            # Regenerating from an already seen image: neither the VAE nor the image encoder is needed
+            start_latent, image_encoder_last_hidden_state = cached_image_embeddings
+            image_encoder_last_hidden_state = image_encoder_last_hidden_state.to(gpu)
+            print('Start image found in cache, skipping VAE and CLIP Vision encoding')
+        else:
+            input_image_pt = torch.from_numpy(input_image_np).float() / 127.5 - 1
+            input_image_pt = input_image_pt.permute(2, 0, 1)[None, :, None]
+
+            # VAE encoding
+
+            stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'VAE encoding ...'))))
+
+            if not high_vram:
+                models.residency.load(vae)
+
+            start_latent = vae_encode(input_image_pt, vae)
+
+            # CLIP Vision
+
+            stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'CLIP Vision encoding ...'))))
+
+            if not high_vram:
+                models.residency.load(image_encoder)
+
+            image_encoder_output = hf_clip_vision_encode(input_image_np, feature_extractor, image_encoder)
+            image_encoder_last_hidden_state = image_encoder_output.last_hidden_state
+
+            models.image_cache.put(input_image_np, start_latent, image_encoder_last_hidden_state)
+
+        # Dtype
+
+        llama_vec = llama_vec.to(transformer.dtype)
+        llama_vec_n = llama_vec_n.to(transformer.dtype)
+        clip_l_pooler = clip_l_pooler.to(transformer.dtype)
+        clip_l_pooler_n = clip_l_pooler_n.to(transformer.dtype)
+        image_encoder_last_hidden_state = image_encoder_last_hidden_state.to(transformer.dtype)
+
+        # Sampling
+
+        stream.output_queue.push(('progress', (None, '', make_enhanced_progress_bar_html(0, 'Start sampling ...'))))
+
+        seeds = [seed + k for k in range(num_variations)]
+
+        if num_variations == 1:
+            rnd = torch.Generator("cpu").manual_seed(seed)
+        else:
+            # Each variation keeps its own generator so it matches a single-seed run with that seed
+            rnd = [torch.Generator("cpu").manual_seed(s) for s in seeds]
+            start_latent = repeat_to_batch_size(start_latent, num_variations)
+        num_frames = latent_window_size * 4 - 3
+
+        history_latents = torch.zeros(size=(num_variations, 16, 1 + 2 + 16, height // 8, width // 8), dtype=torch.float32).cpu()
+        history_pixels = FrameHistoryBuffer()
+        total_generated_latent_frames = 0
+        sections_done = 0
+        section_steps = steps
+        min_section_steps = max(int(round(steps * ADAPTIVE_STEPS_CONFIG["min_steps_ratio"])), 1)
+        steps_per_section = []
+        overlapped_frames = latent_window_size * 4 - 3
+
+        # Sections are generated back to front, so frames are encoded once as they become final and the
+        # segments are joined in temporal order at the end. The grid writer comes first, then one per seed.
+        writers = [SegmentedMP4Writer(os.path.join(segment_root, 'grid'), fps=30, crf=mp4_crf)]
+        if num_variations > 1:
+            writers += [SegmentedMP4Writer(os.path.join(segment_root, f'seed{s}'), fps=30, crf=mp4_crf) for s in seeds]
+        partial_filename = None
+        preview_filename = None
+
+        def write_frames(pixels, at_front):
+            if pixels.shape[2] == 0:
+                return
+            for writer, writer_pixels in zip(writers, [pixels] + list(pixels.split(1, dim=0))):
+                frames = bcthw_to_uint8_frames(writer_pixels)
+                if at_front:
+                    writer.prepend(frames)
+                else:
+                    writer.append(frames)
+
+        def make_room_for_vae():
+            if not high_vram:
+                if residency_planner is not None:
+                    residency_planner.offload(preserved_memory_gb=8)
+                elif not PinnedSwapInstaller.is_installed(transformer):
+                    offload_model_from_device_for_memory_preservation(transformer, target_device=gpu, preserved_memory_gb=8)
+                models.residency.load(vae)
+
+        latent_paddings = reversed(range(total_latent_sections))
+
+        if total_latent_sections > 4:
+            # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
+            # items looks better than expanding it when total_latent_sections > 4
+            # One can try to remove below trick and just
+            # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
+            latent_paddings = [3] + [2] * (total_latent_sections - 3) + [1, 0]
+
+        for latent_padding in latent_paddings:
+            is_last_section = latent_padding == 0
+            latent_padding_size = latent_padding * latent_window_size
+
+            if stream.input_queue.top() == 'end':
+                stream.output_queue.push(('end', None))
+                return None
+
+            print(f'latent_padding_size = {latent_padding_size}, is_last_section = {is_last_section}')
+
+            indices = torch.arange(0, sum([1, latent_padding_size, latent_window_size, 1, 2, 16])).unsqueeze(0)
+            clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([1, latent_padding_size, latent_window_size, 1, 2, 16], dim=1)
+            clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
+
+            clean_latents_pre = start_latent.to(history_latents)
+            clean_latents_post, clean_latents_2x, clean_latents_4x = history_latents[:, :, :1 + 2 + 16, :, :].split([1, 2, 16], dim=2)
+            clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
+
+            activation_key = (height, width, latent_window_size, num_variations, cfg_batching and cfg != 1, teacache_name)
+
+            if not high_vram:
+                if residency_planner is not None:
+                    # The preserved memory setting plus the TeaCache residuals is only the activation reserve
+                    # until this key's peak, which includes the residuals, has been measured
+                    residency_planner.apply(residency_planner.plan(activation_key, default_activation_gb=gpu_memory_preservation + teacache_residual_gb))
+                elif not PinnedSwapInstaller.is_installed(transformer):
+                    move_model_to_device_with_memory_preservation(transformer, target_device=gpu, preserved_memory_gb=gpu_memory_preservation + teacache_residual_gb)
+
+            # The context holds this section's TeaCache state, kept apart per CFG branch and per sample.
+            # It counts model calls, which some samplers make more than one of per step
+            if use_teacache:
+                teacache = TeaCacheContext(
+                    num_steps=sampler_nfe(sampler, section_steps), rel_l1_thresh=teacache_settings["rel_l1_thresh"], sync_free=SAMPLING_CONFIG["sync_free"],
+                    mode=teacache_settings.get("mode", "model"), block_group_size=teacache_settings.get("block_group_size", 4),
+                    residual_budget_gb=teacache_settings.get("residual_budget_gb", None),
+                    rescale_coefficients=rescale_coefficients, record_traces=teacache_traces is not None,
+                )
+                print(f"TeaCache enabled with {teacache_name} settings ({teacache_settings})")
+            else:
+                teacache = None
+                print("TeaCache disabled")
+
+            # Get the actual flow preset name from the config if needed
+            actual_flow_preset = flow_preset
+            if actual_flow_preset in FLOW_SHIFT_CONFIGS:
+                actual_flow_preset = FLOW_SHIFT_CONFIGS[actual_flow_preset]["flow_preset"]
+
+            print(f"Using flow preset: {actual_flow_preset}")
+
+            def callback(d):
+                if stream.input_queue.top() == 'end':
+                    stream.output_queue.push(('end', None))
+                    raise KeyboardInterrupt('User ends the task.')
+
+                if headless:
+                    return
+
+                preview = d['denoised']
+                preview = vae_decode_fake(preview)
+
+                preview = (preview * 255.0).detach().cpu().numpy().clip(0, 255).astype(np.uint8)
+                preview = einops.rearrange(preview, 'b c t h w -> (b h) (t w) c')
+
+                current_step = d['i'] + 1
+                percentage = int(100.0 * current_step / section_steps)
+                hint = f'Sampling {current_step}/{section_steps}'
+                desc = f'Total generated frames: {int(max(0, total_generated_latent_frames * 4 - 3))}, Video length: {max(0, (total_generated_latent_frames * 4 - 3) / 30) :.2f} seconds (FPS-30). The video is being extended now ...'
+                stream.output_queue.push(('progress', (preview, desc, make_enhanced_progress_bar_html(percentage, hint))))
+                return
+
+            if adaptive_steps is not None:
+                convergence = ConvergenceMonitor(
+                    section_steps, tolerance=ADAPTIVE_STEPS_CONFIG["tolerance"], patience=ADAPTIVE_STEPS_CONFIG["patience"],
+                    min_steps_ratio=ADAPTIVE_STEPS_CONFIG["min_steps_ratio"], early_stop=adaptive_steps == 'early_stop',
+                )
+            else:
+                convergence = None
+
+            activation_observer = residency_planner.observe_activations(activation_key) if residency_planner is not None else contextlib.nullcontext()
+
+            with activation_observer:
+                generated_latents = sample_hunyuan(
+                    transformer=transformer,
+                    sampler=sampler,
+                    width=width,
+                    height=height,
+                    frames=num_frames,
+                    real_guidance_scale=cfg,
+                    distilled_guidance_scale=gs,
+                    guidance_rescale=rs,
+                    # shift=3.0,  # Replaced with flow_preset
+                    flow_preset=actual_flow_preset,  # Use optimized flow shift parameters
+                    num_inference_steps=section_steps,
+                    teacache=teacache,
+                    convergence=convergence,
+                    generator=rnd,
+                    batch_size=num_variations,
+                    prompt_embeds=llama_vec,
+                    prompt_embeds_mask=llama_attention_mask,
+                    prompt_poolers=clip_l_pooler,
+                    negative_prompt_embeds=llama_vec_n,
+                    negative_prompt_embeds_mask=llama_attention_mask_n,
+                    negative_prompt_poolers=clip_l_pooler_n,
+                    device=gpu,
+                    dtype=torch.bfloat16,
+                    image_embeddings=image_encoder_last_hidden_state,
+                    latent_indices=latent_indices,
+                    clean_latents=clean_latents,
+                    clean_latent_indices=clean_latent_indices,
+                    clean_latents_2x=clean_latents_2x,
+                    clean_latent_2x_indices=clean_latent_2x_indices,
+                    clean_latents_4x=clean_latents_4x,
+                    clean_latent_4x_indices=clean_latent_4x_indices,
+                    callback=callback,
+                    cfg_batching=cfg_batching,
+                )
+
+            if teacache is not None:
+                print(f'TeaCache computed/skipped block groups per branch: {teacache.stats()}')
+                if teacache_traces is not None:
+                    teacache_traces.extend(teacache.traces())
+
+            if convergence is not None:
+                print(f'Section {sections_done + 1}: {convergence.summary()}')
+                steps_per_section.append(convergence.steps)
+
+                if adaptive_steps == 'coarse_grid':
+                    # Sections generated later see more clean context; a section that did not converge resets the grid
+                    section_steps = steps if convergence.converged_at is None else max(convergence.converged_at, min_section_steps)
+            else:
+                steps_per_section.append(section_steps)
+
+            if is_last_section:
+                print(f'Steps per section, in generation order: {steps_per_section} ({sum(steps_per_section)} of {steps * len(steps_per_section)})')
+                generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
+
+            total_generated_latent_frames += int(generated_latents.shape[2])
+            history_latents = torch.cat([generated_latents.to(history_latents), history_latents], dim=2)
+
+            real_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
+            section_latent_frames = (latent_window_size * 2 + 1) if is_last_section else (latent_window_size * 2)
+            sections_done += 1
+
+            if deferred_decode and not is_last_section:
+                if headless or preview_every_sections <= 0 or sections_done % preview_every_sections != 0:
+                    print(f'Decode deferred. Current latent shape {real_history_latents.shape}')
+                    continue
+
+                make_room_for_vae()
+                preview_pixels = vae_decode(real_history_latents[:, :, :section_latent_frames], vae).cpu()
+
+                # Each preview replaces the previous one, so a job leaves no preview files behind
+                previous_preview_filename = preview_filename
+                preview_filename = os.path.join(outputs_dir, f'{job_id}_{total_generated_latent_frames}_preview.mp4')
+                save_bcthw_as_mp4(preview_pixels, preview_filename, fps=30, crf=mp4_crf)
+
+                if previous_preview_filename is not None:
+                    os.remove(previous_preview_filename)
+                stream.output_queue.push(('file', preview_filename))
+                continue
+
+            make_room_for_vae()
+
+            if deferred_decode:
+                # The only decode of the job. Chunks go straight to the encoder in temporal order,
+                # so host memory holds one chunk of frames instead of the whole video
+                for pixel_chunk in vae_decode_chunked(real_history_latents, vae):
+                    write_frames(pixel_chunk, at_front=False)
+
+                print(f'Decoded. Latent shape {real_history_latents.shape}')
+            else:
+                if len(history_pixels) == 0:
+                    history_pixels.prepend(vae_decode(real_history_latents, vae))
+                else:
+                    current_pixels = vae_decode(real_history_latents[:, :, :section_latent_frames], vae)
+                    history_pixels.prepend(current_pixels, overlap=overlapped_frames)
+
+                print(f'Decoded. Current latent shape {real_history_latents.shape}; {history_pixels.total_frames} pixel frames')
+
+                # Only the first overlapped_frames frames are blended again by the next section; everything after them
+                # is final, so it is encoded and released and the buffer never holds more than about one section
+                pending_frames = 0 if is_last_section else overlapped_frames
+                final_pixels = history_pixels.frames[:, :, pending_frames:]
+
+                write_frames(final_pixels, at_front=True)
+                history_pixels.release_tail(final_pixels.shape[2])
+
+            if is_last_section:
+                output_filename = writers[0].finalize(os.path.join(outputs_dir, f'{job_id}_{total_generated_latent_frames}.mp4'))
+                for writer, variation_seed in zip(writers[1:], seeds):
+                    writer.finalize(output_filename[:-len('.mp4')] + f'_seed{variation_seed}.mp4')
+
+                for intermediate_filename in [partial_filename, preview_filename]:
+                    if intermediate_filename is not None:
+                        os.remove(intermediate_filename)
+
+                stream.output_queue.push(('file', output_filename))
+                break
+
+            # Headless runs have no one watching the intermediate results, so only the final video is written
+            if headless:
+                continue
+
+            # Remuxing the finished segments is cheap and gives a playable file of the video's tail so far
+            previous_partial_filename = partial_filename
+            partial_filename = writers[0].publish(os.path.join(outputs_dir, 'partial', f'{job_id}_{total_generated_latent_frames}.mp4'))
+
+            if partial_filename is not None:
+                if previous_partial_filename is not None:
+                    os.remove(previous_partial_filename)
+                stream.output_queue.push(('file', partial_filename))
+    except:
+        traceback.print_exc()
+
+        models.unload_all()
+
+        output_filename = None
+    finally:
+        for writer in writers:
+            writer.close()
+        shutil.rmtree(segment_root, ignore_errors=True)
+
+    stream.output_queue.push(('end', None))
+    return output_filename
@@ -1,44 +1,9 @@
 import torch
-import math
 
-from diffusers_helper.k_diffusion.uni_pc_fm import sample_unipc
+from diffusers_helper.k_diffusion.samplers import get_sampler
 from diffusers_helper.k_diffusion.wrapper import fm_wrapper
 from diffusers_helper.utils import repeat_to_batch_size
-from diffusers_helper.pipelines.flow_shift_configs import (
-    flux_time_shift,
-    calculate_optimized_mu,
-    calculate_optimized_sigma,
-    FLOW_SHIFT_PRESETS
-)
-
-
-def flux_time_shift(t, mu=1.15, sigma=1.0):
-    return math.exp(mu) / (math.exp(mu) + (1 / t - 1) ** sigma)
-
-
-def calculate_flux_mu(context_length, x1=256, y1=0.5, x2=4096, y2=1.15, exp_max=7.0):
-    k = (y2 - y1) / (x2 - x1)
-    b = y1 - k * x1
-    mu = k * context_length + b
-    mu = min(mu, math.log(exp_max))
-    return mu
-
-
-def get_flux_sigmas_from_mu_sigma(n, mu, sigma):
-    """
-    Get sigma schedule with custom mu and sigma parameters for more balanced diffusion.
-    
-    Args:
-        n: Number of inference steps
-        mu: Flow shift magnitude parameter
-        sigma: Flow shift curve parameter
-    
-    Returns:
-        Tensor of sigma values
-    """
-    sigmas = torch.linspace(1, 0, steps=n + 1)
-    sigmas = flux_time_shift(sigmas, mu=mu, sigma=sigma)
-    return sigmas
+from diffusers_helper.pipelines.flow_shift_configs import get_sigma_schedule, resolve_flow_preset
 
 
 @torch.inference_mode()
@@ -71,43 +36,35 @@ def sample_hunyuan(
         device=None,
         negative_kwargs=None,
         callback=None,
+        cfg_batching=False,
+        teacache=None,
+        convergence=None,
         **kwargs,
 ):
     device = device or transformer.device
 
+    if teacache is None:
+        # Context set with transformer.initialize_teacache, if any
+        teacache = getattr(transformer, 'teacache_context', None)
+
     if batch_size is None:
         batch_size = int(prompt_embeds.shape[0])
 
-    latents = torch.randn((batch_size, 16, (frames + 3) // 4, height // 8, width // 8), generator=generator, device=generator.device).to(device=device, dtype=torch.float32)
+    latent_shape = (16, (frames + 3) // 4, height // 8, width // 8)
+
+    if isinstance(generator, (list, tuple)):
+        # One generator per sample, e.g. several seeds denoised together in one batch
+        assert len(generator) == batch_size, f'Got {len(generator)} generators for batch size {batch_size}.'
+        latents = torch.cat([torch.randn((1, *latent_shape), generator=g, device=g.device).to(device=device, dtype=torch.float32) for g in generator], dim=0)
+    else:
+        latents = torch.randn((batch_size, *latent_shape), generator=generator, device=generator.device).to(device=device, dtype=torch.float32)
 
     B, C, T, H, W = latents.shape
     seq_length = T * H * W // 4
 
-    # Flow shift parameter calculation
-    if shift is not None:
-        # Direct shift value provided (legacy mode)
-        mu = math.log(shift)
-        sigma = 1.0  # Default sigma in legacy mode
-    elif flow_preset is not None and flow_preset in FLOW_SHIFT_PRESETS:
-        # Use a predefined preset
-        preset = FLOW_SHIFT_PRESETS[flow_preset]
-        mu = calculate_optimized_mu(seq_length, preset["content_type"], preset["detail_level"])
-        sigma = calculate_optimized_sigma(preset["content_type"], preset["detail_level"])
-    elif content_type is not None:
-        # Use specified content type and detail level
-        actual_detail_level = detail_level if detail_level is not None else "standard"
-        mu = calculate_optimized_mu(seq_length, content_type, actual_detail_level)
-        sigma = calculate_optimized_sigma(content_type, actual_detail_level)
-    else:
-        # Use default balanced settings
-        mu = calculate_optimized_mu(seq_length)
-        sigma = calculate_optimized_sigma()
-    
-    # Get sigmas with optimized parameters
-    sigmas = get_flux_sigmas_from_mu_sigma(num_inference_steps, mu, sigma).to(device)
-    
-    # Log flow shift parameters for debugging
-    print(f"Using flow shift parameters: mu={mu:.4f}, sigma={sigma:.4f}")
+    # Memoized per sequence length, preset and step count, already on the device
+    preset = resolve_flow_preset(flow_preset=flow_preset, content_type=content_type, detail_level=detail_level, shift=shift)
+    sigmas = get_sigma_schedule(seq_length, num_inference_steps, preset, device=device)
 
     k_model = fm_wrapper(transformer)
 
@@ -130,10 +87,16 @@ def sample_hunyuan(
     negative_prompt_poolers = repeat_to_batch_size(negative_prompt_poolers, batch_size)
     concat_latent = repeat_to_batch_size(concat_latent, batch_size)
 
+    for k in ['image_embeddings', 'clean_latents', 'clean_latents_2x', 'clean_latents_4x']:
+        if isinstance(kwargs.get(k, None), torch.Tensor):
+            kwargs[k] = repeat_to_batch_size(kwargs[k], batch_size)
+
     sampler_kwargs = dict(
         dtype=dtype,
         cfg_scale=real_guidance_scale,
         cfg_rescale=guidance_rescale,
+        cfg_batching=cfg_batching,
+        teacache=teacache,
         concat_latent=concat_latent,
         positive=dict(
             pooled_projections=prompt_poolers,
@@ -151,9 +114,9 @@ def sample_hunyuan(
         )
     )
 
-    if sampler == 'unipc':
-        results = sample_unipc(k_model, latents, sigmas, extra_args=sampler_kwargs, disable=False, callback=callback)
-    else:
-        raise NotImplementedError(f'Sampler {sampler} is not supported.')
+    # Samplers registered without adaptive step support still work with fixed steps
+    adaptive_kwargs = {} if convergence is None else dict(convergence=convergence)
+
+    results = get_sampler(sampler)(k_model, latents, sigmas, extra_args=sampler_kwargs, disable=False, callback=callback, **adaptive_kwargs)
 
     return results
@@ -0,0 +1,218 @@
+"""
+Offline TeaCache calibration from recorded traces.
+
+A trace is recorded by sampling with `TeaCacheContext(record_traces=True)`, which
+computes every step and stores, per block group and sample, the relative L1
+distance of the group's modulated input to the previous step (what TeaCache
+measures) and of the group's residual to the previous step (the error TeaCache
+makes by reusing it). From a set of traces this module fits the rescale
+polynomial that maps the first to the second, and picks for every TeaCache
+preset the largest threshold whose simulated error stays within its budget.
+
+Only numpy is needed, so calibration runs anywhere once traces are recorded.
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+DEFAULT_THRESHOLDS = np.round(np.linspace(0.01, 1.0, 100), 4).tolist()
+
+
+def read_traces(path):
+    traces = []
+    with open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                traces.append(json.loads(line))
+    return traces
+
+
+def write_traces(path, traces):
+    """Append traces to a JSONL file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'at', encoding='utf-8') as f:
+        for trace in traces:
+            f.write(json.dumps(trace) + '\n')
+
+
+def fit_rescale_polynomial(traces, degree=4):
+    """
+    Least-squares fit of output distance against input distance over all steps
+    of all traces. Returns the coefficients, highest power first, as used by
+    `np.poly1d` and `TeaCacheContext(rescale_coefficients=...)`.
+    """
+    x = np.concatenate([np.asarray(t['input_rel_l1'], dtype=np.float64) for t in traces])
+    y = np.concatenate([np.asarray(t['output_rel_l1'], dtype=np.float64) for t in traces])
+
+    mask = np.isfinite(x) & np.isfinite(y)
+    assert mask.sum() > degree, f'Need more than {degree} finite samples to fit a degree {degree} polynomial, got {mask.sum()}'
+
+    return np.polyfit(x[mask], y[mask], degree).tolist()
+
+
+def simulate_teacache(traces, coefficients, rel_l1_thresh):
+    """
+    Replay the TeaCache skip rule on recorded traces.
+
+    The first and last step of every run always compute. At a skipped step the
+    error is the true residual drift accumulated since the last computed step.
+
+    Returns:
+        Dict with the fraction of skipped steps and the mean (over all steps) and
+        max of the accumulated error
+    """
+    rescale_func = np.poly1d(coefficients)
+
+    total_steps = 0
+    skipped = 0
+    errors = []
+
+    for trace in traces:
+        num_steps = trace['num_steps']
+        total_steps += num_steps
+        errors.append(0.0)  # First step
+
+        accumulated = 0.0
+        error = 0.0
+
+        # Entry i is the distance between steps i and i + 1
+        for i, (x, y) in enumerate(zip(trace['input_rel_l1'], trace['output_rel_l1'])):
+            step = i + 1
+            accumulated += rescale_func(x)
+            error += y
+
+            if step == num_steps - 1 or accumulated >= rel_l1_thresh:
+                accumulated = 0.0
+                error = 0.0
+            else:
+                skipped += 1
+
+            errors.append(error)
+
+    errors = np.asarray(errors)
+    return dict(
+        rel_l1_thresh=rel_l1_thresh,
+        skip_ratio=skipped / max(total_steps, 1),
+        mean_error=float(errors.mean()) if len(errors) > 0 else 0.0,
+        max_error=float(errors.max()) if len(errors) > 0 else 0.0,
+    )
+
+
+def calibrate(traces, presets, max_errors, degree=4, thresholds=None):
+    """
+    Fit a rescale polynomial per TeaCache mode and a threshold per preset.
+
+    Args:
+        traces: Recorded traces, see `TeaCacheContext.traces`
+        presets: Dict of preset name -> settings with a "mode", e.g. config.TEACACHE_CONFIG
+        max_errors: Dict of preset name -> largest allowed mean error
+        degree: Degree of the rescale polynomial
+        thresholds: Candidate thresholds; default 0.01 to 1.0
+
+    Returns:
+        Dict with "modes" (coefficients and threshold sweep per mode) and
+        "presets" (chosen threshold, skip ratio and error per preset)
+    """
+    thresholds = DEFAULT_THRESHOLDS if thresholds is None else thresholds
+
+    modes = {}
+    for mode in sorted(set(t['mode'] for t in traces)):
+        mode_traces = [t for t in traces if t['mode'] == mode and len(t['input_rel_l1']) > 0]
+        coefficients = fit_rescale_polynomial(mode_traces, degree=degree)
+        modes[mode] = dict(
+            coefficients=coefficients,
+            num_traces=len(mode_traces),
+            sweep=[simulate_teacache(mode_traces, coefficients, t) for t in thresholds],
+        )
+
+    calibrated_presets = {}
+    for name, settings in presets.items():
+        mode = settings.get('mode', 'model')
+        if mode not in modes or name not in max_errors:
+            print(f'TeaCache preset {name}: no {mode} traces or error budget, not calibrated')
+            continue
+
+        sweep = modes[mode]['sweep']
+        within_budget = [row for row in sweep if row['mean_error'] <= max_errors[name]]
+        chosen = max(within_budget, key=lambda row: row['rel_l1_thresh']) if len(within_budget) > 0 else sweep[0]
+        calibrated_presets[name] = dict(mode=mode, error_budget=max_errors[name], **chosen)
+
+    return dict(modes=modes, presets=calibrated_presets)
+
+
+def save_calibration(path, calibration):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_calibration(path):
+    """Return the calibration stored at `path`, or None if there is none."""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f'Could not read TeaCache calibration {path}: {e}')
+        return None
+
+
+def is_calibrated(name, settings, calibration):
+    """Whether `calibration` covers TeaCache preset `name` in the mode of its `settings`."""
+    if calibration is None:
+        return False
+
+    preset = calibration.get('presets', {}).get(name, None)
+    mode = settings.get('mode', 'model')
+
+    return preset is not None and preset['mode'] == mode and mode in calibration.get('modes', {})
+
+
+def calibrated_settings(name, settings, calibration):
+    """
+    Apply a calibration to the settings of TeaCache preset `name`.
+
+    Returns:
+        (settings with the calibrated rel_l1_thresh, rescale coefficients or None)
+        The settings are returned unchanged if the calibration does not cover the
+        preset in its current mode.
+    """
+    if not is_calibrated(name, settings, calibration):
+        return settings, None
+
+    mode = settings.get('mode', 'model')
+    rel_l1_thresh = calibration['presets'][name]['rel_l1_thresh']
+    return dict(settings, rel_l1_thresh=rel_l1_thresh), calibration['modes'][mode]['coefficients']
+
+
+def preset_teacache(preset, teacache_config, calibration):
+    """
+    TeaCache switches (use_teacache, hand_optimization) of a PRESET_CONFIGS entry.
+
+    A preset with "calibrated_teacache" uses that TeaCache setting when the
+    calibration covers it; otherwise its "use_teacache" applies, with the standard
+    setting.
+    """
+    name = preset.get('calibrated_teacache', None)
+    if name is not None and is_calibrated(name, teacache_config[name], calibration):
+        return True, name == 'hand_optimized'
+    return preset['use_teacache'], False
+
+
+def format_calibration(calibration):
+    lines = []
+    for mode, fit in calibration['modes'].items():
+        coefficients = ', '.join(f'{c:.6e}' for c in fit['coefficients'])
+        lines.append(f'{mode}: {fit["num_traces"]} traces, rescale polynomial [{coefficients}]')
+    for name, preset in calibration['presets'].items():
+        lines.append(
+            f'{name} ({preset["mode"]}): rel_l1_thresh={preset["rel_l1_thresh"]}, '
+            f'skips {100.0 * preset["skip_ratio"]:.1f}% of steps, mean error {preset["mean_error"]:.4f} (budget {preset["error_budget"]})'
+        )
+    return '\n'.join(lines)
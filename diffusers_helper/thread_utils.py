@@ -1,39 +1,75 @@
-import time
+"""
+Thread helpers for running generation jobs next to the Gradio UI.
 
-from threading import Thread, Lock
+`async_run` hands a function to a single background listener thread and
+`AsyncStream` carries messages between that thread and the UI. Both wait on
+condition variables, so idle threads sleep until there is work instead of
+polling.
+"""
+
+from collections import deque
+from threading import Thread, Condition
 
 
 class Listener:
-    task_queue = []
-    lock = Lock()
+    task_queue = deque()
+    condition = Condition()
     thread = None
-    
+    stopping = False
+
     @classmethod
     def _process_tasks(cls):
         while True:
-            task = None
-            with cls.lock:
-                if cls.task_queue:
-                    task = cls.task_queue.pop(0)
-                    
-            if task is None:
-                time.sleep(0.001)
-                continue
-                
-            func, args, kwargs = task
+            with cls.condition:
+                while not cls.task_queue and not cls.stopping:
+                    cls.condition.wait()
+
+                if not cls.task_queue:
+                    # Stopping and every queued task is done
+                    return
+
+                func, args, kwargs = cls.task_queue.popleft()
+
             try:
                 func(*args, **kwargs)
             except Exception as e:
                 print(f"Error in listener thread: {e}")
-    
+
     @classmethod
     def add_task(cls, func, *args, **kwargs):
-        with cls.lock:
+        with cls.condition:
+            assert not cls.stopping, 'Listener is shutting down'
             cls.task_queue.append((func, args, kwargs))
 
-        if cls.thread is None:
-            cls.thread = Thread(target=cls._process_tasks, daemon=True)
-            cls.thread.start()
+            if cls.thread is None:
+                cls.thread = Thread(target=cls._process_tasks, daemon=True)
+                cls.thread.start()
+
+            cls.condition.notify()
+
+    @classmethod
+    def shutdown(cls, timeout=None):
+        """
+        Let the listener thread finish the queued tasks and exit.
+
+        Returns:
+            True if the thread has exited, False if it is still running after `timeout` seconds
+        """
+        with cls.condition:
+            thread = cls.thread
+            cls.stopping = True
+            cls.condition.notify_all()
+
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+
+        with cls.condition:
+            cls.thread = None
+            cls.stopping = False
+
+        return True
 
 
 def async_run(func, *args, **kwargs):
@@ -42,35 +78,54 @@ def async_run(func, *args, **kwargs):
 
 class FIFOQueue:
     def __init__(self):
-        self.queue = []
-        self.lock = Lock()
+        self.queue = deque()
+        self.condition = Condition()
+        self.closed = False
 
     def push(self, item):
-        with self.lock:
+        with self.condition:
+            if self.closed:
+                return
             self.queue.append(item)
+            self.condition.notify()
 
     def pop(self):
-        with self.lock:
+        with self.condition:
             if self.queue:
-                return self.queue.pop(0)
+                return self.queue.popleft()
             return None
 
     def top(self):
-        with self.lock:
+        with self.condition:
             if self.queue:
                 return self.queue[0]
             return None
 
-    def next(self):
-        while True:
-            with self.lock:
-                if self.queue:
-                    return self.queue.pop(0)
+    def next(self, timeout=None):
+        """
+        Remove and return the oldest item, waiting for one to be pushed.
 
-            time.sleep(0.001)
+        Returns None if `timeout` seconds pass first, or if the queue is closed
+        and empty.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.queue or self.closed, timeout)
+            if self.queue:
+                return self.queue.popleft()
+            return None
+
+    def close(self):
+        """Wake up every waiting `next` call; later pushes are dropped."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 
 class AsyncStream:
     def __init__(self):
         self.input_queue = FIFOQueue()
         self.output_queue = FIFOQueue()
+
+    def close(self):
+        self.input_queue.close()
+        self.output_queue.close()
@@ -263,7 +263,92 @@ def soft_append_bcthw(history, current, overlap=0):
     return output.to(history)
 
 
-def save_bcthw_as_mp4(x, output_filename, fps=10, crf=0):
+class FrameHistoryBuffer:
+    """
+    Growable uint8 store of decoded frames that is filled back to front, like
+    `history_pixels = soft_append_bcthw(current_pixels, history_pixels, overlap)`.
+
+    Frames are kept at the end of a preallocated tensor, so prepending a section
+    only writes the section: the linear crossfade is done in place on the
+    overlapped frames and the storage doubles when it runs out, making appends
+    O(section) amortized. Frames that are no longer needed (e.g. already encoded)
+    can be dropped from the tail with `release_tail`. Storing uint8 instead of
+    float32 in [-1, 1] takes 4x less memory.
+    """
+
+    def __init__(self):
+        self.storage = None
+        self.start = 0
+        self.end = 0
+        self.total_frames = 0  # Including released frames
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def frames(self):
+        """uint8 bcthw view of the frames held, in temporal order."""
+        return self.storage[:, :, self.start:self.end]
+
+    def _reserve_front(self, count):
+        if self.start >= count:
+            return
+
+        length = len(self)
+        capacity = self.storage.shape[2]
+        needed = length + count
+        frames = self.frames
+
+        if needed > capacity:
+            capacity = max(needed, 2 * capacity)
+            storage = self.storage.new_empty(self.storage.shape[:2] + (capacity,) + self.storage.shape[3:])
+        else:
+            # Released tail frames left room at the end; move the held frames there
+            storage = self.storage
+            frames = frames.clone()
+
+        storage[:, :, capacity - length:] = frames
+        self.storage = storage
+        self.start, self.end = capacity - length, capacity
+
+    def prepend(self, pixels, overlap=0):
+        """
+        Put `pixels` ([-1, 1] bcthw) before the held frames, crossfading its last
+        `overlap` frames into the first `overlap` held frames.
+        """
+        pixels = pixels.detach().cpu()
+        count = pixels.shape[2]
+
+        if self.storage is None:
+            b, c, t, h, w = pixels.shape
+            self.storage = torch.empty((b, c, 2 * count, h, w), dtype=torch.uint8)
+            self.start = self.end = 2 * count
+            overlap = 0
+
+        assert len(self) >= overlap, f"History length ({len(self)}) must be >= overlap ({overlap})"
+        assert count >= overlap, f"Current length ({count}) must be >= overlap ({overlap})"
+
+        if overlap > 0:
+            weights = torch.linspace(1, 0, overlap, dtype=torch.float32).view(1, 1, -1, 1, 1)
+            held = self.storage[:, :, self.start:self.start + overlap].float() / 127.5 - 1.0
+            blended = weights * pixels[:, :, count - overlap:].float() + (1 - weights) * held
+            self.storage[:, :, self.start:self.start + overlap] = (torch.clamp(blended, -1., 1.) * 127.5 + 127.5).to(torch.uint8)
+
+        added = count - overlap
+        self._reserve_front(added)
+        self.storage[:, :, self.start - added:self.start] = (torch.clamp(pixels[:, :, :added].float(), -1., 1.) * 127.5 + 127.5).to(torch.uint8)
+        self.start -= added
+        self.total_frames += added
+        return
+
+    def release_tail(self, count):
+        """Forget the last `count` frames held."""
+        self.end -= min(count, len(self))
+        return
+
+
+def bcthw_to_uint8_frames(x):
+    """Turn a [-1, 1] (or already uint8) bcthw video batch into uint8 thwc frames, laying the batch out as a grid."""
     b, c, t, h, w = x.shape
 
     per_row = b
@@ -272,10 +357,16 @@ def save_bcthw_as_mp4(x, output_filename, fps=10, crf=0):
             per_row = p
             break
 
-    os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
-    x = torch.clamp(x.float(), -1., 1.) * 127.5 + 127.5
+    if x.dtype != torch.uint8:
+        x = torch.clamp(x.float(), -1., 1.) * 127.5 + 127.5
     x = x.detach().cpu().to(torch.uint8)
     x = einops.rearrange(x, '(m n) c t h w -> t (m h) (n w) c', n=per_row)
+    return x
+
+
+def save_bcthw_as_mp4(x, output_filename, fps=10, crf=0):
+    os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
+    x = bcthw_to_uint8_frames(x)
     torchvision.io.write_video(output_filename, x, fps=fps, video_codec='libx264', options={'crf': str(int(crf))})
     return x
 
@@ -0,0 +1,124 @@
+"""
+Incremental MP4 writing for FramePack's inverted (back to front) sampling.
+
+Every section finalizes a run of frames that lies *before* everything finalized so
+far. `SegmentedMP4Writer` encodes each run once into its own libx264 segment, and
+produces the final or a partial video by remuxing the segments in temporal order.
+Remuxing copies packets without re-encoding, so total encode cost is proportional
+to the video length instead of sections x video length.
+"""
+
+import os
+import shutil
+import uuid
+
+import av
+import numpy as np
+
+
+class SegmentedMP4Writer:
+    def __init__(self, segment_dir, fps=30, crf=16):
+        """
+        Args:
+            segment_dir: Scratch directory for the segment files; removed by `finalize` and `close`
+            fps: Frame rate
+            crf: libx264 constant rate factor
+        """
+        self.segment_dir = segment_dir
+        self.fps = fps
+        self.crf = crf
+
+        self.segments = []  # Temporal order
+        self.frame_count = 0
+
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+    def prepend(self, frames):
+        """
+        Encode frames that come right before all frames written so far.
+
+        Args:
+            frames: uint8 frames of shape (t, h, w, c), numpy array or CPU tensor
+        """
+        self._encode_segment(frames, position=0)
+
+    def append(self, frames):
+        """Encode frames that come right after all frames written so far."""
+        self._encode_segment(frames, position=len(self.segments))
+
+    def _encode_segment(self, frames, position):
+        frames = np.ascontiguousarray(np.asarray(frames))
+        if frames.shape[0] == 0:
+            return
+
+        path = os.path.join(self.segment_dir, f'{uuid.uuid4().hex}.mp4')
+
+        container = av.open(path, mode='w')
+        try:
+            stream = container.add_stream('libx264', rate=self.fps)
+            stream.width = frames.shape[2]
+            stream.height = frames.shape[1]
+            stream.pix_fmt = 'yuv420p'
+            stream.options = {'crf': str(int(self.crf))}
+
+            for frame in frames:
+                for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format='rgb24')):
+                    container.mux(packet)
+
+            for packet in stream.encode():
+                container.mux(packet)
+        finally:
+            container.close()
+
+        self.segments.insert(position, path)
+        self.frame_count += frames.shape[0]
+
+    def _remux(self, output_filename):
+        tmp_filename = output_filename + '.tmp.mp4'
+        os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+
+        output = av.open(tmp_filename, mode='w')
+        try:
+            output_stream = None
+            offset = 0  # In the time base of the segments, which all share one encoder configuration
+
+            for path in self.segments:
+                with av.open(path) as segment:
+                    segment_stream = segment.streams.video[0]
+
+                    if output_stream is None:
+                        output_stream = output.add_stream_from_template(segment_stream)
+
+                    frame_duration = int(round(1 / (self.fps * segment_stream.time_base)))
+
+                    for packet in segment.demux(segment_stream):
+                        if packet.dts is None:
+                            continue  # Flush packet at the end of the segment
+                        packet.pts += offset
+                        packet.dts += offset
+                        packet.stream = output_stream
+                        output.mux(packet)
+
+                    offset += segment_stream.frames * frame_duration
+        finally:
+            output.close()
+
+        os.replace(tmp_filename, output_filename)
+        return output_filename
+
+    def publish(self, filename):
+        """Write the frames encoded so far to `filename` as a playable video, or return None if there are none."""
+        if len(self.segments) == 0:
+            return None
+        return self._remux(filename)
+
+    def finalize(self, output_filename):
+        """Write the final video to `output_filename` and remove the segments."""
+        self._remux(output_filename)
+        self.close()
+        return output_filename
+
+    def close(self):
+        """Remove the segments. Safe to call more than once."""
+        self.segments = []
+        shutil.rmtree(self.segment_dir, ignore_errors=True)
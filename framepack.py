@@ -0,0 +1,231 @@
+from diffusers_helper.hf_login import login
+
+import os
+from config import PRESET_CONFIGS, DEFAULT_UI_SETTINGS, TEACACHE_CONFIG, TEACACHE_CALIBRATION_CONFIG
+
+os.environ['HF_HOME'] = os.path.abspath(os.path.realpath(os.path.join(os.path.dirname(__file__), './hf_download')))
+
+# Set up paths
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+OUTPUTS_DIR = os.path.join(ROOT_DIR, 'outputs')
+
+import json
+import time
+import argparse
+import numpy as np
+
+from PIL import Image
+from diffusers_helper.utils import generate_timestamp
+
+
+# Job fields that can be set per line in the jobs file, with their defaults
+JOB_DEFAULTS = {
+    "prompt": "",
+    "n_prompt": "",
+    "seed": DEFAULT_UI_SETTINGS["seed"],
+    "num_variations": DEFAULT_UI_SETTINGS["num_variations"],
+    "total_second_length": DEFAULT_UI_SETTINGS["total_second_length"],
+    "latent_window_size": DEFAULT_UI_SETTINGS["latent_window_size"],
+    "steps": DEFAULT_UI_SETTINGS["steps"],
+    "cfg": DEFAULT_UI_SETTINGS["cfg"],
+    "gs": DEFAULT_UI_SETTINGS["gs"],
+    "rs": DEFAULT_UI_SETTINGS["rs"],
+    "gpu_memory_preservation": DEFAULT_UI_SETTINGS["gpu_memory_preservation"],
+    "use_teacache": DEFAULT_UI_SETTINGS["use_teacache"],
+    "hand_optimization": DEFAULT_UI_SETTINGS["hand_optimization"],
+    "flow_preset": DEFAULT_UI_SETTINGS["flow_preset"],
+    "mp4_crf": DEFAULT_UI_SETTINGS["mp4_crf"],
+    "sampler": None,  # None: SAMPLING_CONFIG["sampler"]
+    "adaptive_steps": None,  # None: ADAPTIVE_STEPS_CONFIG["mode"]
+}
+
+
+def read_jobs(jobs_path):
+    """
+    Read a JSONL jobs file.
+
+    Every line is a JSON object with an "image" path (relative paths are resolved
+    against the jobs file) and any of the fields in JOB_DEFAULTS. A "preset" name
+    from config.PRESET_CONFIGS can be given to fill in the preset's settings;
+    explicit fields on the line still take precedence.
+    """
+    from diffusers_helper.teacache_calibration import load_calibration, preset_teacache
+
+    jobs = []
+    base_dir = os.path.dirname(os.path.abspath(jobs_path))
+    # Presets with "calibrated_teacache" only use TeaCache once it is calibrated
+    calibration = load_calibration(TEACACHE_CALIBRATION_CONFIG['file'])
+
+    with open(jobs_path, 'rt', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            spec = json.loads(line)
+
+            if 'image' not in spec:
+                raise ValueError(f'{jobs_path}:{line_number}: job has no "image" field')
+
+            job = dict(JOB_DEFAULTS)
+
+            preset_name = spec.get('preset', None)
+            if preset_name is not None:
+                if preset_name not in PRESET_CONFIGS:
+                    raise ValueError(f'{jobs_path}:{line_number}: unknown preset "{preset_name}"')
+                preset = PRESET_CONFIGS[preset_name]
+                job.update({k: v for k, v in preset.items() if k in JOB_DEFAULTS and (k != 'prompt' or v)})
+                job['use_teacache'], job['hand_optimization'] = preset_teacache(preset, TEACACHE_CONFIG, calibration)
+
+            job.update({k: v for k, v in spec.items() if k in JOB_DEFAULTS})
+            job['image'] = os.path.join(base_dir, spec['image'])
+            job['id'] = str(spec.get('id', line_number))
+            jobs.append(job)
+
+    return jobs
+
+
+def run(args):
+    jobs = read_jobs(args.jobs)
+    print(f'Loaded {len(jobs)} jobs from {args.jobs}')
+
+    if len(jobs) == 0:
+        return
+
+    from diffusers_helper.pipelines.image_to_video import load_models, generate_video
+
+    outputs_dir = os.path.abspath(args.outputs)
+    os.makedirs(outputs_dir, exist_ok=True)
+
+    models = load_models(high_vram=args.high_vram)
+
+    # Encode every distinct prompt of the queue up front so the text encoders are loaded once
+    queue_prompts = [job['prompt'] for job in jobs] + [job['n_prompt'] for job in jobs if float(job['cfg']) != 1]
+    queue_prompts = list(dict.fromkeys(queue_prompts))
+    print(f'Encoding {len(queue_prompts)} distinct prompts')
+    models.encode_prompts(queue_prompts)
+    models.unload_all()
+
+    results_file = open(args.results, 'at', encoding='utf-8') if args.results else None
+
+    run_start = time.perf_counter()
+    succeeded = 0
+
+    try:
+        for job_index, job in enumerate(jobs):
+            print(f'[{job_index + 1}/{len(jobs)}] Job {job["id"]}: {job["image"]}')
+
+            job_start = time.perf_counter()
+            input_image = np.array(Image.open(job['image']).convert('RGB'))
+
+            output_filename = generate_video(
+                models, input_image, job['prompt'], job['n_prompt'], int(job['seed']), float(job['total_second_length']),
+                int(job['latent_window_size']), int(job['steps']), float(job['cfg']), float(job['gs']), float(job['rs']),
+                float(job['gpu_memory_preservation']), bool(job['use_teacache']), bool(job['hand_optimization']),
+                job['flow_preset'], int(job['mp4_crf']),
+                outputs_dir=outputs_dir, job_id=f'{generate_timestamp()}_{job["id"]}', num_variations=int(job['num_variations']),
+                sampler=job['sampler'], adaptive_steps=job['adaptive_steps'],
+            )
+
+            elapsed = time.perf_counter() - job_start
+
+            if output_filename is not None:
+                succeeded += 1
+
+            print(f'Job {job["id"]} finished in {elapsed:.1f}s: {output_filename}')
+
+            if results_file is not None:
+                results_file.write(json.dumps({'id': job['id'], 'output': output_filename, 'seconds': round(elapsed, 3)}) + '\n')
+                results_file.flush()
+    finally:
+        if results_file is not None:
+            results_file.close()
+
+    total_elapsed = time.perf_counter() - run_start
+    print(f'Finished {succeeded}/{len(jobs)} jobs in {total_elapsed:.1f}s ({3600.0 * succeeded / total_elapsed:.1f} jobs/hour)')
+
+    if models.residency is not None:
+        print(f'Model residency: {models.residency.stats()}')
+
+
+def record_teacache(args):
+    jobs = read_jobs(args.jobs)
+    print(f'Recording TeaCache traces for {len(jobs)} jobs at {args.steps} steps')
+
+    if len(jobs) == 0:
+        return
+
+    from diffusers_helper.pipelines.image_to_video import load_models, generate_video
+    from diffusers_helper.teacache_calibration import write_traces
+
+    outputs_dir = os.path.abspath(args.outputs)
+    os.makedirs(outputs_dir, exist_ok=True)
+
+    models = load_models(high_vram=args.high_vram)
+
+    for job in jobs:
+        input_image = np.array(Image.open(job['image']).convert('RGB'))
+
+        for steps in args.steps:
+            # Standard settings record the whole-model mode, hand optimization the block-level mode
+            for hand_optimization in (False, True):
+                traces = []
+
+                generate_video(
+                    models, input_image, job['prompt'], job['n_prompt'], int(job['seed']), float(job['total_second_length']),
+                    int(job['latent_window_size']), int(steps), float(job['cfg']), float(job['gs']), float(job['rs']),
+                    float(job['gpu_memory_preservation']), True, hand_optimization, job['flow_preset'], int(job['mp4_crf']),
+                    outputs_dir=outputs_dir, job_id=f'{generate_timestamp()}_{job["id"]}_teacache', num_variations=int(job['num_variations']),
+                    teacache_traces=traces,
+                )
+
+                for trace in traces:
+                    trace['job'] = job['id']
+
+                write_traces(args.traces, traces)
+                print(f'Job {job["id"]}, {steps} steps, hand_optimization={hand_optimization}: {len(traces)} traces')
+
+
+def calibrate_teacache(args):
+    from diffusers_helper.teacache_calibration import read_traces, calibrate, save_calibration, format_calibration
+
+    traces = read_traces(args.traces)
+    print(f'Loaded {len(traces)} traces from {args.traces}')
+
+    calibration = calibrate(traces, TEACACHE_CONFIG, TEACACHE_CALIBRATION_CONFIG['max_error'], degree=TEACACHE_CALIBRATION_CONFIG['degree'])
+    save_calibration(args.output, calibration)
+
+    print(format_calibration(calibration))
+    print(f'Saved TeaCache calibration to {args.output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FramePack headless runner')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a batch of image-to-video jobs with models loaded once')
+    run_parser.add_argument('--jobs', type=str, required=True, help='JSONL file with one job per line')
+    run_parser.add_argument('--outputs', type=str, default=OUTPUTS_DIR, help='Directory for generated videos')
+    run_parser.add_argument('--results', type=str, default=None, help='Optional JSONL file to append per-job results to')
+    run_parser.add_argument('--high-vram', dest='high_vram', action='store_true', default=None, help='Force high-VRAM mode (keep all models on GPU)')
+    run_parser.set_defaults(func=run)
+
+    record_parser = subparsers.add_parser('record-teacache', help='Record TeaCache calibration traces by running jobs without skipping steps')
+    record_parser.add_argument('--jobs', type=str, required=True, help='JSONL file with one job per line')
+    record_parser.add_argument('--traces', type=str, required=True, help='JSONL file to append the traces to')
+    record_parser.add_argument('--steps', type=int, nargs='+', default=TEACACHE_CALIBRATION_CONFIG['trace_steps'], help='Step counts to record every job with')
+    record_parser.add_argument('--outputs', type=str, default=OUTPUTS_DIR, help='Directory for generated videos')
+    record_parser.add_argument('--high-vram', dest='high_vram', action='store_true', default=None, help='Force high-VRAM mode (keep all models on GPU)')
+    record_parser.set_defaults(func=record_teacache)
+
+    calibrate_parser = subparsers.add_parser('calibrate-teacache', help='Fit the TeaCache rescale polynomial and per-preset thresholds from recorded traces')
+    calibrate_parser.add_argument('--traces', type=str, required=True, help='JSONL file written by record-teacache')
+    calibrate_parser.add_argument('--output', type=str, default=TEACACHE_CALIBRATION_CONFIG['file'], help='Calibration file, read by generate_video when present')
+    calibrate_parser.set_defaults(func=calibrate_teacache)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Benchmark the flow-matching samplers for quality versus step count.
+
+Runs every sampler through `sample_hunyuan` on a tiny randomly initialized
+packed HunyuanVideo transformer, so it needs no model download and runs on CPU.
+Quality is the relative L2 distance to a high-step UniPC reference; NFE is the
+number of transformer calls. A random model only shows how fast each solver
+converges, not how good the videos look.
+
+Usage: python scripts/benchmark_samplers.py [--steps 4 8 12 16 25] [--samplers euler dpmpp_2m ...]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModelPacked
+from diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
+from diffusers_helper.k_diffusion.samplers import SAMPLERS
+
+
+def make_tiny_transformer(seed):
+    torch.manual_seed(seed)
+    transformer = HunyuanVideoTransformer3DModelPacked(
+        num_attention_heads=2, attention_head_dim=16, num_layers=2, num_single_layers=2, num_refiner_layers=1,
+        text_embed_dim=32, pooled_projection_dim=8, rope_axes_dim=(4, 6, 6),
+        has_image_proj=True, image_proj_dim=12, has_clean_x_embedder=True,
+    )
+    return transformer.eval()
+
+
+def make_conditioning(seed, device):
+    g = torch.Generator().manual_seed(seed)
+    indices = torch.arange(0, 1 + 3 + 1 + 2 + 16).unsqueeze(0)
+    clean_latent_indices_pre, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([1, 3, 1, 2, 16], dim=1)
+
+    conditioning = dict(
+        prompt_embeds=torch.randn(1, 10, 32, generator=g),
+        prompt_embeds_mask=torch.ones(1, 10, dtype=torch.bool),
+        prompt_poolers=torch.randn(1, 8, generator=g),
+        image_embeddings=torch.randn(1, 5, 12, generator=g),
+        latent_indices=latent_indices,
+        clean_latents=torch.randn(1, 16, 2, 8, 8, generator=g),
+        clean_latent_indices=torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1),
+        clean_latents_2x=torch.randn(1, 16, 2, 8, 8, generator=g),
+        clean_latent_2x_indices=clean_latent_2x_indices,
+        clean_latents_4x=torch.randn(1, 16, 16, 8, 8, generator=g),
+        clean_latent_4x_indices=clean_latent_4x_indices,
+    )
+
+    conditioning = {k: v.to(device) for k, v in conditioning.items()}
+    conditioning.update(
+        negative_prompt_embeds=conditioning['prompt_embeds'],
+        negative_prompt_embeds_mask=conditioning['prompt_embeds_mask'],
+        negative_prompt_poolers=conditioning['prompt_poolers'],
+    )
+    return conditioning
+
+
+def run_sampler(transformer, conditioning, sampler, steps, seed, device):
+    calls = [0]
+    hook = transformer.register_forward_pre_hook(lambda module, args: calls.__setitem__(0, calls[0] + 1))
+
+    try:
+        start = time.perf_counter()
+        latents = sample_hunyuan(
+            transformer=transformer,
+            sampler=sampler,
+            width=64,
+            height=64,
+            frames=9,
+            real_guidance_scale=1.0,
+            distilled_guidance_scale=10.0,
+            num_inference_steps=steps,
+            generator=torch.Generator('cpu').manual_seed(seed),
+            device=device,
+            dtype=torch.float32,
+            **conditioning,
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        hook.remove()
+
+    return latents.float(), calls[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark flow-matching samplers on a tiny random transformer')
+    parser.add_argument('--steps', type=int, nargs='+', default=[4, 8, 12, 16, 25], help='Step counts to benchmark')
+    parser.add_argument('--samplers', type=str, nargs='+', default=list(SAMPLERS.keys()), help='Samplers to benchmark')
+    parser.add_argument('--reference-steps', type=int, default=100, help='UniPC steps of the reference result')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    transformer = make_tiny_transformer(args.seed).to(device)
+    conditioning = make_conditioning(args.seed + 1, device)
+
+    reference, _, _ = run_sampler(transformer, conditioning, 'unipc', args.reference_steps, args.seed, device)
+
+    rows = []
+    for sampler in args.samplers:
+        for steps in args.steps:
+            latents, nfe, elapsed = run_sampler(transformer, conditioning, sampler, steps, args.seed, device)
+            error = ((latents - reference).norm() / reference.norm()).item()
+            rows.append((sampler, steps, nfe, error, elapsed))
+
+    print(f'\nRelative L2 error against {args.reference_steps}-step UniPC\n')
+    print(f'{"sampler":<12}{"steps":>7}{"NFE":>7}{"rel. error":>14}{"seconds":>10}')
+    for sampler, steps, nfe, error, elapsed in rows:
+        print(f'{sampler:<12}{steps:>7}{nfe:>7}{error:>14.6f}{elapsed:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the repo's modules the same way demo_gradio.py and framepack.py do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,83 @@
+import torch
+import torch.nn.functional as F
+
+from diffusers_helper.models import attention_backends
+from diffusers_helper.models.attention_backends import _sdpa_varlen, benchmark_attention_backends, AttentionBackend
+from diffusers_helper.models.hunyuan_video_packed import get_cu_seqlens
+
+
+def per_segment_reference(q, k, v, cu_seqlens):
+    # Plain SDPA over each segment of the flattened tokens, one (1, heads, len, dim) call each
+    q, k, v = (x.reshape(-1, *x.shape[2:]) for x in (q, k, v))
+    out = torch.zeros_like(q)
+    bounds = cu_seqlens.tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end > start:
+            segment = [x[start:end].transpose(0, 1)[None] for x in (q, k, v)]
+            out[start:end] = F.scaled_dot_product_attention(*segment)[0].transpose(0, 1)
+    return out
+
+
+def make_inputs(text_lens, img_len=24, max_text=8, heads=2, dim=16, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batch_size = len(text_lens)
+    seq_len = img_len + max_text
+    q, k, v = (torch.randn(batch_size, seq_len, heads, dim, generator=generator) for _ in range(3))
+    text_mask = torch.arange(max_text)[None, :] < torch.tensor(text_lens)[:, None]
+    cu_seqlens = get_cu_seqlens(text_mask, img_len)
+    return q, k, v, cu_seqlens, seq_len
+
+
+def test_sdpa_varlen_matches_per_segment_sdpa():
+    q, k, v, cu_seqlens, seq_len = make_inputs([3, 8, 0])
+
+    out = _sdpa_varlen(q, k, v, cu_seqlens, cu_seqlens, seq_len, seq_len)
+    expected = per_segment_reference(q, k, v, cu_seqlens).view(q.shape)
+
+    assert out.shape == q.shape
+    assert torch.allclose(out, expected, atol=1e-6)
+
+
+def test_sdpa_varlen_matches_masked_sdpa():
+    q, k, v, cu_seqlens, seq_len = make_inputs([5, 2], seed=1)
+
+    positions = torch.arange(q.shape[0] * seq_len)
+    segments = torch.bucketize(positions, cu_seqlens[1:].long(), right=True).view(q.shape[0], seq_len)
+    mask = (segments[:, :, None] == segments[:, None, :]).unsqueeze(1)
+    expected = F.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=mask).transpose(1, 2)
+
+    out = _sdpa_varlen(q, k, v, cu_seqlens, cu_seqlens, seq_len, seq_len)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+
+def test_attention_dispatches_to_sdpa_varlen():
+    q, k, v, cu_seqlens, seq_len = make_inputs([4, 6], seed=2)
+
+    previous = attention_backends.selected_backend
+    attention_backends.set_attention_backend('sdpa')
+    try:
+        out = attention_backends.attention(q, k, v, cu_seqlens, cu_seqlens, seq_len, seq_len)
+    finally:
+        attention_backends.selected_backend = previous
+
+    assert torch.allclose(out, per_segment_reference(q, k, v, cu_seqlens).view(q.shape), atol=1e-6)
+
+
+def test_benchmark_falls_back_when_every_backend_fails(monkeypatch):
+    q, k, v, cu_seqlens, seq_len = make_inputs([4, 6], seed=3)
+    calls = [0]
+
+    def sdpa_once(*args):
+        # The reference call succeeds, the timed calls fail
+        calls[0] += 1
+        if calls[0] > 1:
+            raise RuntimeError('kernel failed')
+        return _sdpa_varlen(*args)
+
+    def broken(*args):
+        raise RuntimeError('kernel failed')
+
+    backends = {'sdpa': AttentionBackend('sdpa', varlen=sdpa_once), 'broken': AttentionBackend('broken', varlen=broken)}
+    monkeypatch.setattr(attention_backends, 'ATTENTION_BACKENDS', backends)
+
+    assert benchmark_attention_backends(q, k, v, (cu_seqlens, cu_seqlens, seq_len, seq_len)) == 'sdpa'
@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+pytest.importorskip('diffusers')
+
+from diffusers_helper.k_diffusion.wrapper import fm_wrapper
+from diffusers_helper.models.hunyuan_video_packed import TeaCacheContext, TeaCacheBlockGroup
+
+
+GROUP_BYTES = 1024 ** 3 // 4
+
+
+class FakeTransformer:
+    """Caches one residual per group like block-mode TeaCache; the fused 2B batch cannot run."""
+
+    def __init__(self, num_groups=4):
+        self.num_groups = num_groups
+        self.calls = []
+
+    def __call__(self, hidden_states, timestep, return_dict, teacache, **kwargs):
+        self.calls.append(hidden_states.shape[0])
+
+        if teacache.groups is None:
+            teacache.groups = [TeaCacheBlockGroup(i, i + 1) for i in range(self.num_groups)]
+            num_cacheable = teacache.context.reserve_residuals(teacache, GROUP_BYTES, self.num_groups)
+            for group in teacache.groups[num_cacheable:]:
+                group.cacheable = False
+
+        for group in teacache.groups:
+            if group.cacheable:
+                group.previous_residual = torch.zeros_like(hidden_states)
+
+        if hidden_states.shape[0] == 4:
+            raise NotImplementedError('No varlen attention backend')
+
+        teacache.cnt += 1
+        return (torch.zeros_like(hidden_states),)
+
+
+def test_fallback_discards_fused_branch_and_its_budget():
+    transformer = FakeTransformer()
+    context = TeaCacheContext(num_steps=10, mode='blocks', residual_budget_gb=1.0)
+    k_model = fm_wrapper(transformer)
+
+    x = torch.randn(2, 4, 3)
+    extra_args = dict(
+        dtype=torch.float32, cfg_scale=5.0, cfg_rescale=0.0, concat_latent=None, cfg_batching=True, teacache=context,
+        positive=dict(encoder_hidden_states=torch.randn(2, 5)), negative=dict(encoder_hidden_states=torch.randn(2, 5)),
+    )
+
+    k_model(x, torch.full((2,), 0.5), **extra_args)
+
+    assert transformer.calls == [4, 2, 2]
+    assert 'cfg_batch' not in context.branches
+    assert set(context.branches) == {'positive', 'negative'}
+    assert all(state in context.branches.values() for state in context.reserved_bytes)
+    # The positive branch gets the whole budget, not what the dead fused branch left
+    assert sum(group.cacheable for group in context.branches['positive'].groups) == 4
+
+    k_model(x, torch.full((2,), 0.4), **extra_args)
+    assert transformer.calls == [4, 2, 2, 2, 2]
+
+
+def test_discard_branch_frees_residuals():
+    context = TeaCacheContext(mode='blocks', residual_budget_gb=1.0)
+    state = context.branch('cfg_batch', start_step=3)
+    state.groups = [TeaCacheBlockGroup(0, 1)]
+    state.groups[0].previous_residual = torch.zeros(4)
+    context.reserve_residuals(state, GROUP_BYTES, 1)
+
+    assert context.discard_branch('cfg_batch') is state
+    assert state.cnt == 3
+    assert state.groups[0].previous_residual is None
+    assert not context.branches and not context.reserved_bytes
+    assert context.discard_branch('cfg_batch') is None
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from diffusers_helper.models.hunyuan_video_packed import get_cu_seqlens
+
+
+def get_cu_seqlens_loop(text_mask, img_len):
+    # The per-element loop get_cu_seqlens replaced, on the mask's device instead of "cuda"
+    batch_size = text_mask.shape[0]
+    text_len = text_mask.sum(dim=1)
+    max_len = text_mask.shape[1] + img_len
+
+    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device=text_mask.device)
+
+    for i in range(batch_size):
+        s = text_len[i] + img_len
+        s1 = i * max_len + s
+        s2 = (i + 1) * max_len
+        cu_seqlens[2 * i + 1] = s1
+        cu_seqlens[2 * i + 2] = s2
+
+    return cu_seqlens
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 5])
+@pytest.mark.parametrize('img_len', [0, 7, 1536])
+def test_matches_loop(batch_size, img_len):
+    generator = torch.Generator().manual_seed(batch_size * 100 + img_len)
+    text_len = torch.randint(0, 33, (batch_size,), generator=generator)
+    text_mask = torch.arange(32)[None, :] < text_len[:, None]
+
+    expected = get_cu_seqlens_loop(text_mask, img_len)
+    cu_seqlens = get_cu_seqlens(text_mask, img_len)
+
+    assert cu_seqlens.dtype == torch.int32
+    assert cu_seqlens.device == text_mask.device
+    assert torch.equal(cu_seqlens, expected)
+
+
+def test_full_and_empty_text():
+    text_mask = torch.tensor([[True] * 4, [False] * 4])
+    assert get_cu_seqlens(text_mask, 10).tolist() == [0, 14, 14, 24, 28]
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+pytest.importorskip('diffusers')
+
+from diffusers_helper.embedding_cache import model_fingerprint
+
+
+def test_fingerprint_covers_every_weight():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 8)).to(torch.bfloat16)
+    copy = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 8)).to(torch.bfloat16)
+    copy.load_state_dict(model.state_dict())
+
+    assert model_fingerprint(copy) == model_fingerprint(model)
+
+    # A change at a single position, like a merged LoRA touching few weights, gives a new fingerprint
+    for index in range(0, 64 * 64, 397):
+        edited = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 8)).to(torch.bfloat16)
+        edited.load_state_dict(model.state_dict())
+        with torch.no_grad():
+            edited[0].weight.view(-1)[index] += 1
+        assert model_fingerprint(edited) != model_fingerprint(model)
+
@@ -0,0 +1,73 @@
+import torch
+
+from diffusers_helper.utils import FrameHistoryBuffer, soft_append_bcthw
+
+
+def to_uint8(pixels):
+    return (torch.clamp(pixels.float(), -1., 1.) * 127.5 + 127.5).to(torch.uint8)
+
+
+def random_sections(counts, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.rand(2, 3, count, 4, 5, generator=generator) * 2 - 1 for count in counts]
+
+
+def test_prepend_matches_soft_append():
+    overlap = 3
+    sections = random_sections([9, 8, 8, 12, 7])
+
+    buffer = FrameHistoryBuffer()
+    history_pixels = None
+    for pixels in sections:
+        if history_pixels is None:
+            history_pixels = pixels
+            buffer.prepend(pixels)
+        else:
+            history_pixels = soft_append_bcthw(pixels, history_pixels, overlap)
+            buffer.prepend(pixels, overlap)
+
+    assert len(buffer) == history_pixels.shape[2]
+    assert buffer.total_frames == history_pixels.shape[2]
+    assert buffer.frames.dtype == torch.uint8
+    # Held frames are blended after rounding to uint8, which can move them by one level
+    assert (buffer.frames.int() - to_uint8(history_pixels).int()).abs().max() <= 1
+
+
+def test_prepend_without_overlap_is_exact():
+    sections = random_sections([5, 1, 6], seed=1)
+
+    buffer = FrameHistoryBuffer()
+    history_pixels = None
+    for pixels in sections:
+        history_pixels = pixels if history_pixels is None else soft_append_bcthw(pixels, history_pixels, 0)
+        buffer.prepend(pixels)
+
+    assert torch.equal(buffer.frames, to_uint8(history_pixels))
+
+
+def test_release_tail_keeps_front_frames_and_total():
+    overlap = 2
+    sections = random_sections([6, 6, 6, 6], seed=2)
+
+    buffer = FrameHistoryBuffer()
+    history_pixels = None
+    released = 0
+    for pixels in sections:
+        if history_pixels is None:
+            history_pixels = pixels
+            buffer.prepend(pixels)
+        else:
+            history_pixels = soft_append_bcthw(pixels, history_pixels, overlap)
+            buffer.prepend(pixels, overlap)
+
+        # Like the encoder loop: everything after the first overlap frames is final
+        final = len(buffer) - overlap
+        buffer.release_tail(final)
+        released += final
+
+        assert len(buffer) == overlap
+        assert buffer.total_frames == history_pixels.shape[2]
+        expected = to_uint8(history_pixels[:, :, :overlap])
+        assert (buffer.frames.int() - expected.int()).abs().max() <= 1
+
+    assert released + len(buffer) == history_pixels.shape[2]
@@ -0,0 +1,99 @@
+import pytest
+import torch
+
+from diffusers_helper.memory import ModelResidencyManager, FakeDeviceMemoryAccountant, ResidencyPlanner
+
+
+class Blob(torch.nn.Module):
+    def __init__(self, num_floats):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(num_floats))
+
+
+MB = 1024 ** 2
+FLOATS_PER_MB = MB // 4
+
+
+def make_models():
+    return Blob(FLOATS_PER_MB), Blob(FLOATS_PER_MB), Blob(FLOATS_PER_MB)
+
+
+def test_lru_eviction_and_counters():
+    a, b, c = make_models()
+    accountant = FakeDeviceMemoryAccountant(total_bytes=100 * MB)
+    manager = ModelResidencyManager(budget_bytes=2 * MB, accountant=accountant)
+
+    manager.load(a)
+    manager.load(b)
+    manager.load(a)  # Hit; b is now the least recently used
+    manager.load(c)
+
+    assert manager.is_resident(a) and manager.is_resident(c) and not manager.is_resident(b)
+    assert accountant.used_bytes == 2 * MB
+
+    stats = manager.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1)
+    assert stats['bytes_loaded'] == 3 * MB
+    assert stats['bytes_evicted'] == MB
+    assert stats['resident_bytes'] == 2 * MB
+
+    manager.unload_all()
+    assert accountant.used_bytes == 0
+    assert manager.resident_bytes == 0
+
+
+def test_evicts_for_device_memory_within_budget():
+    a, b, _ = make_models()
+    # The budget would hold both models, but something else holds most of the device
+    accountant = FakeDeviceMemoryAccountant(total_bytes=3 * MB, reserved_bytes=int(1.5 * MB))
+    manager = ModelResidencyManager(budget_bytes=10 * MB, accountant=accountant)
+
+    manager.load(a)
+    manager.load(b)
+
+    assert manager.is_resident(b) and not manager.is_resident(a)
+    assert manager.evictions == 1
+
+
+def test_model_larger_than_budget_is_loaded_until_next_load():
+    a, b, _ = make_models()
+    big = Blob(3 * FLOATS_PER_MB)
+    accountant = FakeDeviceMemoryAccountant(total_bytes=100 * MB)
+    manager = ModelResidencyManager(budget_bytes=2 * MB, accountant=accountant)
+
+    manager.load(a)
+    manager.load(big)
+    assert manager.is_resident(big) and not manager.is_resident(a)
+
+    manager.load(b)
+    assert manager.is_resident(b) and not manager.is_resident(big)
+    assert accountant.used_bytes == MB
+
+
+def test_out_of_memory_after_evicting_everything():
+    a, _, _ = make_models()
+    big = Blob(3 * FLOATS_PER_MB)
+    accountant = FakeDeviceMemoryAccountant(total_bytes=2 * MB)
+    manager = ModelResidencyManager(budget_bytes=10 * MB, accountant=accountant)
+
+    manager.load(a)
+
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        manager.load(big)
+
+    # The resident model was evicted to make room, and the failed model is not tracked as resident
+    assert not manager.is_resident(a) and not manager.is_resident(big)
+    assert accountant.used_bytes == 0
+
+
+def test_planner_on_cpu_device_needs_no_cuda():
+    model = torch.nn.Module()
+    model.blocks = torch.nn.ModuleList([Blob(FLOATS_PER_MB) for _ in range(3)])
+    planner = ResidencyPlanner(model, device='cpu', vram_budget_gb=2 / 1024)
+
+    plan = planner.plan('key', default_activation_gb=0)
+    assert plan.resident == [0, 1]
+    planner.apply(plan)
+    planner.offload(preserved_memory_gb=8)
+
+    assert all(p.device.type == 'cpu' for p in model.parameters())
@@ -0,0 +1,103 @@
+import torch
+
+from diffusers_helper.memory import PinnedSwapEngine, PinnedSwapInstaller
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self, num_blocks=4, dim=8):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(dim, dim)
+        self.blocks = torch.nn.ModuleList([torch.nn.Linear(dim, dim) for _ in range(num_blocks)])
+
+    def forward(self, x, skip=()):
+        x = self.proj_in(x)
+        for index, block in enumerate(self.blocks):
+            if index not in skip:
+                x = torch.relu(block(x))
+        return x
+
+
+def block_bytes(model):
+    return sum(p.nelement() * p.element_size() for p in model.blocks[0].parameters())
+
+
+def test_engine_splits_blocks_by_budget_and_matches_forward():
+    torch.manual_seed(0)
+    model = ToyModel()
+    x = torch.randn(2, 8)
+    expected = model(x)
+
+    engine = PinnedSwapEngine(model, device='cpu', gpu_budget_bytes=block_bytes(model), prefetch_blocks=1)
+
+    assert engine.resident == [0]
+    assert engine.streamed == [1, 2, 3]
+
+    for _ in range(2):
+        assert torch.allclose(model(x), expected)
+
+    # Every streamed block is uploaded once per forward; the last one prefetches the first for the next forward
+    assert engine.upload_count == 3 * 2 + 1
+    assert engine.bytes_uploaded == engine.upload_count * block_bytes(model)
+
+
+def test_skipped_blocks_release_their_prefetched_copies():
+    torch.manual_seed(0)
+    model = ToyModel(num_blocks=8)
+    x = torch.randn(2, 8)
+
+    skips = [(1, 2), (3, 4, 5), (1, 2, 6, 7), (0, 5)]
+    expected = [model(x, skip=skip) for skip in skips]
+
+    engine = PinnedSwapEngine(model, device='cpu', gpu_budget_bytes=0, prefetch_blocks=2)
+
+    held = []
+    for block in model.blocks:
+        block.register_forward_hook(lambda module, args, output: held.append(len(engine.uploads)))
+
+    # Like TeaCache skipping block groups: prefetched blocks that never run must not pile up
+    for skip, expected_output in zip(skips, expected):
+        assert torch.allclose(model(x, skip=skip), expected_output)
+        assert len(engine.uploads) <= 2
+        assert not engine.swapped_in
+
+    assert max(held) <= 2
+
+
+def test_installer_install_forward_uninstall():
+    torch.manual_seed(0)
+    model = ToyModel()
+    x = torch.randn(2, 8)
+    expected = model(x)
+
+    PinnedSwapInstaller.install_model(model, device='cpu', gpu_budget_gb=0)
+    assert PinnedSwapInstaller.is_installed(model)
+    assert torch.allclose(model(x), expected)
+
+    PinnedSwapInstaller.uninstall_model(model)
+    assert not PinnedSwapInstaller.is_installed(model)
+    assert all(len(block._forward_pre_hooks) == 0 and len(block._forward_hooks) == 0 for block in model.blocks)
+    assert all(p.device.type == 'cpu' for p in model.parameters())
+    assert torch.allclose(model(x), expected)
+
+
+def test_uninstall_after_interrupted_forward_restores_weights():
+    torch.manual_seed(0)
+    model = ToyModel()
+    x = torch.randn(2, 8)
+    expected = model(x)
+
+    PinnedSwapInstaller.install_model(model, device='cpu', gpu_budget_gb=0)
+
+    def fail(module, args):
+        raise KeyboardInterrupt('User ends the task.')
+
+    # The pre-hook of block 2 has swapped its weights in when block 2 raises
+    handle = model.blocks[2].register_forward_pre_hook(fail)
+    try:
+        model(x)
+    except KeyboardInterrupt:
+        pass
+    handle.remove()
+
+    PinnedSwapInstaller.uninstall_model(model)
+    assert torch.allclose(model(x), expected)
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from diffusers_helper.teacache_calibration import (
+    read_traces, write_traces, fit_rescale_polynomial, simulate_teacache, calibrate,
+    save_calibration, load_calibration, calibrated_settings, preset_teacache,
+)
+
+
+def synthetic_traces(mode='model', num_traces=4, num_steps=10, seed=0):
+    # Output drift is an exact quadratic of the input drift
+    rng = np.random.default_rng(seed)
+    traces = []
+    for _ in range(num_traces):
+        x = rng.uniform(0.01, 0.3, num_steps - 1)
+        traces.append(dict(mode=mode, num_steps=num_steps, branch='positive', group=0,
+                           input_rel_l1=x.tolist(), output_rel_l1=(0.5 * x ** 2 + 2 * x).tolist()))
+    return traces
+
+
+def test_fit_recovers_polynomial():
+    coefficients = fit_rescale_polynomial(synthetic_traces(), degree=2)
+    assert np.allclose(coefficients, [0.5, 2.0, 0.0], atol=1e-8)
+
+
+def test_simulate_extremes():
+    traces = synthetic_traces(num_traces=3, num_steps=10)
+    coefficients = [1.0, 0.0]
+
+    never = simulate_teacache(traces, coefficients, rel_l1_thresh=0.0)
+    assert never['skip_ratio'] == 0.0
+    assert never['max_error'] == 0.0
+
+    # Only the first and last step of every run compute
+    always = simulate_teacache(traces, coefficients, rel_l1_thresh=1e9)
+    assert always['skip_ratio'] == pytest.approx(8 / 10)
+    assert always['max_error'] > 0.0
+
+
+def test_simulate_error_accumulates_until_recompute():
+    trace = dict(mode='model', num_steps=5, input_rel_l1=[0.1, 0.1, 0.1, 0.1], output_rel_l1=[0.2, 0.2, 0.2, 0.2])
+
+    # Skips steps 1 and 2, recomputes at 3 (accumulated 0.3) and at the last step
+    result = simulate_teacache([trace], [1.0, 0.0], rel_l1_thresh=0.25)
+    assert result['skip_ratio'] == pytest.approx(2 / 5)
+    assert result['mean_error'] == pytest.approx((0 + 0.2 + 0.4 + 0 + 0) / 5)
+    assert result['max_error'] == pytest.approx(0.4)
+
+
+def test_calibrate_picks_largest_threshold_within_budget():
+    traces = synthetic_traces(mode='model') + synthetic_traces(mode='blocks', seed=1)
+    presets = {'standard': {'mode': 'model'}, 'hand_optimized': {'mode': 'blocks'}, 'quality_first': {'mode': 'model'}}
+    budgets = {'standard': 0.2, 'hand_optimized': 0.05}
+
+    calibration = calibrate(traces, presets, budgets, degree=2)
+
+    assert set(calibration['modes']) == {'model', 'blocks'}
+    assert set(calibration['presets']) == {'standard', 'hand_optimized'}  # quality_first has no budget
+
+    for name, preset in calibration['presets'].items():
+        assert preset['mean_error'] <= budgets[name]
+        sweep = calibration['modes'][preset['mode']]['sweep']
+        larger = [row for row in sweep if row['rel_l1_thresh'] > preset['rel_l1_thresh']]
+        assert all(row['mean_error'] > budgets[name] for row in larger)
+
+    assert calibration['presets']['hand_optimized']['rel_l1_thresh'] < calibration['presets']['standard']['rel_l1_thresh']
+
+
+def test_round_trip_and_calibrated_settings(tmp_path):
+    traces = synthetic_traces()
+    traces_path = str(tmp_path / 'traces.jsonl')
+    write_traces(traces_path, traces[:2])
+    write_traces(traces_path, traces[2:])
+    assert read_traces(traces_path) == traces
+
+    calibration = calibrate(traces, {'standard': {'mode': 'model'}}, {'standard': 0.2}, degree=2)
+    calibration_path = str(tmp_path / 'calibration.json')
+    save_calibration(calibration_path, calibration)
+    loaded = load_calibration(calibration_path)
+    assert loaded == calibration
+    assert load_calibration(str(tmp_path / 'missing.json')) is None
+
+    settings, coefficients = calibrated_settings('standard', {'rel_l1_thresh': 0.15, 'mode': 'model'}, loaded)
+    assert settings['rel_l1_thresh'] == loaded['presets']['standard']['rel_l1_thresh']
+    assert coefficients == loaded['modes']['model']['coefficients']
+
+    # A preset whose mode was changed since calibration keeps its own settings
+    settings, coefficients = calibrated_settings('standard', {'rel_l1_thresh': 0.15, 'mode': 'blocks'}, loaded)
+    assert settings['rel_l1_thresh'] == 0.15 and coefficients is None
+
+
+def test_hand_presets_use_teacache_only_once_calibrated():
+    teacache_config = {'standard': {'mode': 'model'}, 'hand_optimized': {'mode': 'blocks'}}
+    hand_preset = {'use_teacache': False, 'calibrated_teacache': 'hand_optimized'}
+    default_preset = {'use_teacache': True}
+
+    assert preset_teacache(hand_preset, teacache_config, None) == (False, False)
+    assert preset_teacache(default_preset, teacache_config, None) == (True, False)
+
+    # Only model mode calibrated: block-level hand optimization is still unvalidated
+    model_only = calibrate(synthetic_traces(), {'standard': {'mode': 'model'}}, {'standard': 0.2}, degree=2)
+    assert preset_teacache(hand_preset, teacache_config, model_only) == (False, False)
+
+    traces = synthetic_traces(mode='model') + synthetic_traces(mode='blocks', seed=1)
+    calibration = calibrate(traces, teacache_config, {'standard': 0.2, 'hand_optimized': 0.05}, degree=2)
+    assert preset_teacache(hand_preset, teacache_config, calibration) == (True, True)
+    assert preset_teacache(default_preset, teacache_config, calibration) == (True, False)
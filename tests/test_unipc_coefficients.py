@@ -0,0 +1,177 @@
+import pytest
+import torch
+
+from diffusers_helper.k_diffusion.uni_pc_fm import FlowMatchUniPC, step_coefficients, unipc_coefficients
+
+
+def expand_dims(v, dims):
+    return v[(...,) + (None,) * (dims - 1)]
+
+
+class LoopUniPC:
+    """The per-step UniPC that solved for its coefficients with small tensors on every step."""
+
+    def __init__(self, model, variant='bh1'):
+        self.model = model
+        self.variant = variant
+
+    def update_fn(self, x, model_prev_list, t_prev_list, t, order):
+        dims = x.dim()
+
+        t_prev_0 = t_prev_list[-1]
+        lambda_prev_0 = - torch.log(t_prev_0)
+        lambda_t = - torch.log(t)
+        model_prev_0 = model_prev_list[-1]
+
+        h = lambda_t - lambda_prev_0
+
+        rks = []
+        D1s = []
+        for i in range(1, order):
+            t_prev_i = t_prev_list[-(i + 1)]
+            model_prev_i = model_prev_list[-(i + 1)]
+            lambda_prev_i = - torch.log(t_prev_i)
+            rk = ((lambda_prev_i - lambda_prev_0) / h)[0]
+            rks.append(rk)
+            D1s.append((model_prev_i - model_prev_0) / rk)
+
+        rks.append(1.)
+        rks = torch.tensor(rks, dtype=torch.float64)
+
+        R = []
+        b = []
+
+        hh = -h[0]
+        h_phi_1 = torch.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+
+        factorial_i = 1
+
+        B_h = hh if self.variant == 'bh1' else torch.expm1(hh)
+
+        for i in range(1, order + 1):
+            R.append(torch.pow(rks, i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= (i + 1)
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+
+        R = torch.stack(R)
+        b = torch.tensor(b, dtype=torch.float64)
+
+        use_predictor = len(D1s) > 0
+
+        if use_predictor:
+            D1s = torch.stack(D1s, dim=1)
+            if order == 2:
+                rhos_p = torch.tensor([0.5], dtype=torch.float64)
+            else:
+                rhos_p = torch.linalg.solve(R[:-1, :-1], b[:-1])
+        else:
+            D1s = None
+            rhos_p = None
+
+        if order == 1:
+            rhos_c = torch.tensor([0.5], dtype=torch.float64)
+        else:
+            rhos_c = torch.linalg.solve(R, b)
+
+        x_t_ = expand_dims(t / t_prev_0, dims) * x - expand_dims(h_phi_1, dims) * model_prev_0
+
+        if use_predictor:
+            pred_res = torch.tensordot(D1s, rhos_p, dims=([1], [0]))
+        else:
+            pred_res = 0
+
+        x_t = x_t_ - expand_dims(B_h, dims) * pred_res
+        model_t = self.model(x_t, t)
+
+        if D1s is not None:
+            corr_res = torch.tensordot(D1s, rhos_c[:-1], dims=([1], [0]))
+        else:
+            corr_res = 0
+
+        D1_t = (model_t - model_prev_0)
+        x_t = x_t_ - expand_dims(B_h, dims) * (corr_res + rhos_c[-1] * D1_t)
+
+        return x_t, model_t
+
+    def sample(self, x, sigmas):
+        order = min(3, len(sigmas) - 2)
+        model_prev_list, t_prev_list = [], []
+        for i in range(len(sigmas) - 1):
+            vec_t = sigmas[i].expand(x.shape[0])
+
+            if i == 0:
+                model_prev_list = [self.model(x, vec_t)]
+                t_prev_list = [vec_t]
+            else:
+                x, model_x = self.update_fn(x, model_prev_list, t_prev_list, vec_t, min(i, order))
+                model_prev_list.append(model_x)
+                t_prev_list.append(vec_t)
+
+            model_prev_list = model_prev_list[-order:]
+            t_prev_list = t_prev_list[-order:]
+
+        return model_prev_list[-1]
+
+
+class ToyFlowModel:
+    def __init__(self, channels=4):
+        generator = torch.Generator().manual_seed(0)
+        self.weight = torch.randn(channels, channels, generator=generator, dtype=torch.float64) / channels
+        self.calls = 0
+
+    def __call__(self, x, t):
+        self.calls += 1
+        return torch.tanh(torch.einsum('oc,bchw->bohw', self.weight, x)) * expand_dims(1 - t, x.dim()) + 0.1 * x
+
+
+def shifted_sigmas(steps, shift=3.0):
+    sigmas = torch.linspace(1, 0, steps + 1, dtype=torch.float64)
+    return shift * sigmas / (1 + (shift - 1) * sigmas)
+
+
+@pytest.mark.parametrize('variant', ['bh1', 'bh2'])
+@pytest.mark.parametrize('steps', [2, 3, 4, 10, 25])
+def test_sample_matches_per_step_loop(variant, steps):
+    torch.manual_seed(steps)
+    noise = torch.randn(2, 4, 3, 3, dtype=torch.float64)
+    sigmas = shifted_sigmas(steps)
+
+    expected = LoopUniPC(ToyFlowModel(), variant=variant).sample(noise.clone(), sigmas)
+    model = ToyFlowModel()
+    result = FlowMatchUniPC(lambda x, t: model(x, t), extra_args={}, variant=variant).sample(noise.clone(), sigmas, disable_pbar=True)
+
+    assert model.calls == steps
+    assert torch.allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('variant', ['bh1', 'bh2'])
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_step_coefficients_match_single_update(variant, order):
+    generator = torch.Generator().manual_seed(order)
+    sigmas = shifted_sigmas(8)[:order + 1].tolist()
+    x = torch.randn(1, 4, 2, 2, generator=generator, dtype=torch.float64)
+    model_prev_list = [torch.randn(1, 4, 2, 2, generator=generator, dtype=torch.float64) for _ in range(order)]
+    model_t = torch.randn(1, 4, 2, 2, generator=generator, dtype=torch.float64)
+
+    t_prev_list = [torch.tensor([s], dtype=torch.float64) for s in sigmas[:-1]]
+    t = torch.tensor([sigmas[-1]], dtype=torch.float64)
+    expected, _ = LoopUniPC(lambda x_t, t: model_t, variant=variant).update_fn(x, model_prev_list, t_prev_list, t, order)
+
+    x_weight, predictor, corrector, model_t_weight = step_coefficients(sigmas[:-1], sigmas[-1], order, variant)
+    result = x_weight * x + sum(w * m for w, m in zip(corrector, model_prev_list)) + model_t_weight * model_t
+
+    assert len(predictor) == order
+    assert torch.allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_coefficient_table_is_cached_per_schedule():
+    sigmas = shifted_sigmas(6)
+
+    table = unipc_coefficients(sigmas, 3, 'bh1')
+
+    assert table[0] is None
+    assert len(table) == len(sigmas) - 1
+    assert unipc_coefficients(sigmas.tolist(), 3, 'bh1') is table
+    assert unipc_coefficients(sigmas, 3, 'bh2') is not table
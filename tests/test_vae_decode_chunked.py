@@ -0,0 +1,65 @@
+import types
+
+import pytest
+import torch
+
+pytest.importorskip('diffusers')
+
+from diffusers_helper.hunyuan import vae_decode, vae_decode_chunked
+
+
+class FakeCausalVAE:
+    """
+    Stand-in for the video VAE: latent 0 decodes to one frame and every later
+    latent to four, each depending on its latent and the one before it. The first
+    latent of a decode call sees zeros in front, like the start of a clip.
+    """
+
+    def __init__(self, channels=4):
+        generator = torch.Generator().manual_seed(0)
+        self.config = types.SimpleNamespace(scaling_factor=0.5)
+        self.device = torch.device('cpu')
+        self.dtype = torch.float32
+        self.current = torch.randn(3, channels, generator=generator)
+        self.previous = torch.randn(3, channels, generator=generator)
+
+    def decode(self, latents):
+        previous = torch.cat([torch.zeros_like(latents[:, :, :1]), latents[:, :, :-1]], dim=2)
+        mixed = torch.einsum('oc,bcthw->bothw', self.current, latents) + torch.einsum('oc,bcthw->bothw', self.previous, previous)
+
+        frames = [torch.tanh(mixed[:, :, :1])]
+        for k in range(4):
+            frames.append(torch.tanh(mixed[:, :, 1:] + 0.1 * k))
+        later = torch.stack(frames[1:], dim=3).flatten(2, 3)
+        return types.SimpleNamespace(sample=torch.cat([frames[0], later], dim=2))
+
+
+def to_uint8(pixels):
+    return (torch.clamp(pixels.float(), -1., 1.) * 127.5 + 127.5).to(torch.uint8)
+
+
+@pytest.mark.parametrize('latent_frames', [1, 2, 8, 9, 13, 20])
+@pytest.mark.parametrize('chunk_latent_frames', [1, 4, 8])
+def test_chunked_decode_matches_single_decode(latent_frames, chunk_latent_frames):
+    torch.manual_seed(latent_frames)
+    vae = FakeCausalVAE()
+    latents = torch.randn(2, 4, latent_frames, 3, 5)
+
+    expected = to_uint8(vae_decode(latents, vae))
+    chunks = list(vae_decode_chunked(latents, vae, chunk_latent_frames=chunk_latent_frames))
+
+    assert all(chunk.dtype == torch.uint8 for chunk in chunks)
+    decoded = torch.cat(chunks, dim=2)
+    assert decoded.shape == expected.shape
+    # The crossfade mixes two decodes of the same frames, so only rounding can differ
+    assert (decoded.int() - expected.int()).abs().max() <= 1
+
+
+def test_chunks_stay_bounded():
+    vae = FakeCausalVAE()
+    latents = torch.randn(1, 4, 33, 2, 2)
+
+    sizes = [chunk.shape[2] for chunk in vae_decode_chunked(latents, vae, chunk_latent_frames=8)]
+
+    assert sum(sizes) == 4 * (33 - 1) + 1
+    assert max(sizes) <= 4 * 8 + 4